@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.database import data_version
+
+# Columns hidden from each access tier, with the reason reported to the caller
+ACCESS_TIERS = {
+    "public": {
+        "gender": "registered access only",
+        "race": "registered access only",
+        "ethnicity": "registered access only",
+        "year_of_birth": "controlled access only",
+    },
+    "registered": {
+        "year_of_birth": "controlled access only",
+    },
+    "controlled": {},
+}
+DEFAULT_TIER = "public"
+# Least to most privileged; a caller may read at any tier up to the one they are entitled to
+TIER_ORDER = ("public", "registered", "controlled")
+
+# Distinct (query, tier) projections kept compiled
+PROJECTION_CACHE_SIZE = int(os.getenv("PROJECTION_CACHE_SIZE", "512"))
+
+def base_name(column: str) -> str:
+    # SQLite names a repeated output column "name:1", "name:2"...; it is still that column
+    return column.split(":", 1)[0].lower()
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+class ProjectionCache:
+    """Tier-specific rewrites of a query that select only the columns the tier may see.
+
+    The query is wrapped as SELECT <allowed columns> FROM (query); SQLite flattens the subquery,
+    so hidden columns are never read from the table. The column list is worked out once per
+    query, tier and database version and reused afterwards.
+    """
+
+    def __init__(self, max_entries: int = PROJECTION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def project(self, session: Session, query: str, params: Any, tier: str) -> str:
+        hidden = {field.lower() for field in ACCESS_TIERS[tier]}
+        if not hidden:
+            return query
+        key = (data_version(), tier, query)
+        with self._lock:
+            sql = self._entries.get(key)
+            if sql is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return sql
+            self.misses += 1
+
+        probe = session.execute(text(f"SELECT * FROM ({query}) AS _probe LIMIT 0"), params)
+        columns = list(probe.keys())
+        probe.close()
+        allowed = [column for column in columns if base_name(column) not in hidden]
+        if len(allowed) == len(columns):
+            sql = query
+        elif allowed:
+            sql = f"SELECT {', '.join(quote_identifier(c) for c in allowed)} FROM ({query}) AS _tier"
+        else:
+            # Every column is hidden; keep the row count with a placeholder that is replaced by the source label
+            sql = f'SELECT NULL AS "source" FROM ({query}) AS _tier'
+
+        with self._lock:
+            self._entries[key] = sql
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return sql
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+projections = ProjectionCache()
+
+def resolve_tier(requested: Optional[str], entitled: str) -> str:
+    """The requested tier, lowered to the entitled one when it asks for more; unknown tiers pass through."""
+    tier = requested or DEFAULT_TIER
+    if tier in TIER_ORDER and TIER_ORDER.index(tier) > TIER_ORDER.index(entitled):
+        return entitled
+    return tier
@@ -0,0 +1,136 @@
+import csv
+import os
+import time
+from typing import Callable, Iterable, Iterator, List, Optional
+
+# Rows per BigQuery page or file batch, and rows written per transaction
+BULK_LOAD_PAGE_SIZE = int(os.getenv("BULK_LOAD_PAGE_SIZE", "10000"))
+BULK_LOAD_COMMIT_ROWS = int(os.getenv("BULK_LOAD_COMMIT_ROWS", "200000"))
+
+# Set on the loading connection only. A half-built file is thrown away and rebuilt, so there is
+# nothing to gain from syncing to disk after every transaction.
+LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "temp_store": "MEMORY",
+    "cache_size": -256 * 1024,
+}
+
+Page = List[tuple]
+
+class LoadReport:
+    def __init__(self, table: str, rows: int, pages: int, seconds: float, write_seconds: float):
+        self.table = table
+        self.rows = rows
+        self.pages = pages
+        self.seconds = seconds
+        # Time spent inside executemany/commit; the rest went to fetching and converting pages
+        self.write_seconds = write_seconds
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.table}: {self.rows:,} rows in {self.pages} pages, {self.seconds:.2f}s "
+            f"({self.rows_per_second:,.0f} rows/s, {self.write_seconds:.2f}s writing)"
+        )
+
+def bigquery_pages(client, query: str, table, page_size: int = BULK_LOAD_PAGE_SIZE) -> Iterator[Page]:
+    """A BigQuery result as pages of tuples in the table's column order, fetched one page at a time."""
+    columns = [column.name for column in table.columns]
+    for page in client.query(query).result(page_size=page_size).pages:
+        yield [tuple(row[column] for column in columns) for row in page]
+
+def file_pages(path: str, table, page_size: int = BULK_LOAD_PAGE_SIZE,
+               keep: Optional[Callable[[tuple], bool]] = None) -> Iterator[Page]:
+    """A local Parquet or CSV export as pages of tuples in the table's column order.
+
+    Columns the file lacks are loaded as NULL. keep, if given, is called with each row tuple and
+    drops the rows it returns False for, e.g. to take one ID range out of a full export.
+    """
+    pages = parquet_pages(path, table, page_size) if path.endswith(".parquet") else csv_pages(path, table, page_size)
+    for page in pages:
+        if keep is not None:
+            page = [row for row in page if keep(row)]
+        if page:
+            yield page
+
+def parquet_pages(path: str, table, page_size: int) -> Iterator[Page]:
+    import pyarrow.parquet as pq
+
+    columns = [column.name for column in table.columns]
+    parquet = pq.ParquetFile(path)
+    present = [column for column in columns if column in parquet.schema_arrow.names]
+    for batch in parquet.iter_batches(batch_size=page_size, columns=present):
+        values = {name: batch.column(i).to_pylist() for i, name in enumerate(batch.schema.names)}
+        missing = [None] * batch.num_rows
+        yield list(zip(*(values.get(column, missing) for column in columns)))
+
+def csv_pages(path: str, table, page_size: int) -> Iterator[Page]:
+    # CSV has no types; empty cells are NULL and the rest are cast to the column's Python type
+    converters = []
+    for column in table.columns:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = str
+        converters.append((column.name, python_type))
+
+    with open(path, newline="", encoding="utf-8") as f:
+        page = []
+        for record in csv.DictReader(f):
+            page.append(tuple(
+                None if record.get(name) in (None, "") else cast(record[name])
+                for name, cast in converters
+            ))
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+def bulk_load(engine, table, pages: Iterable[Page], commit_rows: int = BULK_LOAD_COMMIT_ROWS) -> LoadReport:
+    """Insert pages of row tuples with executemany, committing every commit_rows rows.
+
+    Rows whose primary key already exists are replaced, as session.merge() did, without the
+    SELECT that merge issues per row.
+    """
+    columns = [column.name for column in table.columns]
+    sql = 'INSERT OR REPLACE INTO "{}" ({}) VALUES ({})'.format(
+        table.name, ", ".join(f'"{column}"' for column in columns), ", ".join("?" for _ in columns),
+    )
+    start = time.perf_counter()
+    rows = pages_loaded = pending = 0
+    write_seconds = 0.0
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        restore = {name: cursor.execute(f"PRAGMA {name}").fetchone()[0] for name in LOAD_PRAGMAS}
+        for name, value in LOAD_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        try:
+            for page in pages:
+                write_start = time.perf_counter()
+                cursor.executemany(sql, page)
+                rows += len(page)
+                pages_loaded += 1
+                pending += len(page)
+                if pending >= commit_rows:
+                    connection.commit()
+                    pending = 0
+                write_seconds += time.perf_counter() - write_start
+            write_start = time.perf_counter()
+            connection.commit()
+            write_seconds += time.perf_counter() - write_start
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            for name, value in restore.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+    finally:
+        connection.close()
+    return LoadReport(table.name, rows, pages_loaded, time.perf_counter() - start, write_seconds)
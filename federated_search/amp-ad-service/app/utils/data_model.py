@@ -0,0 +1,213 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+from app.database import data_version
+from app.utils.query_guard import table_aliases
+
+# Distinct query shapes (query text and result columns) whose column types are kept
+DATA_MODEL_CACHE_SIZE = int(os.getenv("DATA_MODEL_CACHE_SIZE", "512"))
+
+def value_type(value) -> Optional[str]:
+    # bool is a subclass of int, so it has to be tested first
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, (float, Decimal)):
+        return "number"
+    return "string"
+
+def schema_type(sql_type) -> Optional[str]:
+    """JSON schema type of a reflected column type, or None for untyped SQLite columns."""
+    try:
+        python_type = sql_type.python_type
+    except NotImplementedError:
+        return None
+    if issubclass(python_type, bool):
+        return "boolean"
+    if issubclass(python_type, int):
+        return "integer"
+    if issubclass(python_type, (float, Decimal)):
+        return "number"
+    return "string"
+
+# A select-list item that only names a column, optionally qualified and renamed
+PLAIN_ITEM = re.compile(r'^(?:"?\w+"?\s*\.\s*)?"?(\w+)"?(?:\s+(?:as\s+)?"?(\w+)"?)?$', flags=re.IGNORECASE)
+STAR_ITEM = re.compile(r'^(?:"?\w+"?\s*\.\s*)?\*$')
+FROM_KEYWORD = re.compile(r'from\b', flags=re.IGNORECASE)
+
+def select_items(query: str) -> Optional[List[str]]:
+    """The items of the outermost SELECT list, or None if the query does not start with one."""
+    match = re.match(r'\s*select\s+(?:distinct\s+|all\s+)?', query, flags=re.IGNORECASE)
+    if not match:
+        return None
+    items, start, depth, quote = [], match.end(), 0, None
+    for i in range(match.end(), len(query)):
+        char = query[i]
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"`[":
+            quote = "]" if char == "[" else char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and char == ",":
+            items.append(query[start:i].strip())
+            start = i + 1
+        elif depth == 0 and FROM_KEYWORD.match(query, i) and not (query[i - 1].isalnum() or query[i - 1] == "_"):
+            break
+    else:
+        i = len(query)
+    items.append(query[start:i].strip())
+    return items
+
+def plain_references(query: str) -> Tuple[Dict[str, str], Set[str], bool]:
+    """Result columns that are plain references to a table column.
+
+    Returns (result name -> referenced column, names of computed items, whether a * is selected),
+    all lowercased. Only the referenced columns may take their type from the schema; an expression
+    aliased to a column's name (COUNT(*) AS person_id) may not.
+    """
+    references, computed, star = {}, set(), False
+    for item in select_items(query) or []:
+        if STAR_ITEM.match(item):
+            star = True
+            continue
+        match = PLAIN_ITEM.match(item)
+        if match:
+            references[(match.group(2) or match.group(1)).lower()] = match.group(1).lower()
+        else:
+            alias = re.search(r'\bas\s+"?(\w+)"?\s*$', item, flags=re.IGNORECASE)
+            computed.add((alias.group(1) if alias else item).lower())
+    return references, computed, star
+
+def fill_value_types(types: Dict[str, Optional[str]], rows: Iterable[Mapping]):
+    """Type the columns no schema declares from their first non-NULL value."""
+    missing = [column for column, kind in types.items() if kind is None]
+    for row in rows:
+        if not missing:
+            break
+        for column in list(missing):
+            kind = value_type(row.get(column))
+            if kind is not None:
+                types[column] = kind
+                missing.remove(column)
+
+def object_model(types: Mapping[str, Optional[str]]) -> dict:
+    if not types:
+        return {"type": "object", "properties": {}}
+    return {
+        "type": "object",
+        "properties": {column: {"type": kind or "string"} for column, kind in types.items()},
+        "required": list(types),
+    }
+
+class SchemaCache:
+    """Column types from the table schema, per table and per query shape, for the database on disk.
+
+    A query's result columns that plainly reference a column (by name, through *, or renamed) take
+    that column's type from the tables the query reads, so the model does not depend on which values
+    happen to be in the first row. Everything else, expressions included, is left as None for
+    fill_value_types. Entries are dropped
+    when data_version() changes, which is the case for any rebuilt or altered database file.
+    """
+
+    def __init__(self, max_entries: int = DATA_MODEL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._version = None
+        self._tables: Dict[str, Dict[str, Optional[str]]] = {}
+        self._queries: "OrderedDict[tuple, Dict[str, Optional[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        version = data_version()
+        with self._lock:
+            if version != self._version:
+                if self._tables or self._queries:
+                    self.invalidations += 1
+                self._tables.clear()
+                self._queries.clear()
+                self._version = version
+
+    def table_types(self, session: Session, table: str) -> Dict[str, Optional[str]]:
+        """Column name -> type for one table, in declaration order; empty for tables that do not exist."""
+        with self._lock:
+            types = self._tables.get(table.lower())
+        if types is not None:
+            return types
+        inspector = inspect(session.connection())
+        if inspector.has_table(table):
+            types = {column["name"]: schema_type(column["type"]) for column in inspector.get_columns(table)}
+        else:
+            types = {}
+        with self._lock:
+            self._tables[table.lower()] = types
+        return types
+
+    def column_types(self, session: Session, query: str, columns: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Type of each result column, in column order; a copy the caller may fill in."""
+        self._check_version()
+        columns = tuple(columns)
+        key = (query, columns)
+        with self._lock:
+            types = self._queries.get(key)
+            if types is not None:
+                self._queries.move_to_end(key)
+                self.hits += 1
+                return dict(types)
+            self.misses += 1
+
+        # SQLite column names are case-insensitive
+        tables = list(dict.fromkeys(table_aliases(query).values()))
+        schemas = [
+            {column.lower(): kind for column, kind in self.table_types(session, table).items()}
+            for table in tables
+        ]
+        references, computed, star = plain_references(query)
+        types = {}
+        for column in columns:
+            name = column.lower()
+            source = references.get(name)
+            if source is None and star and name not in computed:
+                # A repeated column from * comes back as name:1
+                source = name.split(":", 1)[0]
+            types[column] = next((schema[source] for schema in schemas if schema.get(source)), None) if source else None
+
+        with self._lock:
+            self._queries[key] = types
+            while len(self._queries) > self.max_entries:
+                self._queries.popitem(last=False)
+        return dict(types)
+
+    def stats(self) -> dict:
+        return {
+            "tables": len(self._tables),
+            "queries": len(self._queries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._queries.clear()
+
+schema_cache = SchemaCache()
+
+def result_model(session: Session, query: str, columns: List[str], rows: Iterable[Mapping] = ()) -> dict:
+    types = schema_cache.column_types(session, query, columns)
+    fill_value_types(types, rows)
+    return object_model(types)
@@ -0,0 +1,15 @@
+import json
+from typing import Optional
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Streamed /search responses are newline-delimited JSON. Every line is one object:
+#   {"data_model": {...}, ...}   header, always the first line
+#   {"data": {...}}              one line per row
+#   {"pagination": {...}, ...}   trailer, always the last line
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    return NDJSON_MEDIA_TYPE in (accept or "")
+
+def encode_line(message: dict) -> bytes:
+    return (json.dumps(message, default=str) + "\n").encode("utf-8")
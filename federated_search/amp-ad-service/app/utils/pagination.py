@@ -0,0 +1,100 @@
+import base64
+import json
+import re
+from typing import Any, Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# Primary keys of the tables we serve. When a query reads a single table and returns one of
+# these columns, pages are fetched by keyset (WHERE key > last key) instead of OFFSET, so
+# deep pages do not rescan every earlier row.
+KEYSET_COLUMNS = ("person_id", "ID", "drs_url")
+
+# Anything that can reorder rows or repeat a key value rules out keyset pagination
+KEYSET_BLOCKERS = re.compile(
+    r"\b(join|group\s+by|order\s+by|union|intersect|except|distinct|with|limit|offset)\b",
+    flags=re.IGNORECASE,
+)
+
+def is_paginatable(query: str) -> bool:
+    return not re.search(r'\blimit\b', query, flags=re.IGNORECASE)
+
+def encode_token(data: dict) -> str:
+    raw = json.dumps(data, separators=(",", ":"), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_token(token: str) -> dict:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise ValueError("Malformed page token")
+    if not isinstance(data, dict):
+        raise ValueError("Malformed page token")
+    return data
+
+def supports_keyset(query: str) -> bool:
+    if KEYSET_BLOCKERS.search(query):
+        return False
+    match = re.search(r'\bfrom\b(.*)', query, flags=re.IGNORECASE | re.DOTALL)
+    if not match:
+        return False
+    from_clause = re.split(r'\bwhere\b', match.group(1), maxsplit=1, flags=re.IGNORECASE)[0]
+    return "," not in from_clause and not re.search(r'\bselect\b', from_clause, flags=re.IGNORECASE)
+
+class PagePlan:
+    """SQL for one page of a query, plus what is needed to find where the next page starts."""
+
+    def __init__(self, sql: str, params: Dict[str, Any], limit: int, key: Optional[str] = None, offset: int = 0):
+        self.sql = sql
+        self.params = params
+        self.limit = limit
+        self.key = key
+        self.offset = offset
+
+    def next_position(self, last_row: Any, has_more: bool) -> Optional[dict]:
+        if not has_more:
+            return None
+        if self.key:
+            return {"k": self.key, "a": getattr(last_row, "_mapping", last_row)[self.key]}
+        return {"o": self.offset + self.limit}
+
+def plan_page(db: Session, query: str, params: Dict[str, Any], limit: int, position: Optional[dict] = None,
+              keyset_query: Optional[str] = None) -> PagePlan:
+    """Plan one page of query. A fresh page has no position; keyset is only chosen for one.
+
+    keyset_query is the query as the caller wrote it, when query is a rewrite of it (such as a tier
+    projection) whose wrapping subquery would otherwise rule keyset out.
+    """
+    # Each plan fetches limit + 1 rows; the extra row only tells us whether another page exists
+    query = query.strip().rstrip(';')
+    position = position or {}
+    page_params = {**params, "_page_limit": limit + 1}
+
+    key = position.get("k")
+    if key is None and "o" not in position and supports_keyset((keyset_query or query).strip().rstrip(';')):
+        probe = db.execute(text(f"SELECT * FROM ({query}) AS _probe LIMIT 0"), params)
+        key = next((column for column in KEYSET_COLUMNS if column in probe.keys()), None)
+        probe.close()
+
+    if key in KEYSET_COLUMNS:
+        where = ""
+        if "a" in position:
+            where = f' WHERE "{key}" > :_page_after'
+            page_params["_page_after"] = position["a"]
+        sql = f'SELECT * FROM ({query}) AS _page{where} ORDER BY "{key}" LIMIT :_page_limit'
+        return PagePlan(sql, page_params, limit, key=key)
+
+    offset = int(position.get("o", 0))
+    page_params["_page_offset"] = offset
+    return PagePlan(f"{query} LIMIT :_page_limit OFFSET :_page_offset", page_params, limit, offset=offset)
+
+def split_page(plan: PagePlan, rows: list):
+    """Drop the look-ahead row and return (page rows, position of the next page or None)."""
+    has_more = len(rows) > plan.limit
+    rows = rows[:plan.limit]
+    return rows, plan.next_position(rows[-1] if rows else None, has_more)
+
+def fetch_page(db: Session, query: str, params: Dict[str, Any], limit: int, position: Optional[dict] = None):
+    plan = plan_page(db, query, params, limit, position)
+    return split_page(plan, db.execute(text(plan.sql), plan.params).fetchall())
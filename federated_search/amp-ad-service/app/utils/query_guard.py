@@ -0,0 +1,137 @@
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Optional
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from app.database import data_version
+
+# Wall-clock seconds one /search may spend inside SQLite; 0 disables the budget
+QUERY_TIME_BUDGET = float(os.getenv("QUERY_TIME_BUDGET", "10"))
+# SQLite VM instructions between budget checks
+QUERY_PROGRESS_STEPS = int(os.getenv("QUERY_PROGRESS_STEPS", "10000"))
+
+# Queries whose plan joins full table scans are rejected when the product of the scanned tables'
+# row counts exceeds this estimate; 0 disables the plan check
+QUERY_MAX_PLAN_COST = float(os.getenv("QUERY_MAX_PLAN_COST", str(10 ** 8)))
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+class QueryRejected(Exception):
+    pass
+
+def is_interrupt(exc: BaseException) -> bool:
+    return isinstance(exc, OperationalError) and "interrupted" in str(exc.orig)
+
+class QueryGuard:
+    """Interrupts statements on a session's connection once the time budget runs out.
+
+    Use as a context manager around the work. When rows are read after the block ends, as with
+    streamed responses, call detach() inside the block and stop() once the rows are consumed.
+    """
+
+    def __init__(self, session: Session, budget: Optional[float] = None):
+        self.session = session
+        self.budget = QUERY_TIME_BUDGET if budget is None else budget
+        self._connection = None
+        self._deadline = 0.0
+        self._detached = False
+
+    def start(self):
+        if self.budget <= 0:
+            return self
+        self._deadline = time.monotonic() + self.budget
+        self._connection = self.session.connection().connection.dbapi_connection
+        self._connection.set_progress_handler(self._check, QUERY_PROGRESS_STEPS)
+        return self
+
+    def _check(self) -> int:
+        # A non-zero return makes SQLite abort the running statement with SQLITE_INTERRUPT
+        return 1 if time.monotonic() > self._deadline else 0
+
+    def stop(self):
+        if self._connection is not None:
+            self._connection.set_progress_handler(None, 0)
+            self._connection = None
+
+    def detach(self):
+        self._detached = True
+
+    def error(self) -> QueryBudgetExceeded:
+        return QueryBudgetExceeded(f"Query exceeded its execution budget of {self.budget:g} seconds")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None or not self._detached:
+            self.stop()
+        if exc is not None and is_interrupt(exc):
+            raise self.error() from exc
+        return False
+
+SCAN_DETAIL = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?', flags=re.IGNORECASE)
+_TABLE_REF = re.compile(
+    r'\b(?:from|join)\s+"?(\w+)"?(?:\s+(?:as\s+)?"?(\w+)"?)?|,\s*"?(\w+)"?(?:\s+(?:as\s+)?"?(\w+)"?)?',
+    flags=re.IGNORECASE,
+)
+
+# Row estimates per (database version, table)
+_row_counts: Dict[tuple, int] = {}
+_row_counts_lock = threading.Lock()
+
+def table_aliases(query: str) -> Dict[str, str]:
+    # EXPLAIN QUERY PLAN names scans by alias, so map aliases back to the tables they read
+    aliases = {}
+    for match in _TABLE_REF.finditer(query):
+        table, alias = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+        aliases[table.lower()] = table
+        if alias:
+            aliases[alias.lower()] = table
+    return aliases
+
+def estimated_rows(session: Session, table: str) -> int:
+    key = (data_version(), table)
+    with _row_counts_lock:
+        if key in _row_counts:
+            return _row_counts[key]
+    try:
+        # The largest rowid is an index lookup, unlike COUNT(*)
+        rows = session.execute(text(f'SELECT MAX(rowid) FROM "{table}"')).scalar() or 0
+    except Exception:
+        rows = 1
+    with _row_counts_lock:
+        _row_counts[key] = rows
+    return rows
+
+def clear_row_counts():
+    with _row_counts_lock:
+        _row_counts.clear()
+
+def check_plan(session: Session, query: str, params: Any, max_cost: Optional[float] = None):
+    """Reject a query whose plan nests full table scans above max_cost estimated rows."""
+    max_cost = QUERY_MAX_PLAN_COST if max_cost is None else max_cost
+    if max_cost <= 0:
+        return
+    plan = session.execute(text(f"EXPLAIN QUERY PLAN {query}"), params).fetchall()
+    aliases = table_aliases(query)
+    scans_by_parent: Dict[int, list] = {}
+    for _, parent, _, detail in plan:
+        match = SCAN_DETAIL.match(detail)
+        if match and match.group(1).lower() in aliases:
+            scans_by_parent.setdefault(parent, []).append(aliases[match.group(1).lower()])
+
+    for tables in scans_by_parent.values():
+        if len(tables) < 2:
+            continue
+        cost = 1
+        for table in tables:
+            cost *= max(estimated_rows(session, table), 1)
+        if cost > max_cost:
+            raise QueryRejected(
+                f"Query joins full scans of {', '.join(tables)} (about {cost:.3g} row combinations, "
+                f"limit {max_cost:.3g}); add a join condition or filter"
+            )
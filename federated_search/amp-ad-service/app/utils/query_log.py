@@ -0,0 +1,45 @@
+import json
+import os
+import threading
+import time
+from typing import Iterator, Optional
+
+# JSON-lines file that /search appends each executed query to; unset disables logging.
+# index_advisor.py reads it to find the scans worth indexing.
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH")
+
+class QueryLog:
+    def __init__(self, path: Optional[str] = QUERY_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, query: str, seconds: float, rows: Optional[int] = None):
+        if not self.path:
+            return
+        line = json.dumps({
+            "ts": round(time.time(), 3),
+            "query": query,
+            "ms": round(seconds * 1000, 3),
+            "rows": rows,
+        })
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+def read_log(path: str) -> Iterator[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A line cut short by a crash should not stop the advisor
+                continue
+
+query_log = QueryLog()
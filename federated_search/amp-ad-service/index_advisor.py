@@ -0,0 +1,44 @@
+"""Recommend, and optionally create, indexes for the scans in the recorded /search query log.
+
+    QUERY_LOG_PATH=./queries.log python index_advisor.py            # print recommendations
+    QUERY_LOG_PATH=./queries.log python index_advisor.py --apply    # also create them
+"""
+import argparse
+from app.database import create_read_engine, create_write_engine
+from app.indexes import create_index, recommend_indexes
+from app.utils.query_log import QUERY_LOG_PATH, read_log
+from sqlalchemy import text
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend indexes from the /search query log.")
+    parser.add_argument("--log", default=QUERY_LOG_PATH, help="query log to read (default: $QUERY_LOG_PATH)")
+    parser.add_argument("--top", type=int, default=10, help="number of recommendations")
+    parser.add_argument("--apply", action="store_true", help="create the recommended indexes")
+    args = parser.parse_args()
+    if not args.log:
+        parser.error("no query log; pass --log or set QUERY_LOG_PATH")
+
+    with create_read_engine().connect() as conn:
+        recommendations = recommend_indexes(conn, read_log(args.log), limit=args.top)
+
+    if not recommendations:
+        print("No unindexed scans found in the query log.")
+        return
+    for candidate in recommendations:
+        columns = ", ".join(candidate["columns"])
+        print(
+            f"{candidate['name']}: {candidate['table']}({columns}) - "
+            f"{candidate['scans']} scans, {candidate['total_ms']:.1f} ms total, e.g. {candidate['example']}"
+        )
+
+    if args.apply:
+        engine = create_write_engine()
+        with engine.begin() as conn:
+            for candidate in recommendations:
+                create_index(conn, candidate["name"], candidate["table"], candidate["columns"])
+            conn.execute(text("ANALYZE"))
+        engine.dispose()
+        print(f"Created {len(recommendations)} indexes.")
+
+if __name__ == "__main__":
+    main()
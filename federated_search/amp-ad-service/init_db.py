@@ -1,32 +1,93 @@
-import csv
-from app.database import Base, engine, SessionLocal
+import argparse
+import json
+import os
+from app.bulk_load import bigquery_pages, bulk_load, file_pages
+from app.database import DATABASE_PATH, Base, create_write_engine
+from app.indexes import build_indexes
 from app.models.person import Person
 from app.models.synthetic_dataset import SyntheticDataset
 from app.models.synthetic_files import SyntheticFiles
-from google.cloud import bigquery
+from app.snapshot import Snapshot, bigquery_watermarks, file_watermark, record_watermarks
+
+# The services open the database read-only; the build writes through its own engine
+engine = create_write_engine()
+
+# A local Parquet or CSV export of the person cohort, with the columns of the person table.
+# When set, it is loaded instead of querying BigQuery, so the build can run offline.
+PERSON_EXPORT = os.getenv("PERSON_EXPORT")
+# Set by build_dbs.py to the watermarks of the export or BigQuery tables a shard was cut from
+PERSON_WATERMARKS = json.loads(os.getenv("PERSON_WATERMARKS", "null"))
+
+# The BigQuery tables the person cohort is read from; their last-modified times are its watermarks
+COHORT_TABLES = (
+    "data-development-440922.sysbio_synth_omop.condition_occurrence",
+    "data-development-440922.sysbio_synth_omop.concept",
+    "data-development-440922.sysbio_synth_omop.person",
+)
 
 # I'm arbitrarily choosing people with ID <= 1500 to be in PD
 # people with 1500 < ID <= 3000 to be in AD
 MAX_PD_ID = 1500
 MAX_AD_ID = 3000
 
+# Synthetic metadata shipped with the service, as (table, CSV file)
+SYNTHETIC_CSVS = (
+    (SyntheticDataset.__table__, "synthetic_dataset.csv"),
+    (SyntheticFiles.__table__, "synthetic_files.csv"),
+)
+
 def init_db():
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
     print("Database tables created.")
 
-    print("Querying BQ for initial data...")
-    sync_bigquery_to_sqlite()
-    print("BigQuery data loaded into SQLite.")
+    print(f"Loading persons from {PERSON_EXPORT or 'BigQuery'}...")
+    sources, pages = person_source()
+    print(bulk_load(engine, Person.__table__, pages()))
+    watermarks = {"person": sources}
 
     print("Loading Synthetic Dataset from CSV...")
-    load_synthetic_data_to_sqlite()
-    load_synthetic_files_to_sqlite()
-    print("Synthetic CSV data loaded into SQLite")
+    for table, path in SYNTHETIC_CSVS:
+        print(bulk_load(engine, table, file_pages(path, table)))
+        watermarks[table.name] = {path: file_watermark(path)}
+
+    print("Building secondary indexes...")
+    created = build_indexes(engine)
+    print(f"Built {len(created)} indexes.")
+    record_watermarks(DATABASE_PATH, watermarks)
+
+def sync_incremental():
+    """Apply new and changed rows to a staging copy of the served database, then swap it in.
+
+    Sources whose watermark has not moved since the last sync or build are not read at all.
+    """
+    if not os.path.exists(DATABASE_PATH):
+        print(f"{DATABASE_PATH} does not exist yet; running a full build.")
+        return init_db()
+
+    print(f"Syncing persons from {PERSON_EXPORT or 'BigQuery'} into a copy of {DATABASE_PATH}...")
+    with Snapshot(DATABASE_PATH) as snapshot:
+        Base.metadata.create_all(bind=snapshot.engine)
+        sources, pages = person_source()
+        print(snapshot.sync(Person.__table__, sources, pages))
+        for table, path in SYNTHETIC_CSVS:
+            print(snapshot.sync(table, {path: file_watermark(path)}, lambda: file_pages(path, table)))
+        build_indexes(snapshot.engine)
+    print(f"Swapped the updated copy into {DATABASE_PATH}.")
+
+def in_shard(row: tuple) -> bool:
+    # person_id is the first column of the person table
+    return MAX_PD_ID < row[0] <= MAX_AD_ID
+
+def person_source():
+    """The watermark of each source the persons come from, and a function that reads this service's rows."""
+    table = Person.__table__
+    if PERSON_EXPORT:
+        sources = PERSON_WATERMARKS or {PERSON_EXPORT: file_watermark(PERSON_EXPORT)}
+        return sources, lambda: file_pages(PERSON_EXPORT, table, keep=in_shard)
 
-def sync_bigquery_to_sqlite():
-    session = SessionLocal()
-    bq_client = bigquery.Client()
+    # Imported here so builds from a local export do not need the BigQuery client installed
+    from google.cloud import bigquery
 
     # This sql is pretty wild. First, it gets each person's latest diagnosis.
     # I call this the ranked_conditions (because the diagnosis is a condition_occurrence concept)
@@ -64,53 +125,15 @@ def sync_bigquery_to_sqlite():
     AND p.person_id <= {MAX_AD_ID}
     """
 
-    result = bq_client.query(query).result()
-
-    for row in result:
-        pc = Person(
-            person_id=row["person_id"],
-            gender=row["gender"],
-            year_of_birth=row["year_of_birth"],
-            race=row["race"],
-            ethnicity=row["ethnicity"],
-            diagnosis_name=row["diagnosis_name"]
-        )
-        session.merge(pc)
-    session.commit()
-    session.close()
-
-def load_synthetic_data_to_sqlite():
-  session = SessionLocal()
-  with open("synthetic_dataset.csv", newline='', encoding='utf-8') as csvfile:
-      reader = csv.DictReader(csvfile)
-      for row in reader:
-          dataset = SyntheticDataset(
-              ID=row["ID"],
-              dataset=row["dataset"],
-              status=row["status"],
-              sex=row["sex"],
-              age_at_sampling=int(row["age_at_sampling"]) if row["age_at_sampling"] else None,
-              age_at_death=int(row["age_at_death"]) if row["age_at_death"] else None,
-              APOE4_compund_genotype=int(row["APOE4_compund_genotype"]) if row["APOE4_compund_genotype"] else None,
-              time_from_baseline=float(row["time_from_baseline"]) if row["time_from_baseline"] else None,
-              repository_link=row["repository_link"]
-          )
-          session.add(dataset)
-      session.commit()
-
-def load_synthetic_files_to_sqlite():
-  session = SessionLocal()
-  with open("synthetic_files.csv", newline='', encoding='utf-8') as csvfile:
-      reader = csv.DictReader(csvfile)
-      for row in reader:
-          syn_file = SyntheticFiles(
-              drs_url=row["drs_url"],
-              filename=row["filename"],
-              filesize_bytes=row["filesize_bytes"],
-              description=row["description"],
-          )
-          session.add(syn_file)
-      session.commit()
+    client = bigquery.Client()
+    # Only table metadata is read here; the query runs when the rows are, a page at a time
+    return bigquery_watermarks(client, COHORT_TABLES), lambda: bigquery_pages(client, query, table)
 
 if __name__ == "__main__":
-    init_db()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="Update a copy of the existing database and swap it in, instead of building from scratch")
+    if parser.parse_args().incremental:
+        sync_incremental()
+    else:
+        init_db()
@@ -0,0 +1,320 @@
+import json
+import time
+import httpx
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.database import Base
+from app.dependencies import get_db
+from app.models.person import Person
+from app.access_policy import projections
+from app import entitlements
+from app.routes import search
+from app.utils import query_guard
+from app.utils.data_model import schema_cache
+from app.utils.pagination import decode_token
+from main import app
+
+test_engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(bind=test_engine)
+
+def override_get_db():
+    db = TestingSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture(scope="module", autouse=True)
+def create_test_db():
+    app.dependency_overrides[get_db] = override_get_db
+    Base.metadata.create_all(bind=test_engine)
+    db = TestingSessionLocal()
+    db.add_all([
+        Person(person_id=1, gender="male", year_of_birth=1980,
+               race="asian", ethnicity="non-hispanic", diagnosis_name="Alzheimer"),
+        Person(person_id=2, gender="female", year_of_birth=1975,
+               race="white", ethnicity="hispanic", diagnosis_name="Alzheimer"),
+    ])
+    db.commit()
+    db.close()
+
+    yield
+
+    Base.metadata.drop_all(bind=test_engine)
+    app.dependency_overrides.pop(get_db, None)
+
+client = TestClient(app)
+
+def test_public_tier_hides_restricted_fields():
+    response = client.post("/search", json={"query": "SELECT * FROM person", "parameters": {"access_tier": "public"}})
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body["data"]) == 2
+    assert "gender" not in body["data"][0]
+    assert body["data"][0]["source"] == "AMP AD"
+    assert "year_of_birth" in body["restricted_fields"]
+
+def test_tier_projection_is_compiled_once_and_skips_hidden_columns():
+    projections.clear()
+    db = TestingSessionLocal()
+    try:
+        sql = projections.project(db, "SELECT * FROM person", {}, "registered")
+        assert sql == (
+            'SELECT "person_id", "gender", "race", "ethnicity", "diagnosis_name" '
+            'FROM (SELECT * FROM person) AS _tier'
+        )
+        assert projections.project(db, "SELECT * FROM person", {}, "controlled") == "SELECT * FROM person"
+    finally:
+        db.close()
+    assert projections.project(None, "SELECT * FROM person", {}, "registered") == sql
+
+def test_self_join_does_not_expose_repeated_hidden_columns():
+    for query in (
+        "SELECT * FROM person p JOIN person q ON p.person_id = q.person_id",
+        "SELECT p.*, q.gender FROM person p JOIN person q ON p.person_id = q.person_id",
+    ):
+        response = client.post("/search", json={"query": query, "parameters": {"access_tier": "public"}})
+        assert response.status_code == 200
+        for row in response.json()["data"]:
+            assert not {column.split(":")[0] for column in row} & {"gender", "race", "ethnicity", "year_of_birth"}
+
+def test_query_of_only_hidden_columns_keeps_row_count():
+    body = client.post("/search", json={"query": "SELECT gender FROM person", "parameters": {}}).json()
+    assert body["data"] == [{"source": "AMP AD"}, {"source": "AMP AD"}]
+
+def test_ndjson_stream_has_header_rows_and_trailer():
+    response = client.post(
+        "/search",
+        json={"query": "SELECT * FROM person", "parameters": {"access_tier": "public"}},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert "data_model" in lines[0]
+    assert "gender" in lines[0]["restricted_fields"]
+    assert [line["data"]["person_id"] for line in lines[1:-1]] == [1, 2]
+    assert "gender" not in lines[1]["data"]
+    assert lines[-1] == {"pagination": {"next_page_url": None}, "truncated": False}
+
+def test_unpaginated_result_is_capped_and_flagged(monkeypatch):
+    monkeypatch.setattr(search, "MAX_RESULT_ROWS", 1)
+    body = client.post("/search", json={"query": "SELECT * FROM person", "parameters": {}}).json()
+    assert [row["person_id"] for row in body["data"]] == [1]
+    assert body["truncated"] is True
+
+    lines = [
+        json.loads(line) for line in client.post(
+            "/search",
+            json={"query": "SELECT * FROM person", "parameters": {}},
+            headers={"Accept": "application/x-ndjson"},
+        ).text.splitlines()
+    ]
+    assert [line["data"]["person_id"] for line in lines[1:-1]] == [1]
+    assert lines[-1]["truncated"] is True
+
+def test_page_size_is_clamped_to_row_cap(monkeypatch):
+    monkeypatch.setattr(search, "MAX_RESULT_ROWS", 1)
+    body = client.post("/search", json={"query": "SELECT * FROM person", "parameters": {}, "limit": 50}).json()
+    assert len(body["data"]) == 1
+    assert body["truncated"] is False
+    assert body["pagination"]["next_page_token"]
+
+def test_invalid_sql_is_rejected_before_streaming():
+    response = client.post(
+        "/search",
+        json={"query": "SELEC WRONG", "parameters": {}},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 400
+
+def test_keyset_pagination_walks_every_page():
+    payload = {"query": "SELECT * FROM person", "parameters": {"access_tier": "public"}, "limit": 1}
+    first = client.post("/search", json=payload).json()
+    assert [row["person_id"] for row in first["data"]] == [1]
+    token = first["pagination"]["next_page_token"]
+    # The public tier wraps the query in a projection; pages still continue from the last key
+    assert decode_token(token) == {"k": "person_id", "a": 1}
+
+    second = client.post("/search", json={**payload, "page_token": token}).json()
+    assert [row["person_id"] for row in second["data"]] == [2]
+    assert second["pagination"]["next_page_token"] is None
+
+def test_ordered_query_falls_back_to_offset_pagination():
+    payload = {
+        "query": "SELECT * FROM person ORDER BY year_of_birth",
+        "parameters": {"access_tier": "controlled"},
+        "limit": 1,
+    }
+    first = client.post("/search", json=payload, headers={"Authorization": "Bearer test"}).json()
+    assert [row["person_id"] for row in first["data"]] == [2]
+    assert decode_token(first["pagination"]["next_page_token"]) == {"o": 1}
+    second = client.post(
+        "/search",
+        json={**payload, "page_token": first["pagination"]["next_page_token"]},
+        headers={"Authorization": "Bearer test"},
+    ).json()
+    assert [row["person_id"] for row in second["data"]] == [1]
+
+def test_arrow_response_drops_restricted_columns():
+    pa = pytest.importorskip("pyarrow")
+    response = client.post(
+        "/search",
+        json={"query": "SELECT * FROM person", "parameters": {"access_tier": "public"}, "limit": 1},
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+    )
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.column_names == ["person_id", "diagnosis_name", "source"]
+    assert table.column("person_id").to_pylist() == [1]
+    pagination = json.loads(table.schema.metadata[b"pagination"])
+    assert pagination["next_page_token"]
+
+def test_query_over_budget_fails_with_error_response(monkeypatch):
+    monkeypatch.setattr(query_guard, "QUERY_TIME_BUDGET", 0.05)
+    runaway = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT COUNT(*) AS c FROM n"
+    response = client.post("/search", json={"query": runaway, "parameters": {"access_tier": "controlled"}})
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["title"] == "Query budget exceeded"
+
+def test_cross_join_above_plan_cost_is_rejected(monkeypatch):
+    monkeypatch.setattr(query_guard, "QUERY_MAX_PLAN_COST", 1)
+    response = client.post("/search", json={"query": "SELECT a.person_id FROM person a, person b", "parameters": {}})
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["title"] == "Query rejected"
+
+def test_metrics_report_search_latency_and_rows():
+    client.post("/search", json={"query": "SELECT * FROM person", "parameters": {}})
+    text = client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="POST",route="/search",status="200"}' in text
+    assert "search_rows_returned_count" in text
+    assert "projection_cache_entries" in text
+
+def test_server_timing_reports_phases_under_the_callers_trace():
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    response = client.post(
+        "/search",
+        json={"query": "SELECT * FROM person", "parameters": {"access_tier": "public"}, "limit": 2, "timings": True},
+        headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+    )
+    assert response.status_code == 200
+    server_timing = response.headers["Server-Timing"]
+    for phase in ("parse", "plan", "sql", "build", "serialize"):
+        assert f"{phase};dur=" in server_timing
+    timings = response.json()["timings"]
+    assert timings["trace_id"] == trace_id
+    assert "serialize" not in timings["phases_ms"]
+
+def test_data_model_comes_from_schema_even_for_null_and_empty_results():
+    schema_cache.clear()
+    nulls = client.post("/search", json={
+        "query": "SELECT p.person_id, NULL AS note, q.year_of_birth, p.year_of_birth * 1.5 AS race "
+                 "FROM person p LEFT JOIN person q ON q.person_id = p.person_id + 100",
+        "parameters": {"access_tier": "controlled"},
+    }, headers={"Authorization": "Bearer x"}).json()
+    assert nulls["data_model"]["properties"]["person_id"] == {"type": "integer"}
+    # NULL in every row, but still a plain reference to an INTEGER column
+    assert nulls["data_model"]["properties"]["year_of_birth"] == {"type": "integer"}
+    assert nulls["data_model"]["properties"]["note"] == {"type": "string"}
+    # An expression aliased to a column's name is typed from its values, not that column
+    assert nulls["data_model"]["properties"]["race"] == {"type": "number"}
+
+    empty = client.post("/search", json={
+        "query": "SELECT * FROM person WHERE person_id < 0", "parameters": {"access_tier": "public"},
+    }).json()
+    assert empty["data"] == []
+    assert empty["data_model"]["required"] == ["person_id", "diagnosis_name", "source"]
+    assert empty["data_model"]["properties"]["person_id"] == {"type": "integer"}
+
+def access_token(sub: str) -> str:
+    return jwt.encode({"sub": sub, "exp": int(time.time()) + 600}, "test-secret", algorithm="HS256")
+
+def signed_visa(key, kid: str, visa_type: str = "ControlledAccessGrants", lifetime: int = 3600) -> str:
+    now = int(time.time())
+    claims = {"iss": "http://auth.test", "sub": "user-1", "iat": now, "exp": now + lifetime,
+              "ga4gh_visa_v1": {"type": visa_type, "asserted": now, "value": "phs000123.v1.p1.c1", "by": "dac"}}
+    return jwt.encode(claims, key, algorithm="RS256", headers={"kid": kid})
+
+def test_visas_are_verified_against_cached_jwks_and_cached_until_expiry(monkeypatch):
+    keys = [rsa.generate_private_key(public_exponent=65537, key_size=2048) for _ in range(2)]
+    published = {"keys": [{**jwk.construct(keys[0], algorithm="RS256").public_key().to_dict(), "kid": "k1"}]}
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return {"keys": list(published["keys"])}
+
+    cache = entitlements.EntitlementCache(
+        entitlements.JWKSCache("http://auth.test/jwks", fetch=fetch, min_refresh=0), issuer="http://auth.test",
+    )
+    monkeypatch.setattr(entitlements, "entitlements", cache)
+    monkeypatch.setattr(entitlements, "JWT_SECRET", "test-secret")
+    payload = {"query": "SELECT * FROM person", "parameters": {"access_tier": "controlled"}}
+    bearer = {"Authorization": f"Bearer {access_token('user-1')}"}
+
+    # A bearer token alone no longer unlocks restricted tiers
+    body = client.post("/search", json=payload, headers=bearer).json()
+    assert "gender" not in body["data"][0]
+
+    visa = signed_visa(keys[0], "k1")
+    for _ in range(3):
+        body = client.post("/search", json=payload, headers={**bearer, "X-GA4GH-Passport": visa}).json()
+        assert "gender" in body["data"][0]
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 2
+    assert len(fetched) == 1
+
+    # The visa only counts for its own subject: not without a valid bearer, nor with someone else's
+    for headers in ({}, {"Authorization": "Bearer x"}, {"Authorization": f"Bearer {access_token('user-2')}"}):
+        body = client.post("/search", json=payload, headers={**headers, "X-GA4GH-Passport": visa}).json()
+        assert "gender" not in body["data"][0]
+
+    # A registered-tier visa caps a controlled request at registered
+    registered = signed_visa(keys[0], "k1", visa_type="AcceptedTermsAndPolicies")
+    body = client.post("/search", json=payload, headers={**bearer, "X-GA4GH-Passport": registered}).json()
+    assert body["restricted_fields"] == client.post(
+        "/search", json={**payload, "parameters": {"access_tier": "registered"}},
+        headers={**bearer, "X-GA4GH-Passport": visa},
+    ).json()["restricted_fields"]
+
+    # Forged and expired visas grant nothing
+    forged = signed_visa(keys[1], "k1")
+    expired = signed_visa(keys[0], "k1", lifetime=-60)
+    for bad in (forged, expired):
+        body = client.post("/search", json=payload, headers={**bearer, "X-GA4GH-Passport": bad}).json()
+        assert "gender" not in body["data"][0]
+
+    # After auth-service rotates its key, the first visa naming the new kid refreshes the key set
+    published["keys"].append({**jwk.construct(keys[1], algorithm="RS256").public_key().to_dict(), "kid": "k2"})
+    body = client.post(
+        "/search", json=payload, headers={**bearer, "X-GA4GH-Passport": signed_visa(keys[1], "k2")},
+    ).json()
+    assert "gender" in body["data"][0]
+    assert len(fetched) == 2
+
+def test_unreachable_jwks_degrades_to_public(monkeypatch):
+    def fetch(url):
+        raise httpx.ConnectError("auth-service is down")
+
+    cache = entitlements.EntitlementCache(entitlements.JWKSCache("http://auth.test/jwks", fetch=fetch))
+    monkeypatch.setattr(entitlements, "entitlements", cache)
+    monkeypatch.setattr(entitlements, "JWT_SECRET", "test-secret")
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    response = client.post(
+        "/search",
+        json={"query": "SELECT * FROM person", "parameters": {"access_tier": "controlled"}},
+        headers={"Authorization": f"Bearer {access_token('user-1')}", "X-GA4GH-Passport": signed_visa(key, "k1")},
+    )
+    assert response.status_code == 200
+    assert "gender" not in response.json()["data"][0]
+    assert cache.stats()["jwks_failures"] == 1
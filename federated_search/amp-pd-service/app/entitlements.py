@@ -0,0 +1,189 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+import httpx
+from jose import jwt
+from jose.exceptions import JOSEError
+from app.access_policy import DEFAULT_TIER, TIER_ORDER
+
+# With AUTH_JWKS_URL set (e.g. http://auth:8080/.well-known/jwks.json), registered and controlled
+# tiers need visas signed by auth-service, sent as X-GA4GH-Passport: <visa>[,<visa>...], issued to
+# the subject of the bearer token in Authorization. Without it, any Authorization header unlocks
+# them, as before verification existed.
+AUTH_JWKS_URL = os.getenv("AUTH_JWKS_URL")
+# Expected "iss" of visas; any issuer whose key is in the JWKS is accepted when unset
+AUTH_ISSUER = os.getenv("AUTH_ISSUER")
+JWKS_TTL = float(os.getenv("JWKS_TTL", "3600"))
+# A visa signed with an unknown key triggers a JWKS refresh at most this often
+JWKS_MIN_REFRESH = float(os.getenv("JWKS_MIN_REFRESH", "30"))
+JWKS_TIMEOUT = float(os.getenv("JWKS_TIMEOUT", "5"))
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+# The secret auth-service signs access tokens with, shared with sysbio, which forwards them
+JWT_SECRET = os.getenv("JWT_SECRET", os.getenv("SECRET_KEY"))
+ALGORITHM = "HS256"
+
+# The tier each GA4GH visa type entitles its holder to
+VISA_TIERS = {
+    "ControlledAccessGrants": "controlled",
+    "AcceptedTermsAndPolicies": "registered",
+    "ResearcherStatus": "registered",
+    "AffiliationAndRole": "registered",
+}
+
+def fetch_json(url: str) -> dict:
+    response = httpx.get(url, timeout=JWKS_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+class JWKSCache:
+    """auth-service's public keys, fetched once per TTL and early when a visa names a new key id."""
+
+    def __init__(self, url: str, fetch: Callable[[str], dict] = fetch_json, ttl: float = JWKS_TTL,
+                 min_refresh: float = JWKS_MIN_REFRESH):
+        self.url = url
+        self.fetch = fetch
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self._keys: Optional[dict] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.failures = 0
+
+    def keys(self, kid: Optional[str] = None) -> dict:
+        now = time.monotonic()
+        keys, age = self._keys, now - self._fetched_at
+        if keys is not None and age < self.ttl and (kid is None or has_kid(keys, kid) or age < self.min_refresh):
+            return keys
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            age = time.monotonic() - self._fetched_at
+            if self._keys is not None and age < self.ttl and (kid is None or has_kid(self._keys, kid) or age < self.min_refresh):
+                return self._keys
+            try:
+                self._keys = self.fetch(self.url)
+            except Exception:
+                self.failures += 1
+                if self._keys is None:
+                    raise
+                # Keep verifying with the keys we have until auth-service is reachable again
+            else:
+                self.fetches += 1
+            self._fetched_at = time.monotonic()
+            return self._keys
+
+    def stats(self) -> dict:
+        return {"fetches": self.fetches, "failures": self.failures}
+
+def has_kid(keys: dict, kid: str) -> bool:
+    return any(key.get("kid") == kid for key in keys.get("keys", []))
+
+class EntitlementCache:
+    """Tier granted by each verified visa, keyed by a digest of the visa and kept until it expires.
+
+    A visa is verified once; later requests carrying it cost a hash and a dict lookup. It only
+    counts for the subject it was issued to.
+    """
+
+    def __init__(self, jwks: JWKSCache, issuer: Optional[str] = AUTH_ISSUER, max_entries: int = ENTITLEMENT_CACHE_SIZE):
+        self.jwks = jwks
+        self.issuer = issuer
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def visa_tier(self, visa: str, sub: str) -> Optional[str]:
+        digest = hashlib.sha256(visa.encode("utf-8")).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                tier, visa_sub, expires_at = entry
+                if now < expires_at:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return tier if visa_sub == sub else None
+                del self._entries[digest]
+            self.misses += 1
+
+        try:
+            kid = jwt.get_unverified_header(visa).get("kid")
+        except JOSEError:
+            with self._lock:
+                self.rejected += 1
+            return None
+        try:
+            keys = self.jwks.keys(kid)
+        except Exception:
+            # auth-service has not been reachable since startup (counted in jwks_failures); the
+            # caller gets the public tier rather than an error
+            return None
+        try:
+            claims = jwt.decode(visa, keys, algorithms=["RS256"], issuer=self.issuer, options={"verify_aud": False})
+        except JOSEError:
+            with self._lock:
+                self.rejected += 1
+            return None
+        tier = VISA_TIERS.get((claims.get("ga4gh_visa_v1") or {}).get("type"))
+        # Visas without an expiry are not cached, so they are checked again every time
+        if isinstance(claims.get("exp"), (int, float)):
+            with self._lock:
+                self._entries[digest] = (tier, claims.get("sub"), claims["exp"])
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if claims.get("sub") != sub:
+            with self._lock:
+                self.rejected += 1
+            return None
+        return tier
+
+    def tier(self, passport: Optional[str], sub: str) -> str:
+        """Highest tier any valid visa in the X-GA4GH-Passport header grants to sub."""
+        best = DEFAULT_TIER
+        for visa in re.split(r"[,\s]+", passport or ""):
+            if not visa:
+                continue
+            tier = self.visa_tier(visa, sub)
+            if tier is not None and TIER_ORDER.index(tier) > TIER_ORDER.index(best):
+                best = tier
+        return best
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            **{f"jwks_{key}": value for key, value in self.jwks.stats().items()},
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+entitlements = EntitlementCache(JWKSCache(AUTH_JWKS_URL)) if AUTH_JWKS_URL else None
+
+def bearer_subject(authorization: Optional[str]) -> Optional[str]:
+    """Subject of a valid auth-service access token in an Authorization header, or None."""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token or JWT_SECRET is None:
+        return None
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM]).get("sub")
+    except JOSEError:
+        return None
+
+def entitled_tier(authorization: Optional[str], passport: Optional[str]) -> str:
+    if entitlements is None:
+        return TIER_ORDER[-1] if authorization else DEFAULT_TIER
+    sub = bearer_subject(authorization)
+    if sub is None:
+        return DEFAULT_TIER
+    return entitlements.tier(passport, sub)
@@ -0,0 +1,130 @@
+import json
+import os
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import inspect, text
+from app.utils.query_guard import SCAN_DETAIL, table_aliases
+
+# Secondary indexes built by init_db.py after loading, as name -> (table, columns).
+# Point INDEX_CONFIG at a JSON file of the same shape, e.g. {"ix_person_race": ["person", ["race"]]},
+# to build a different set. Composite indexes lead with the column most filters use.
+DEFAULT_INDEXES = {
+    "ix_person_diagnosis_name_gender": ("person", ("diagnosis_name", "gender")),
+    "ix_person_gender": ("person", ("gender",)),
+    "ix_person_race": ("person", ("race",)),
+    "ix_person_year_of_birth": ("person", ("year_of_birth",)),
+    "ix_synthetic_dataset_dataset_status": ("synthetic_dataset", ("dataset", "status")),
+    "ix_synthetic_dataset_status": ("synthetic_dataset", ("status",)),
+    "ix_synthetic_files_filename": ("synthetic_files", ("filename",)),
+}
+
+INDEX_CONFIG = os.getenv("INDEX_CONFIG")
+
+IndexSpec = Tuple[str, Tuple[str, ...]]
+
+def load_index_config(path: str = INDEX_CONFIG) -> Dict[str, IndexSpec]:
+    if not path:
+        return dict(DEFAULT_INDEXES)
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    return {name: (table, tuple(columns)) for name, (table, columns) in raw.items()}
+
+def index_name(table: str, columns: Iterable[str]) -> str:
+    return "ix_" + "_".join([table, *columns]).lower()
+
+def create_index(conn, name: str, table: str, columns: Iterable[str]):
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_list})'))
+
+def build_indexes(engine, indexes: Dict[str, IndexSpec] = None) -> List[str]:
+    """Create the configured indexes on tables that exist, then refresh the planner statistics."""
+    indexes = load_index_config() if indexes is None else indexes
+    tables = set(inspect(engine).get_table_names())
+    created = []
+    with engine.begin() as conn:
+        for name, (table, columns) in indexes.items():
+            if table not in tables:
+                continue
+            create_index(conn, name, table, columns)
+            created.append(name)
+        conn.execute(text("ANALYZE"))
+    return created
+
+def existing_index_columns(conn) -> Dict[str, List[Tuple[str, ...]]]:
+    """Leading-column tuples of every index, primary keys included, per table."""
+    result = defaultdict(list)
+    for table in inspect(conn).get_table_names():
+        for index in inspect(conn).get_indexes(table):
+            result[table].append(tuple(index["column_names"]))
+        pk = inspect(conn).get_pk_constraint(table).get("constrained_columns") or []
+        if pk:
+            result[table].append(tuple(pk))
+    return result
+
+_COMPARISON = r'(?:\w+\.)?"?{column}"?\s*(=|==|IN\b|IS\b|<=|>=|<|>|BETWEEN\b|LIKE\b)'
+
+def filtered_columns(query: str, columns: Iterable[str]) -> List[str]:
+    """Columns the WHERE clause compares, equality filters first since they lead a composite index."""
+    match = re.search(r'\bwhere\b(.*?)(?:\border\s+by\b|\bgroup\s+by\b|\blimit\b|$)', query, re.IGNORECASE | re.DOTALL)
+    if not match:
+        return []
+    where = match.group(1)
+    equality, ranges = [], []
+    for column in columns:
+        found = re.search(_COMPARISON.format(column=re.escape(column)), where, re.IGNORECASE)
+        if not found:
+            continue
+        operator = found.group(1).upper()
+        (equality if operator in ("=", "==", "IN", "IS") else ranges).append(column)
+    return equality + ranges[:1]
+
+def bind_nulls(query: str) -> dict:
+    return {name: None for name in text(query).compile().params}
+
+def recommend_indexes(conn, entries: Iterable[dict], limit: int = 10) -> List[dict]:
+    """Rank index candidates from query log entries by how often, and how slowly, their scans ran.
+
+    Each distinct query is planned once with EXPLAIN QUERY PLAN. A full scan of a table whose
+    WHERE clause filters on columns no existing index leads with becomes a candidate.
+    """
+    by_query = defaultdict(lambda: {"count": 0, "ms": 0.0})
+    for entry in entries:
+        query = " ".join(str(entry.get("query", "")).split()).rstrip(";")
+        if not query:
+            continue
+        by_query[query]["count"] += 1
+        by_query[query]["ms"] += float(entry.get("ms") or 0)
+
+    existing = existing_index_columns(conn)
+    table_columns = {table: [c["name"] for c in inspect(conn).get_columns(table)] for table in inspect(conn).get_table_names()}
+    candidates = {}
+    for query, stats in by_query.items():
+        try:
+            plan = conn.execute(text(f"EXPLAIN QUERY PLAN {query}"), bind_nulls(query)).fetchall()
+        except Exception:
+            continue
+        aliases = table_aliases(query)
+        for _, _, _, detail in plan:
+            match = SCAN_DETAIL.match(detail)
+            table = aliases.get(match.group(1).lower()) if match else None
+            if table not in table_columns:
+                continue
+            columns = tuple(filtered_columns(query, table_columns[table]))
+            if not columns or any(index[:len(columns)] == columns for index in existing[table]):
+                continue
+            candidate = candidates.setdefault((table, columns), {
+                "name": index_name(table, columns),
+                "table": table,
+                "columns": list(columns),
+                "queries": 0,
+                "scans": 0,
+                "total_ms": 0.0,
+                "example": query,
+            })
+            candidate["queries"] += 1
+            candidate["scans"] += stats["count"]
+            candidate["total_ms"] += stats["ms"]
+
+    ranked = sorted(candidates.values(), key=lambda c: (c["total_ms"], c["scans"]), reverse=True)
+    return ranked[:limit]
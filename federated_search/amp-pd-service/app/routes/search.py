@@ -1,43 +1,203 @@
+from app.access_policy import ACCESS_TIERS, projections, resolve_tier
+from app.entitlements import entitled_tier
+from app.utils.arrow import ARROW_MEDIA_TYPE, arrow_available, result_to_table, split_table_page, table_to_ipc, wants_arrow
+from app.utils.data_model import result_model
 from app.utils.error_utils import error_response
-from fastapi import APIRouter, Depends, Header
+from app.utils.metrics import ROWS_RETURNED, SQL_SECONDS
+from app.utils.ndjson import NDJSON_MEDIA_TYPE, encode_line, wants_ndjson
+from app.utils.pagination import PagePlan, decode_token, encode_token, is_paginatable, plan_page, split_page
+from app.utils.query_guard import QueryBudgetExceeded, QueryGuard, QueryRejected, check_plan, is_interrupt
+from app.utils.query_log import query_log
+from app.utils.timing import Timings, TraceContext, json_response, timings_block
+from fastapi import APIRouter, Depends, Header, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from app.database import data_version
 from app.dependencies import get_db
 from app.schemas import SearchRequest
 from typing import Optional
+import os
+import time
 
 router = APIRouter()
 
+SOURCE_LABEL = "AMP PDRD"
+
+# Rows pulled from the cursor per fetchmany() call
+FETCH_BATCH_SIZE = int(os.getenv("FETCH_BATCH_SIZE", "500"))
+
+# Most rows one response may carry. Page sizes are clamped to it, and a query read without
+# pagination stops there and is flagged as truncated.
+MAX_RESULT_ROWS = int(os.getenv("MAX_RESULT_ROWS", "10000"))
+
+def result_columns(result):
+    # Columns of a labelled row: the query's own, then the source label unless the query already has one
+    columns = list(result.keys())
+    return columns if "source" in columns else columns + ["source"]
+
+def label_row(row):
+    # Restricted columns are already left out of the SELECT by the access policy
+    row_dict = dict(row._mapping)
+    row_dict["source"] = SOURCE_LABEL
+    return row_dict
+
+def build_pagination(plan: Optional[PagePlan], next_position: Optional[dict]):
+    pagination = {"next_page_url": None}
+    if plan is not None:
+        pagination["next_page_token"] = encode_token(next_position) if next_position else None
+    return pagination
+
+def record_query(query: str, started: float, rows: int):
+    elapsed = time.perf_counter() - started
+    query_log.record(query, elapsed, rows)
+    SQL_SECONDS.observe(elapsed)
+    ROWS_RETURNED.observe(rows)
+
+def fetch_rows(result, max_rows: int):
+    """Read at most max_rows rows in FETCH_BATCH_SIZE batches; returns (rows, whether rows were left unread)."""
+    rows = []
+    try:
+        while len(rows) <= max_rows:
+            batch = result.fetchmany(min(FETCH_BATCH_SIZE, max_rows + 1 - len(rows)))
+            if not batch:
+                break
+            rows.extend(batch)
+    finally:
+        result.close()
+    return rows[:max_rows], len(rows) > max_rows
+
+def stream_rows(session: Session, result, restricted_fields: dict, plan: Optional[PagePlan], guard: QueryGuard,
+                query: str, started: float):
+    limit = plan.limit if plan is not None else MAX_RESULT_ROWS
+    try:
+        rows = result.fetchmany(FETCH_BATCH_SIZE)
+        data_model = result_model(session, query, result_columns(result), (row._mapping for row in rows))
+        yield encode_line({"data_model": data_model, "restricted_fields": restricted_fields})
+        sent, last_row, has_more = 0, None, False
+        while rows and not has_more:
+            for row in rows:
+                if sent == limit:
+                    has_more = True
+                    break
+                yield encode_line({"data": label_row(row)})
+                sent, last_row = sent + 1, row
+            if not has_more:
+                rows = result.fetchmany(FETCH_BATCH_SIZE)
+        next_position = plan.next_position(last_row, has_more) if plan is not None else None
+        yield encode_line({
+            "pagination": build_pagination(plan, next_position),
+            "truncated": plan is None and has_more,
+        })
+        record_query(query, started, sent)
+    except OperationalError as e:
+        if not is_interrupt(e):
+            raise
+        # Headers are already sent, so the budget error travels in the stream instead of a status code
+        yield encode_line({"errors": [{"title": "Query budget exceeded", "detail": str(guard.error())}]})
+    finally:
+        guard.stop()
+        result.close()
+        session.close()
+
 @router.post("/search", response_model=dict)
-def run_query(request: SearchRequest, db: Session = Depends(get_db), authorization: Optional[str] = Header(None)):
-    access_tier = "public"
-    if isinstance(request.parameters, dict):
-        access_tier = request.parameters.get("access_tier", "public")
-
-    if access_tier in ["registered", "controlled"] and not authorization:
-        access_tier = "public"
-
-    # Define fields restricted by access tier
-    restricted_fields = {}
-    if access_tier == "public":
-        restricted_fields = {
-            "gender": "registered access only",
-            "race": "registered access only",
-            "ethnicity": "registered access only",
-            "year_of_birth": "controlled access only"
-        }
-    elif access_tier == "registered":
-        restricted_fields = {
-            "year_of_birth": "controlled access only"
-        }
-    elif access_tier != "controlled":
+def run_query(request: SearchRequest, db: Session = Depends(get_db), authorization: Optional[str] = Header(None), accept: Optional[str] = Header(None), traceparent: Optional[str] = Header(None), x_ga4gh_passport: Optional[str] = Header(None)):
+    # Phases are reported to sysbio in Server-Timing, under the span sysbio passed in traceparent
+    timings = Timings()
+    trace = TraceContext.from_header(traceparent)
+    # Lets sysbio drop cached results from this service after its database is reloaded
+    version = data_version()
+    version_headers = {"X-Data-Version": version} if version else {}
+
+    requested_tier = request.parameters.get("access_tier") if isinstance(request.parameters, dict) else None
+    # Visas are verified locally against auth-service's cached JWKS; see app.entitlements
+    access_tier = resolve_tier(requested_tier, entitled_tier(authorization, x_ga4gh_passport))
+    if access_tier not in ACCESS_TIERS:
         return error_response(400, title="Bad Request", detail="Invalid access_tier specified.")
+    restricted_fields = ACCESS_TIERS[access_tier]
 
+    position = None
+    limit = min(request.limit, MAX_RESULT_ROWS) if request.limit is not None else None
+    if limit is not None and is_paginatable(request.query):
+        if not isinstance(request.parameters, (dict, type(None))):
+            return error_response(400, title="Bad Request", detail="Only named parameters are supported for pagination.")
+        try:
+            # A fresh page starting at the top can use keyset; an explicit offset cannot
+            position = decode_token(request.page_token) if request.page_token else (
+                {"o": request.offset} if request.offset else {}
+            )
+        except ValueError as e:
+            return error_response(400, title="Invalid page token", detail=str(e))
+
+    arrow = wants_arrow(accept)
+    if arrow and not arrow_available():
+        return error_response(406, title="Not Acceptable", detail="Arrow responses are not available on this service.")
+    timings.lap("parse")
+
+    # A streamed response outlives this handler's session, so it reads through its own
+    streaming = wants_ndjson(accept) and not arrow
+    session = Session(bind=db.get_bind()) if streaming else db
+    streamed = False
+    plan = None
+    started = time.perf_counter()
     try:
-        stmt = text(request.query)
-        result = db.execute(stmt, request.parameters or [])
-        rows = result.fetchall()
+        with QueryGuard(session) as guard:
+            query = projections.project(session, request.query.strip().rstrip(';'), request.parameters or {}, access_tier)
+            check_plan(session, query, request.parameters or {})
+            if position is not None:
+                plan = plan_page(session, query, request.parameters or {}, limit, position, keyset_query=request.query)
+            timings.lap("plan")
+            if plan is not None:
+                result = session.execute(text(plan.sql), plan.params)
+            else:
+                stmt = text(query)
+                result = session.execute(stmt, request.parameters or [])
+            if streaming:
+                streamed = True
+                # Rows are read after this handler returns; the stream keeps the budget running
+                guard.detach()
+                return StreamingResponse(
+                    stream_rows(session, result, restricted_fields, plan, guard, request.query, started),
+                    media_type=NDJSON_MEDIA_TYPE,
+                    headers={**version_headers, "Server-Timing": timings.header()},
+                )
+            # One row past the page (or the cap) tells us whether anything was left behind
+            max_rows = plan.limit if plan is not None else MAX_RESULT_ROWS
+            if arrow:
+                table = result_to_table(result, drop=("source",), source=SOURCE_LABEL, max_rows=max_rows + 1)
+                result.close()
+                truncated, next_position = False, None
+                if plan is not None:
+                    table, next_position = split_table_page(plan, table)
+                else:
+                    truncated = table.num_rows > max_rows
+                    table = table.slice(0, max_rows)
+                record_query(request.query, started, table.num_rows)
+                timings.lap("sql")
+                metadata = {
+                    "restricted_fields": restricted_fields,
+                    "pagination": build_pagination(plan, next_position),
+                    "truncated": truncated,
+                }
+                if request.timings:
+                    metadata["timings"] = timings_block(timings, trace)
+                body = table_to_ipc(table, metadata)
+                timings.lap("serialize")
+                return Response(
+                    content=body,
+                    media_type=ARROW_MEDIA_TYPE,
+                    headers={**version_headers, "Server-Timing": timings.header()},
+                )
+            columns = result_columns(result)
+            rows, truncated = fetch_rows(result, max_rows + 1 if plan is not None else max_rows)
+            next_position = None
+            if plan is not None:
+                rows, next_position = split_page(plan, rows)
+            record_query(request.query, started, len(rows))
+            timings.lap("sql")
+            # Typed from the schema, so every page, empty or not, carries the same model
+            data_model = result_model(session, request.query, columns, (row._mapping for row in rows))
     except OperationalError as e:
         if "no such column" in str(e.orig):
             return error_response(
@@ -50,43 +210,23 @@ def run_query(request: SearchRequest, db: Session = Depends(get_db), authorizati
             title="Operational Error",
             detail=f"SQL error: {e.orig}"
         )
+    except QueryBudgetExceeded as e:
+        return error_response(400, title="Query budget exceeded", detail=str(e))
+    except QueryRejected as e:
+        return error_response(400, title="Query rejected", detail=str(e))
     except Exception as e:
         return error_response(400, title="Invalid SQL", detail=f"Invalid SQL: {e}")
+    finally:
+        if session is not db and not streamed:
+            session.close()
+
+    data = [label_row(row) for row in rows]
+    timings.lap("build")
 
-    # Remove restricted fields from the data rows
-    data = []
-    for row in rows:
-        row_dict = dict(row._mapping)
-        for field in restricted_fields:
-            row_dict.pop(field, None)
-        row_dict["source"] = "AMP PDRD"
-        data.append(row_dict)
-
-    # Build data_model from filtered data
-    def infer_type(value):
-        if isinstance(value, int):
-            return "integer"
-        elif isinstance(value, float):
-            return "number"
-        elif isinstance(value, bool):
-            return "boolean"
-        return "string"
-
-    if data:
-        first_row = data[0]
-        data_model = {
-            "type": "object",
-            "properties": {
-                key: {"type": infer_type(value)} for key, value in first_row.items()
-            },
-            "required": list(first_row.keys())
-        }
-    else:
-        data_model = {"type": "object", "properties": {}}
-
-    return {
+    return json_response({
         "data_model": data_model,
         "data": data,
         "restricted_fields": restricted_fields,
-        "pagination": {"next_page_url": None}
-    }
+        "pagination": build_pagination(plan, next_position),
+        "truncated": truncated,
+    }, timings, trace, request.timings, headers=version_headers)
@@ -4,3 +4,11 @@ from typing import Union, Any, Dict, List, Optional
 class SearchRequest(BaseModel):
     query: str
     parameters: Optional[Union[List[Any], Dict[str, Any]]] = None
+    # Page size, capped at MAX_RESULT_ROWS; when omitted the result is returned in one response,
+    # cut off at MAX_RESULT_ROWS rows and flagged as truncated
+    limit: Optional[int] = None
+    offset: Optional[int] = 0
+    # Opaque position returned as pagination.next_page_token by the previous page
+    page_token: Optional[str] = None
+    # Adds a "timings" block with the per-phase breakdown also sent in the Server-Timing header
+    timings: Optional[bool] = False
@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Optional
+from sqlalchemy import MetaData, text
+from app.bulk_load import LoadReport, Page, bulk_load
+from app.database import create_write_engine
+
+# Incremental syncs write to <database><STAGING_SUFFIX> and rename it over the served file when done.
+# Watermarks live next to the database rather than in it, so the served schema is unchanged.
+STAGING_SUFFIX = ".staging"
+WATERMARK_SUFFIX = ".watermarks.json"
+
+def file_watermark(path: str) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def bigquery_watermarks(client, table_ids: Iterable[str]) -> Dict[str, str]:
+    """Last-modified time of each BigQuery table, read from table metadata without running a query."""
+    return {table_id: client.get_table(table_id).modified.isoformat() for table_id in table_ids}
+
+def read_watermarks(path: str) -> dict:
+    try:
+        with open(path + WATERMARK_SUFFIX, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_watermarks(path: str, watermarks: dict):
+    tmp = path + WATERMARK_SUFFIX + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(watermarks, f, indent=2, sort_keys=True)
+    os.replace(tmp, path + WATERMARK_SUFFIX)
+
+class SyncReport:
+    def __init__(self, table: str, changed: int = 0, load: Optional[LoadReport] = None, skipped: bool = False):
+        self.table = table
+        self.changed = changed
+        self.load = load
+        self.skipped = skipped
+
+    def __str__(self):
+        if self.skipped:
+            return f"{self.table}: sources unchanged since the last sync, skipped"
+        return f"{self.table}: {self.changed:,} new or changed rows applied of {self.load}"
+
+class Snapshot:
+    """A staging copy of a served SQLite file that is brought up to date and then swapped in atomically.
+
+    The copy is taken with SQLite's online backup, so the served file can stay open. On a clean exit
+    the copy replaces the served file with a single rename: connections already open keep reading
+    the old file until they are returned to the pool, and the next checkout opens the new one
+    (see app.database.reopen_on_swap). Nothing is renamed if the sync fails.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.staging = path + STAGING_SUFFIX
+        self.watermarks = read_watermarks(path)
+        self.engine = None
+
+    def remove_staging(self):
+        # The WAL sidecars too, or the next copy would start from a stale log of this one
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.staging + suffix):
+                os.remove(self.staging + suffix)
+
+    def __enter__(self):
+        self.remove_staging()
+        source = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        target = sqlite3.connect(self.staging)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        self.engine = create_write_engine(f"sqlite:///{self.staging}")
+        return self
+
+    def sync(self, table, sources: Dict[str, str], pages: Callable[[], Iterable[Page]]) -> SyncReport:
+        """Upsert the rows from pages() that are new or differ from the staging copy.
+
+        sources maps every source the rows come from to its current watermark. When none has moved
+        since the last sync the table is skipped without reading its source.
+        """
+        previous = self.watermarks.get(table.name, {})
+        if previous and previous == sources:
+            return SyncReport(table.name, skipped=True)
+
+        incoming = table.to_metadata(MetaData(), name=f"_incoming_{table.name}")
+        incoming.create(self.engine)
+        try:
+            load = bulk_load(self.engine, incoming, pages())
+            columns = ", ".join(f'"{column.name}"' for column in table.columns)
+            with self.engine.begin() as conn:
+                # Rows identical to what the table already holds are not rewritten
+                changed = conn.execute(text(
+                    f'INSERT OR REPLACE INTO "{table.name}" ({columns}) '
+                    f'SELECT {columns} FROM "{incoming.name}" EXCEPT SELECT {columns} FROM "{table.name}"'
+                )).rowcount
+        finally:
+            incoming.drop(self.engine)
+        self.watermarks[table.name] = dict(sources)
+        return SyncReport(table.name, changed, load)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.engine.dispose()
+        if exc_type is not None:
+            self.remove_staging()
+            return False
+        # A swapped-in file must not use WAL: the -wal and -shm files are found by path, and the
+        # served file's would still belong to the copy being replaced
+        conn = sqlite3.connect(self.staging)
+        try:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            conn.close()
+        os.replace(self.staging, self.path)
+        self.watermarks["_synced_at"] = datetime.now(timezone.utc).isoformat()
+        write_watermarks(self.path, self.watermarks)
+        return False
+
+def record_watermarks(path: str, watermarks: Dict[str, Dict[str, str]]):
+    """Store the watermarks a full build loaded from, so the next incremental sync can skip unchanged sources."""
+    write_watermarks(path, {**watermarks, "_synced_at": datetime.now(timezone.utc).isoformat()})
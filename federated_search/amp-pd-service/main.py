@@ -1,6 +1,24 @@
 from fastapi import FastAPI
+from fastapi.responses import Response
+from app.access_policy import projections
+from app.database import engine, snapshot_stats
+from app.entitlements import entitlements
 from app.routes import search
+from app.utils.data_model import schema_cache
+from app.utils.metrics import CONTENT_TYPE, MetricsMiddleware, pool_stats, registry
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+
+registry.collect("projection_cache", projections.stats)
+registry.collect("schema_cache", schema_cache.stats)
+if entitlements is not None:
+    registry.collect("entitlement_cache", entitlements.stats)
+registry.collect("db_pool", lambda: pool_stats(engine))
+registry.collect("snapshot", lambda: snapshot_stats)
 
 app.include_router(search.router)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
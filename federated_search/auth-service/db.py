@@ -1,13 +1,47 @@
-from sqlalchemy import Column, String, DateTime, create_engine
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, String, DateTime, create_engine, event, inspect, text
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
 
-DATABASE_URL = "sqlite:///./state.db"
+# Point every instance at the same file (e.g. on a shared volume) to share login state between them
+DATABASE_URL = os.getenv("STATE_DATABASE_URL", "sqlite:///./state.db")
+
+# Connections held per worker process; sized to the executor that runs the DB work
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", os.getenv("DB_MAX_WORKERS", "4")))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "0"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+# Page cache per connection, in KiB
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(16 * 1024)))
+
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+)
+
+@event.listens_for(engine, "connect")
+def set_pragmas(dbapi_connection, connection_record):
+    # Unlike the search databases this one is written by every login, so it stays writable;
+    # WAL lets lookups proceed while a login is being recorded
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={-SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 Base = declarative_base()
 
+# Async routes run their SQLite work on this bounded pool so a slow write never blocks the event loop
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS", "4"))
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="db")
+
 def get_db():
     db = SessionLocal()
     try:
@@ -15,21 +49,40 @@ def get_db():
     finally:
         db.close()
 
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+# Both tables are looked up by their primary key only; expires_at is indexed for the expiry sweep
 class OAuthState(Base):
     __tablename__ = "oauth_state"
 
-    state = Column(String, primary_key=True, index=True)
+    state = Column(String, primary_key=True)
     redirect_uri = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
 
 class IssuedToken(Base):
     __tablename__ = "issued_token"
 
-    state = Column(String, primary_key=True, index=True)
+    state = Column(String, primary_key=True)
     access_token = Column(String, index=True)
     user_sub = Column(String, index=True)
     user_email = Column(String)
     issued_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
+
+def ensure_schema():
+    """Create the tables, and bring a state.db from before expiry tracking up to date."""
+    Base.metadata.create_all(bind=engine)
+    columns = {column["name"] for column in inspect(engine).get_columns("oauth_state")}
+    with engine.begin() as conn:
+        if "expires_at" not in columns:
+            conn.execute(text("ALTER TABLE oauth_state ADD COLUMN expires_at DATETIME"))
+            # Pending logins from before the upgrade have no expiry; they are only minutes old at most
+            conn.execute(text("DELETE FROM oauth_state"))
+    for table in (OAuthState.__table__, IssuedToken.__table__):
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
-Base.metadata.create_all(bind=engine)
+ensure_schema()
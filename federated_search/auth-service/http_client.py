@@ -0,0 +1,67 @@
+import os
+import httpx
+from typing import Optional
+
+# One pooled client for every call to the identity provider, shared by every request in the process
+OUTBOUND_MAX_CONNECTIONS = int(os.getenv("OUTBOUND_MAX_CONNECTIONS", "50"))
+OUTBOUND_MAX_KEEPALIVE = int(os.getenv("OUTBOUND_MAX_KEEPALIVE", "20"))
+OUTBOUND_KEEPALIVE_EXPIRY = float(os.getenv("OUTBOUND_KEEPALIVE_EXPIRY", "30"))
+OUTBOUND_TIMEOUT = float(os.getenv("OUTBOUND_TIMEOUT", "10"))
+
+class OutboundClient:
+    """Lazily created, process-wide httpx client; transport can be swapped for a local stub in tests."""
+
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+
+    def use_transport(self, transport: Optional[httpx.AsyncBaseTransport]):
+        """Send every later request through transport, e.g. httpx.ASGITransport(app=stub_idp.app)."""
+        self.transport = transport
+        self._client = None
+
+    def get(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = self._build()
+        return self._client
+
+    def _build(self) -> httpx.AsyncClient:
+        async def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                self.connections_opened += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+
+        async def on_request(request: httpx.Request):
+            self.requests += 1
+            request.extensions["trace"] = trace
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OUTBOUND_MAX_CONNECTIONS,
+                max_keepalive_connections=OUTBOUND_MAX_KEEPALIVE,
+                keepalive_expiry=OUTBOUND_KEEPALIVE_EXPIRY,
+            ),
+            timeout=OUTBOUND_TIMEOUT,
+            transport=self.transport,
+            event_hooks={"request": [on_request]},
+        )
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "tls_handshakes": self.tls_handshakes,
+            "connections_reused": max(self.requests - self.connections_opened, 0),
+            "max_connections": OUTBOUND_MAX_CONNECTIONS,
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+outbound = OutboundClient()
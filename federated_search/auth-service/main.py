@@ -1,20 +1,26 @@
+import asyncio
 import os
-import httpx
-from db import OAuthState, IssuedToken, get_db
+import time
+from contextlib import asynccontextmanager
+from db import engine, run_db
+from http_client import outbound
+from metrics import CONTENT_TYPE, MetricsMiddleware, pool_stats, registry
+from oidc import OIDC_DISCOVERY_URL, discovery
+from signing import SigningKey, VisaCache
+from state_store import state_store, sweep_expired
+from token_cache import token_cache
 from fastapi import FastAPI, Request, Query, HTTPException, Form, Depends, status
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
-from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, Response
 from authlib.integrations.starlette_client import OAuth
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
 from starlette.config import Config
 from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
-import uuid
 
 load_dotenv()
 
@@ -24,8 +30,16 @@ if JWT_SECRET is None:
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", "300"))
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sweeper = asyncio.create_task(sweep_expired())
+    yield
+    sweeper.cancel()
+    await outbound.aclose()
+
+app = FastAPI(lifespan=lifespan)
 SECRET_KEY = os.getenv("SECRET_KEY")
 if SECRET_KEY is None:
     raise ValueError("SECRET_KEY must be set in the environment")
@@ -41,6 +55,13 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+registry.collect("token_cache", token_cache.stats)
+registry.collect("state_store", state_store.stats)
+registry.collect("outbound_http", outbound.stats)
+registry.collect("oidc_discovery", discovery.stats)
+registry.collect("db_pool", lambda: pool_stats(engine))
 
 config = Config('.env')
 oauth = OAuth(config)
@@ -48,18 +69,26 @@ oauth.register(
     name='google',
     client_id=config('GOOGLE_CLIENT_ID'),
     client_secret=config('GOOGLE_CLIENT_SECRET'),
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+    server_metadata_url=OIDC_DISCOVERY_URL,
     client_kwargs={'scope': 'openid email profile'},
 )
 
 def get_current_user(token: str = Depends(oauth2_scheme)):
     assert JWT_SECRET is not None
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+        payload = token_cache.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
     return payload
 
+@app.get("/stats/token-cache")
+def token_cache_stats():
+    return token_cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
 @app.get("/")
 def home(request: Request):
     user = request.session.get('user')
@@ -69,18 +98,13 @@ def home(request: Request):
 
 
 @app.get("/login")
-def login(
+async def login(
     redirect_uri: str = Query(description="Client redirect URI"),
     state: str = Query(),
-    db: Session = Depends(get_db)
 ):
-    existing = db.query(OAuthState).filter_by(state=state).first()
-    if existing:
+    if not await run_db(state_store.put_state, state, redirect_uri):
         raise HTTPException(status_code=400, detail=f"State {state} already exists - use a different state.")
 
-    db.add(OAuthState(state=state, redirect_uri=redirect_uri))
-    db.commit()
-
     params = {
         "response_type": "code",
         "client_id": config("GOOGLE_CLIENT_ID"),
@@ -89,35 +113,47 @@ def login(
         "prompt": "consent",
         "state": state
     }
-    url = f"https://accounts.google.com/o/oauth2/v2/auth?{urlencode(params)}"
+    url = f"{await discovery.endpoint('authorization_endpoint')}?{urlencode(params)}"
     return RedirectResponse(url)
 
+async def login_user(client, tokens: dict) -> dict:
+    # The ID token already carries sub, email and name; verifying it against the cached provider
+    # keys saves the userinfo round trip. Providers that send no ID token are asked via userinfo.
+    if tokens.get("id_token"):
+        try:
+            return await discovery.verify_id_token(
+                tokens["id_token"], config('GOOGLE_CLIENT_ID'), access_token=tokens.get("access_token")
+            )
+        except JWTError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid ID token: {e}")
+    userinfo_res = await client.get(
+        await discovery.endpoint("userinfo_endpoint"),
+        headers={"Authorization": f"Bearer {tokens['access_token']}"}
+    )
+    return userinfo_res.json()
+
 @app.get("/callback")
-async def callback(request: Request, code: str, state: str, db: Session = Depends(get_db)):
-    state_entry = db.query(OAuthState).filter_by(state=state).first()
-    if not state_entry:
+async def callback(request: Request, code: str, state: str):
+    redirect_uri = await run_db(state_store.pop_state, state)
+    if redirect_uri is None:
         raise HTTPException(400, "Invalid or expired state")
-    redirect_uri = state_entry.redirect_uri
-    db.delete(state_entry)
-    db.commit()
-    async with httpx.AsyncClient() as client:
-        token_res = await client.post(
-            "https://oauth2.googleapis.com/token",
-            data={
-                "code": code,
-                "client_id": config('GOOGLE_CLIENT_ID'),
-                "client_secret": config('GOOGLE_CLIENT_SECRET'),
-                "redirect_uri": config('REDIRECT_URI'),
-                "grant_type": "authorization_code"
-            }
-        )
-        tokens = token_res.json()
-        userinfo_res = await client.get(
-            "https://openidconnect.googleapis.com/v1/userinfo",
-            headers={"Authorization": f"Bearer {tokens['access_token']}"}
-        )
-    user = userinfo_res.json()
-    expire_time = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    client = outbound.get()
+    token_res = await client.post(
+        await discovery.endpoint("token_endpoint"),
+        data={
+            "code": code,
+            "client_id": config('GOOGLE_CLIENT_ID'),
+            "client_secret": config('GOOGLE_CLIENT_SECRET'),
+            "redirect_uri": config('REDIRECT_URI'),
+            "grant_type": "authorization_code"
+        }
+    )
+    if token_res.status_code != 200:
+        raise HTTPException(status_code=400, detail=f"Token exchange failed: {token_res.text}")
+    tokens = token_res.json()
+    user = await login_user(client, tokens)
+    expires_in = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire_time = datetime.utcnow() + expires_in
     to_encode = {
         "sub": user["sub"],
         "email": user["email"],
@@ -126,15 +162,12 @@ async def callback(request: Request, code: str, state: str, db: Session = Depend
     }
     assert JWT_SECRET is not None
     access_token = jwt.encode(to_encode, JWT_SECRET, ALGORITHM)
-    db.add(IssuedToken(
-        state=state,
-        access_token=access_token,
-        user_sub=user["sub"],
-        user_email=user["email"],
-        issued_at=datetime.utcnow(),
-        expires_at=expire_time
-    ))
-    db.commit()
+    # /session reads the token back by state, possibly on another instance sharing the store
+    await run_db(state_store.put_token, state, {
+        "access_token": access_token,
+        "user_sub": user["sub"],
+        "user_email": user["email"],
+    }, time.time() + expires_in.total_seconds())
     params = {
         "state": state,
         "code": code
@@ -150,15 +183,15 @@ def show_passport(request: Request):
     return {"message": "Authenticated user", "user": user}
 
 @app.get("/session")
-def session_info(state: str, db: Session = Depends(get_db)):
-    token = db.query(IssuedToken).filter_by(state=state).first()
+def session_info(state: str):
+    token = state_store.get_token(state)
     if token:
         user = {
-            "email": token.user_email,
-            "sub": token.user_sub 
+            "email": token["user_email"],
+            "sub": token["user_sub"]
         }
         return {
-            "access_token": token.access_token,
+            "access_token": token["access_token"],
             "token_type": "bearer",
             "user": user,
         }
@@ -193,8 +226,7 @@ async def exchange_token(
     if code_verifier:
         payload["code_verifier"] = code_verifier
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post("https://oauth2.googleapis.com/token", data=payload)
+    resp = await outbound.get().post(await discovery.endpoint("token_endpoint"), data=payload)
 
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
@@ -202,41 +234,33 @@ async def exchange_token(
     return resp.json()
 
 
-def load_private_key():
-    with open(config('PRIVATE_KEY_PATH'), "r") as f:
-        return f.read()
+# Parsed once and re-read when the key file is rotated; RS256 signing is the costliest work here,
+# so each subject's visa is also reused for part of its lifetime
+signing_key = SigningKey(lambda: config('PRIVATE_KEY_PATH'))
+visa_cache = VisaCache(signing_key)
+registry.collect("visa_cache", visa_cache.stats)
 
 
-@app.get("/userinfo")
-def userinfo(request: Request, user=Depends(get_current_user)):
-    now = int(datetime.utcnow().timestamp())
-    exp = now + 12 * 3600
+@app.get("/.well-known/jwks.json")
+def jwks(response: Response):
+    # Verifiers cache this, and fetch it again when a visa names a kid they have not seen
+    response.headers["Cache-Control"] = f"public, max-age={JWKS_MAX_AGE}"
+    return signing_key.jwks()
 
-    # Create a dummy visa (normally you’d do this per DAC access or external system)
-    visa_claim = {
-        "iss": config('ISSUER'),
-        "sub": user["sub"],
-        "iat": now,
-        "exp": exp,
-        "jti": str(uuid.uuid4()),
-        "ga4gh_visa_v1": {
-            "type": "ControlledAccessGrants",
-            "asserted": now,
-            "value": "phs000123.v1.p1.c1",
-            "source": config('ISSUER'),
-            "by": "dac"
-        }
-    }
 
-    visa_jwt = jwt.encode(visa_claim, load_private_key(), algorithm="RS256")
+@app.get("/userinfo")
+def userinfo(request: Request, user=Depends(get_current_user)):
+    visa_jwt = visa_cache.get(user["sub"], config('ISSUER'))
+    # The visa may have been signed earlier and reused, so report its own lifetime
+    visa_claims = jwt.get_unverified_claims(visa_jwt)
 
     return {
         "sub": user["sub"],
         "name": user["name"],
         "email": user["email"],
         "iss": config('ISSUER'),
-        "iat": now,
-        "exp": exp,
+        "iat": visa_claims["iat"],
+        "exp": visa_claims["exp"],
         "scope": "openid ga4gh_passport_v1",
         "ga4gh_passport_v1": [visa_jwt]
     }
\ No newline at end of file
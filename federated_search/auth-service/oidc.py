@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from typing import Optional
+from jose import jwt
+from http_client import OutboundClient, outbound
+
+OIDC_DISCOVERY_URL = os.getenv("OIDC_DISCOVERY_URL", "https://accounts.google.com/.well-known/openid-configuration")
+# Seconds the discovery document and the provider's signing keys are trusted before being fetched again
+OIDC_METADATA_TTL = float(os.getenv("OIDC_METADATA_TTL", "3600"))
+OIDC_JWKS_TTL = float(os.getenv("OIDC_JWKS_TTL", "3600"))
+# A token signed with an unknown key triggers a JWKS refresh at most this often
+OIDC_JWKS_MIN_REFRESH = float(os.getenv("OIDC_JWKS_MIN_REFRESH", "60"))
+# Accepted id_token signatures; fixed here rather than taken from what discovery advertises
+ID_TOKEN_ALGORITHMS = ["RS256"]
+
+class DiscoveryCache:
+    """The provider's discovery document and JWKS, each fetched at most once per TTL.
+
+    Callers that arrive while a fetch is in flight wait for it instead of starting their own,
+    so a burst of logins fetches once. If a refresh fails the previous copy keeps being served.
+    """
+
+    def __init__(self, discovery_url: str = OIDC_DISCOVERY_URL, client: OutboundClient = outbound,
+                 metadata_ttl: float = OIDC_METADATA_TTL, jwks_ttl: float = OIDC_JWKS_TTL):
+        self.discovery_url = discovery_url
+        self.client = client
+        self.ttls = {"metadata": metadata_ttl, "jwks": jwks_ttl}
+        # name -> (document, fetched at)
+        self._documents = {}
+        # name -> (lock, the event loop it was created on)
+        self._locks = {}
+        self.hits = 0
+        self.fetches = 0
+        self.failures = 0
+
+    async def _get(self, name: str, url_fn, force: bool = False) -> dict:
+        cached = self._documents.get(name)
+        if cached is not None and not force and time.monotonic() - cached[1] < self.ttls[name]:
+            self.hits += 1
+            return cached[0]
+        async with self._lock(name):
+            latest = self._documents.get(name)
+            # Someone else refreshed it while we waited
+            if latest is not None and latest is not cached and time.monotonic() - latest[1] < self.ttls[name]:
+                self.hits += 1
+                return latest[0]
+            try:
+                response = await self.client.get().get(await url_fn())
+                response.raise_for_status()
+                document = response.json()
+            except Exception:
+                self.failures += 1
+                if latest is None:
+                    raise
+                return latest[0]
+            self.fetches += 1
+            self._documents[name] = (document, time.monotonic())
+            return document
+
+    def _lock(self, name: str) -> asyncio.Lock:
+        # Created on first use in each event loop: this cache is built at import time, before any loop
+        # runs, and an asyncio.Lock only works in the loop it was first used in
+        loop = asyncio.get_running_loop()
+        lock, lock_loop = self._locks.get(name, (None, None))
+        if lock_loop is not loop:
+            lock = asyncio.Lock()
+            self._locks[name] = (lock, loop)
+        return lock
+
+    async def metadata(self) -> dict:
+        async def url():
+            return self.discovery_url
+        return await self._get("metadata", url)
+
+    async def endpoint(self, name: str) -> str:
+        return (await self.metadata())[name]
+
+    async def jwks(self, kid: Optional[str] = None) -> dict:
+        """The provider's signing keys, refreshed early when a token names a key we do not have yet."""
+        async def url():
+            return await self.endpoint("jwks_uri")
+        keys = await self._get("jwks", url)
+        if kid is not None and not any(key.get("kid") == kid for key in keys.get("keys", [])):
+            # The provider may have rotated keys since we fetched them
+            if time.monotonic() - self._documents["jwks"][1] >= OIDC_JWKS_MIN_REFRESH:
+                keys = await self._get("jwks", url, force=True)
+        return keys
+
+    async def verify_id_token(self, id_token: str, client_id: str, access_token: Optional[str] = None) -> dict:
+        metadata = await self.metadata()
+        keys = await self.jwks(jwt.get_unverified_header(id_token).get("kid"))
+        return jwt.decode(
+            id_token,
+            keys,
+            algorithms=ID_TOKEN_ALGORITHMS,
+            audience=client_id,
+            issuer=metadata["issuer"],
+            access_token=access_token,
+        )
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "fetches": self.fetches, "failures": self.failures}
+
+    def clear(self):
+        self._documents.clear()
+        self._locks.clear()
+
+discovery = DiscoveryCache()
@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Tuple
+from jose import jwk, jwt
+
+# Seconds between checks of the key file for a rotated key
+SIGNING_KEY_CHECK_INTERVAL = float(os.getenv("SIGNING_KEY_CHECK_INTERVAL", "5"))
+
+VISA_LIFETIME = 12 * 3600
+# A cached visa is handed out again until this fraction of its lifetime has passed; 0 signs every time
+VISA_REUSE_FRACTION = float(os.getenv("VISA_REUSE_FRACTION", "0.5"))
+VISA_CACHE_MAX_ENTRIES = int(os.getenv("VISA_CACHE_MAX_ENTRIES", "10000"))
+
+def public_jwk(key) -> dict:
+    """Public half of an RS256 key as a JWK, with its RFC 7638 thumbprint as kid."""
+    public = key.public_key().to_dict()
+    required = json.dumps({name: public[name] for name in ("e", "kty", "n")}, separators=(",", ":"), sort_keys=True)
+    kid = base64.urlsafe_b64encode(hashlib.sha256(required.encode()).digest()).decode().rstrip("=")
+    return {"kty": public["kty"], "alg": "RS256", "use": "sig", "kid": kid, "n": public["n"], "e": public["e"]}
+
+class SigningKey:
+    """RS256 private key parsed once from its PEM file and parsed again only when the file changes.
+
+    The file's identity (inode, mtime, size) is checked at most every check_interval seconds, so
+    a rotated key is picked up without a restart and without a stat() per request. A rotated-out
+    key stays in jwks() for one visa lifetime, so visas it signed keep verifying until they expire.
+    """
+
+    def __init__(self, path: Callable[[], str], check_interval: float = SIGNING_KEY_CHECK_INTERVAL):
+        self._path = path
+        self.check_interval = check_interval
+        self._key = None
+        self._jwk = None
+        # (public JWK, time it was rotated out)
+        self._retired = []
+        self._file_id = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self._key is not None and now - self._checked_at < self.check_interval:
+            return self._key
+        with self._lock:
+            path = self._path()
+            stat = os.stat(path)
+            file_id = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if file_id != self._file_id:
+                with open(path, "r") as f:
+                    key = jwk.construct(f.read(), algorithm="RS256")
+                new_jwk = public_jwk(key)
+                if self._jwk is not None and self._jwk["kid"] != new_jwk["kid"]:
+                    self._retired.append((self._jwk, time.time()))
+                self._key, self._jwk = key, new_jwk
+                self._file_id = file_id
+                self.loads += 1
+            self._checked_at = now
+            return self._key
+
+    @property
+    def kid(self) -> str:
+        self.get()
+        return self._jwk["kid"]
+
+    def jwks(self) -> dict:
+        self.get()
+        now = time.time()
+        with self._lock:
+            self._retired = [(key, retired_at) for key, retired_at in self._retired if now - retired_at < VISA_LIFETIME]
+            return {"keys": [self._jwk, *(key for key, _ in self._retired)]}
+
+    @property
+    def version(self):
+        """Changes whenever a different key file has been loaded."""
+        return self._file_id
+
+class VisaCache:
+    """Signed visas per subject, reused until reuse_fraction of their lifetime has passed.
+
+    Visas signed with a key that has since been rotated out are never handed out again.
+    """
+
+    def __init__(self, signing_key: SigningKey, reuse_fraction: float = VISA_REUSE_FRACTION,
+                 max_entries: int = VISA_CACHE_MAX_ENTRIES):
+        self.signing_key = signing_key
+        self.reuse_fraction = reuse_fraction
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sub: str, issuer: str) -> str:
+        key = self.signing_key.get()
+        kid = self.signing_key.kid
+        version = self.signing_key.version
+        now = int(time.time())
+        with self._lock:
+            entry = self._entries.get((issuer, sub))
+            if entry is not None:
+                visa, issued_at, key_version = entry
+                if key_version == version and now < issued_at + VISA_LIFETIME * self.reuse_fraction:
+                    self._entries.move_to_end((issuer, sub))
+                    self.hits += 1
+                    return visa
+            self.misses += 1
+
+        visa = jwt.encode(visa_claims(sub, issuer, now), key, algorithm="RS256", headers={"kid": kid})
+        with self._lock:
+            self._entries[(issuer, sub)] = (visa, now, version)
+            self._entries.move_to_end((issuer, sub))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return visa
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            # Each hit is one RS256 signature skipped
+            "signatures_saved": self.hits,
+            "key_loads": self.signing_key.loads,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def visa_claims(sub: str, issuer: str, now: int) -> dict:
+    # A dummy visa (normally you'd do this per DAC access or external system)
+    return {
+        "iss": issuer,
+        "sub": sub,
+        "iat": now,
+        "exp": now + VISA_LIFETIME,
+        "jti": str(uuid.uuid4()),
+        "ga4gh_visa_v1": {
+            "type": "ControlledAccessGrants",
+            "asserted": now,
+            "value": "phs000123.v1.p1.c1",
+            "source": issuer,
+            "by": "dac"
+        }
+    }
@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+from db import IssuedToken, OAuthState, SessionLocal, run_db
+
+try:
+    import redis
+except ImportError:  # optional; only the "redis" backend needs it
+    redis = None
+
+# "sqlite" keeps state in STATE_DATABASE_URL, which instances share when it names a shared file;
+# "redis" shares it through STATE_REDIS_URL; "memory" keeps it in this process only
+STATE_STORE = os.getenv("STATE_STORE", "sqlite")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+# How long a login may take between /login and /callback
+OAUTH_STATE_TTL = int(os.getenv("OAUTH_STATE_TTL", "600"))
+# Seconds between purges of expired states and tokens
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "60"))
+
+class MemoryStateStore:
+    """Login state and issued tokens in dicts keyed by state, expired lazily on read and by sweep()."""
+
+    def __init__(self):
+        self._states: Dict[str, Tuple[str, float]] = {}
+        self._tokens: Dict[str, Tuple[dict, float]] = {}
+        # (expires_at, table, state), so sweep() only looks at entries that are due
+        self._expiry: list = []
+        self._lock = threading.Lock()
+        self.swept = 0
+
+    def put_state(self, state: str, redirect_uri: str, ttl: float = None) -> bool:
+        now = time.time()
+        expires_at = now + (OAUTH_STATE_TTL if ttl is None else ttl)
+        with self._lock:
+            entry = self._states.get(state)
+            if entry is not None and entry[1] > now:
+                return False
+            self._states[state] = (redirect_uri, expires_at)
+            heapq.heappush(self._expiry, (expires_at, "states", state))
+        return True
+
+    def pop_state(self, state: str) -> Optional[str]:
+        with self._lock:
+            entry = self._states.pop(state, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def put_token(self, state: str, record: dict, expires_at: float):
+        with self._lock:
+            self._tokens[state] = (dict(record), expires_at)
+            heapq.heappush(self._expiry, (expires_at, "tokens", state))
+
+    def get_token(self, state: str) -> Optional[dict]:
+        entry = self._tokens.get(state)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return dict(entry[0])
+
+    def sweep(self) -> int:
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires_at, table, state = heapq.heappop(self._expiry)
+                entries = self._states if table == "states" else self._tokens
+                entry = entries.get(state)
+                # The state may have been reused since; only drop the entry this heap item belongs to
+                if entry is not None and entry[1] == expires_at:
+                    del entries[state]
+                    removed += 1
+            self.swept += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {"states": len(self._states), "tokens": len(self._tokens), "swept": self.swept}
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._tokens.clear()
+            self._expiry.clear()
+
+class SQLStateStore:
+    """Login state and issued tokens in the state database, looked up by primary key.
+
+    Rows carry expires_at, which reads check and sweep() deletes by through its index, so the
+    file stays the size of the logins in flight rather than every login ever made.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+        self.swept = 0
+
+    def put_state(self, state: str, redirect_uri: str, ttl: float = None) -> bool:
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=OAUTH_STATE_TTL if ttl is None else ttl)
+        with self._session_factory() as session:
+            # An expired state may be reused
+            session.execute(delete(OAuthState).where(OAuthState.state == state, OAuthState.expires_at <= now))
+            session.add(OAuthState(state=state, redirect_uri=redirect_uri, created_at=now, expires_at=expires_at))
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return False
+        return True
+
+    def pop_state(self, state: str) -> Optional[str]:
+        # One statement, so two instances handling the same callback cannot both consume the state
+        with self._session_factory() as session:
+            redirect_uri = session.execute(
+                delete(OAuthState)
+                .where(OAuthState.state == state, OAuthState.expires_at > datetime.utcnow())
+                .returning(OAuthState.redirect_uri)
+            ).scalar()
+            session.commit()
+        return redirect_uri
+
+    def put_token(self, state: str, record: dict, expires_at: float):
+        with self._session_factory() as session:
+            session.merge(IssuedToken(
+                state=state,
+                access_token=record["access_token"],
+                user_sub=record["user_sub"],
+                user_email=record["user_email"],
+                issued_at=datetime.utcnow(),
+                expires_at=datetime.utcfromtimestamp(expires_at),
+            ))
+            session.commit()
+
+    def get_token(self, state: str) -> Optional[dict]:
+        with self._session_factory() as session:
+            token = session.get(IssuedToken, state)
+            if token is None or token.expires_at <= datetime.utcnow():
+                return None
+            return {"access_token": token.access_token, "user_sub": token.user_sub, "user_email": token.user_email}
+
+    def sweep(self) -> int:
+        now = datetime.utcnow()
+        with self._session_factory() as session:
+            removed = session.execute(delete(OAuthState).where(OAuthState.expires_at <= now)).rowcount
+            removed += session.execute(delete(IssuedToken).where(IssuedToken.expires_at <= now)).rowcount
+            session.commit()
+        self.swept += removed
+        return removed
+
+    def stats(self) -> dict:
+        with self._session_factory() as session:
+            states = session.execute(select(func.count()).select_from(OAuthState)).scalar()
+            tokens = session.execute(select(func.count()).select_from(IssuedToken)).scalar()
+        return {"states": states, "tokens": tokens, "swept": self.swept}
+
+    def clear(self):
+        with self._session_factory() as session:
+            session.execute(delete(OAuthState))
+            session.execute(delete(IssuedToken))
+            session.commit()
+
+class RedisStateStore:
+    """Login state and issued tokens as Redis keys that Redis expires itself; needs Redis 6.2 or later."""
+
+    def __init__(self, url: str = STATE_REDIS_URL, prefix: str = "auth:"):
+        if redis is None:
+            raise RuntimeError("STATE_STORE=redis needs the redis package installed")
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def put_state(self, state: str, redirect_uri: str, ttl: float = None) -> bool:
+        ttl = OAUTH_STATE_TTL if ttl is None else ttl
+        return bool(self._redis.set(f"{self.prefix}state:{state}", redirect_uri, nx=True, ex=max(1, int(ttl))))
+
+    def pop_state(self, state: str) -> Optional[str]:
+        return self._redis.getdel(f"{self.prefix}state:{state}")
+
+    def put_token(self, state: str, record: dict, expires_at: float):
+        self._redis.set(f"{self.prefix}token:{state}", json.dumps(record), exat=int(expires_at))
+
+    def get_token(self, state: str) -> Optional[dict]:
+        value = self._redis.get(f"{self.prefix}token:{state}")
+        return json.loads(value) if value is not None else None
+
+    def sweep(self) -> int:
+        # Keys carry their own TTL
+        return 0
+
+    def stats(self) -> dict:
+        return {}
+
+    def clear(self):
+        for key in self._redis.scan_iter(f"{self.prefix}*"):
+            self._redis.delete(key)
+
+STATE_STORES = {"memory": MemoryStateStore, "sqlite": SQLStateStore, "redis": RedisStateStore}
+
+def create_state_store(backend: str = STATE_STORE):
+    if backend not in STATE_STORES:
+        raise ValueError(f"Unknown STATE_STORE {backend!r}; expected one of {', '.join(STATE_STORES)}")
+    return STATE_STORES[backend]()
+
+state_store = create_state_store()
+
+async def sweep_expired(store=state_store, interval: float = STATE_SWEEP_INTERVAL):
+    """Purge expired states and tokens every interval seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_db(store.sweep)
+        except Exception as e:
+            print(f"State store sweep failed: {e}")
@@ -0,0 +1,108 @@
+"""A local OpenID Connect provider that signs everyone in without asking, for tests and offline runs.
+
+    uvicorn stub_idp:app --port 9000
+    OIDC_DISCOVERY_URL=http://localhost:9000/.well-known/openid-configuration uvicorn main:app
+
+It serves discovery, an authorize endpoint that redirects straight back with a code, token and
+userinfo endpoints, and a JWKS for the RS256 key its ID tokens are signed with. The signed-in
+user is taken from the login_hint authorize parameter. Calls per endpoint are counted in `calls`.
+"""
+import base64
+import hashlib
+import secrets
+import time
+from collections import Counter
+from urllib.parse import urlencode
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI, Form, Header, HTTPException, Request
+from fastapi.responses import RedirectResponse
+from jose import jwk, jwt
+
+KID = "stub-key-1"
+_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+PRIVATE_KEY_PEM = _private_key.private_bytes(
+    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+).decode()
+PUBLIC_JWK = {
+    **jwk.construct(_private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode(), algorithm="RS256").to_dict(),
+    "kid": KID,
+    "use": "sig",
+}
+
+app = FastAPI()
+calls = Counter()
+# code -> (user, client_id); access token -> user
+_codes = {}
+_access_tokens = {}
+
+def issuer(request: Request) -> str:
+    return str(request.base_url).rstrip("/")
+
+def user_for(login_hint: str) -> dict:
+    name = login_hint.split("@")[0]
+    return {"sub": hashlib.sha256(login_hint.encode()).hexdigest()[:21], "email": login_hint, "name": name.title()}
+
+def at_hash(access_token: str) -> str:
+    digest = hashlib.sha256(access_token.encode()).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip("=")
+
+@app.get("/.well-known/openid-configuration")
+def discovery(request: Request):
+    calls["discovery"] += 1
+    base = issuer(request)
+    return {
+        "issuer": base,
+        "authorization_endpoint": f"{base}/authorize",
+        "token_endpoint": f"{base}/token",
+        "userinfo_endpoint": f"{base}/userinfo",
+        "jwks_uri": f"{base}/jwks",
+        "id_token_signing_alg_values_supported": ["RS256"],
+    }
+
+@app.get("/authorize")
+def authorize(redirect_uri: str, state: str, client_id: str, login_hint: str = "user@example.org"):
+    calls["authorize"] += 1
+    code = secrets.token_urlsafe(16)
+    _codes[code] = (user_for(login_hint), client_id)
+    return RedirectResponse(f"{redirect_uri}?{urlencode({'code': code, 'state': state})}")
+
+@app.post("/token")
+def token(request: Request, code: str = Form(...), client_id: str = Form(...), grant_type: str = Form(...)):
+    calls["token"] += 1
+    if grant_type != "authorization_code" or code not in _codes:
+        raise HTTPException(status_code=400, detail="invalid_grant")
+    user, issued_to = _codes.pop(code)
+    if client_id != issued_to:
+        raise HTTPException(status_code=400, detail="invalid_client")
+    access_token = secrets.token_urlsafe(24)
+    _access_tokens[access_token] = user
+    now = int(time.time())
+    id_token = jwt.encode(
+        {**user, "iss": issuer(request), "aud": client_id, "iat": now, "exp": now + 3600, "at_hash": at_hash(access_token)},
+        PRIVATE_KEY_PEM,
+        algorithm="RS256",
+        headers={"kid": KID},
+    )
+    return {"access_token": access_token, "id_token": id_token, "token_type": "Bearer", "expires_in": 3600}
+
+@app.get("/userinfo")
+def userinfo(authorization: str = Header(...)):
+    calls["userinfo"] += 1
+    user = _access_tokens.get(authorization.removeprefix("Bearer "))
+    if user is None:
+        raise HTTPException(status_code=401, detail="invalid_token")
+    return user
+
+@app.get("/jwks")
+def jwks():
+    calls["jwks"] += 1
+    return {"keys": [PUBLIC_JWK]}
+
+def start_login(code_for: str = "user@example.org", client_id: str = "stub-client") -> str:
+    """Mint a code directly, as /authorize would, for tests that skip the browser redirect."""
+    code = secrets.token_urlsafe(16)
+    _codes[code] = (user_for(code_for), client_id)
+    return code
@@ -0,0 +1,21 @@
+import os
+import sys
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import stub_idp
+from http_client import outbound
+from oidc import discovery
+
+STUB_DISCOVERY_URL = "http://idp.test/.well-known/openid-configuration"
+
+@pytest.fixture(autouse=True)
+def stub_identity_provider():
+    """Route every outbound identity provider call to the local stub instead of Google."""
+    outbound.use_transport(httpx.ASGITransport(app=stub_idp.app))
+    discovery.discovery_url = STUB_DISCOVERY_URL
+    discovery.clear()
+    stub_idp.calls.clear()
+    yield stub_idp
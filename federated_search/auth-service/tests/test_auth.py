@@ -1,24 +1,23 @@
 import pytest
 import os
 import sys
+import time
 from fastapi.testclient import TestClient
 
 # This adds the parent directory to path so that imports can work from anywhere
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from urllib.parse import parse_qs, urlparse
 from main import app
-from db import SessionLocal, OAuthState
+from state_store import state_store
 
 
 client = TestClient(app)
 
 @pytest.fixture(autouse=True)
 def clear_oauth_state():
-    """Clear OAuthState table before each test."""
-    db = SessionLocal()
-    db.query(OAuthState).delete()
-    db.commit()
-    db.close()
+    """Clear login state and issued tokens before each test."""
+    state_store.clear()
 
 def test_login_duplicate_state_returns_400():
     params = {
@@ -29,9 +28,49 @@ def test_login_duplicate_state_returns_400():
     # First call should succeed (redirect)
     response1 = client.get("/login", params=params, follow_redirects=False)
     assert response1.status_code == 307
-    assert response1.headers["location"].startswith("https://accounts.google.com/o/oauth2/v2/auth")
+    assert response1.headers["location"].startswith("http://idp.test/authorize")
 
     # Second call should fail with 400
     response2 = client.get("/login", params=params)
     assert response2.status_code == 400
-    assert "already exists" in response2.json()["detail"]
\ No newline at end of file
+    assert "already exists" in response2.json()["detail"]
+def test_metrics_endpoint_reports_routes_and_pool():
+    client.get("/login", params={"redirect_uri": "http://localhost:3000/callback", "state": "metrics-state"}, follow_redirects=False)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{method="GET",route="/login",status="307"}' in response.text
+    assert "db_pool_size" in response.text
+
+def test_session_returns_token_recorded_for_state():
+    state_store.put_token("session-state", {
+        "access_token": "abc", "user_sub": "123", "user_email": "a@example.com",
+    }, time.time() + 60)
+    response = client.get("/session", params={"state": "session-state"})
+    assert response.status_code == 200
+    assert response.json()["access_token"] == "abc"
+    assert response.json()["user"] == {"email": "a@example.com", "sub": "123"}
+    assert client.get("/session", params={"state": "unknown"}).status_code == 404
+
+def test_login_flow_uses_cached_discovery_and_id_token(stub_identity_provider):
+    idp = TestClient(stub_identity_provider.app)
+    for i in range(2):
+        state = f"flow-state-{i}"
+        login = client.get("/login", params={"redirect_uri": "http://localhost:3000/cb", "state": state},
+                           follow_redirects=False)
+        authorize = urlparse(login.headers["location"])
+        params = {key: values[0] for key, values in parse_qs(authorize.query).items()}
+        consent = idp.get("/authorize", params={**params, "login_hint": f"user{i}@example.org"}, follow_redirects=False)
+        code = parse_qs(urlparse(consent.headers["location"]).query)["code"][0]
+
+        callback = client.get("/callback", params={"code": code, "state": state}, follow_redirects=False)
+        assert callback.status_code == 307
+        assert callback.headers["location"].startswith("http://localhost:3000/cb?state=" + state)
+        session = client.get("/session", params={"state": state}).json()
+        assert session["user"]["email"] == f"user{i}@example.org"
+
+    calls = stub_identity_provider.calls
+    assert calls["discovery"] == 1
+    assert calls["jwks"] == 1
+    assert calls["token"] == 2
+    # The verified ID token replaces the userinfo call
+    assert calls["userinfo"] == 0
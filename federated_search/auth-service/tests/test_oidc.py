@@ -0,0 +1,78 @@
+import asyncio
+import base64
+import os
+import sys
+import pytest
+from jose import jwt
+from jose.exceptions import JWTError
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from oidc import DiscoveryCache
+
+class Response:
+    def __init__(self, document):
+        self.document = document
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.document
+
+class Outbound:
+    """Stands in for http_client.outbound, serving documents by URL; each fetch yields to the loop."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.fetches = 0
+
+    def get(self):
+        return self
+
+    async def fetch(self, url):
+        self.fetches += 1
+        await asyncio.sleep(0.01)
+        return Response(self.documents[url])
+
+class HttpClient:
+    def __init__(self, outbound):
+        self.outbound = outbound
+
+    async def get(self, url):
+        return await self.outbound.fetch(url)
+
+def make_cache(documents, **ttls):
+    outbound = Outbound(documents)
+    outbound.get = lambda: HttpClient(outbound)
+    return DiscoveryCache("http://idp.test/discovery", client=outbound, **ttls), outbound
+
+def test_cache_works_across_event_loops():
+    cache, outbound = make_cache({"http://idp.test/discovery": {"issuer": "http://idp.test"}}, metadata_ttl=0)
+
+    async def burst():
+        return await asyncio.gather(*(cache.metadata() for _ in range(3)))
+
+    # Each asyncio.run is a new loop, as with a fresh loop per test or a reload
+    for _ in range(2):
+        assert asyncio.run(burst())[0] == {"issuer": "http://idp.test"}
+    assert outbound.fetches >= 2
+
+def test_id_token_algorithm_is_pinned_to_rs256():
+    secret = b"shared-secret"
+    # A provider (or anyone who can tamper with discovery) advertising HS256 with a symmetric key
+    cache, _ = make_cache({
+        "http://idp.test/discovery": {
+            "issuer": "http://idp.test",
+            "jwks_uri": "http://idp.test/jwks",
+            "id_token_signing_alg_values_supported": ["HS256"],
+        },
+        "http://idp.test/jwks": {"keys": [{
+            "kty": "oct", "kid": "k1", "alg": "HS256",
+            "k": base64.urlsafe_b64encode(secret).decode().rstrip("="),
+        }]},
+    })
+    forged = jwt.encode({"iss": "http://idp.test", "aud": "client", "sub": "x"}, secret, algorithm="HS256",
+                        headers={"kid": "k1"})
+    with pytest.raises(JWTError):
+        asyncio.run(cache.verify_id_token(forged, "client"))
@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from signing import SigningKey, VisaCache
+
+def write_key(path):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+    ))
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+
+def test_visa_is_reused_within_its_reuse_window(tmp_path):
+    public_key = write_key(tmp_path / "key.pem")
+    cache = VisaCache(SigningKey(lambda: str(tmp_path / "key.pem")), reuse_fraction=0.5)
+    first = cache.get("user-1", "http://issuer")
+    assert cache.get("user-1", "http://issuer") == first
+    assert cache.get("user-2", "http://issuer") != first
+    assert jwt.decode(first, public_key, algorithms=["RS256"])["sub"] == "user-1"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["key_loads"] == 1
+
+def test_zero_reuse_fraction_signs_every_time(tmp_path):
+    write_key(tmp_path / "key.pem")
+    cache = VisaCache(SigningKey(lambda: str(tmp_path / "key.pem")), reuse_fraction=0)
+    assert cache.get("user-1", "http://issuer") != cache.get("user-1", "http://issuer")
+
+def test_rotated_key_is_loaded_and_old_visas_dropped(tmp_path):
+    path = tmp_path / "key.pem"
+    write_key(path)
+    signing_key = SigningKey(lambda: str(path), check_interval=0)
+    cache = VisaCache(signing_key)
+    old_visa = cache.get("user-1", "http://issuer")
+
+    rotated = tmp_path / "rotated.pem"
+    new_public_key = write_key(rotated)
+    os.replace(rotated, path)
+    new_visa = cache.get("user-1", "http://issuer")
+
+    assert new_visa != old_visa
+    assert jwt.decode(new_visa, new_public_key, algorithms=["RS256"])["iat"] <= time.time()
+    assert signing_key.loads == 2
+
+def test_jwks_keeps_the_rotated_out_key_and_visas_name_their_kid(tmp_path):
+    path = tmp_path / "key.pem"
+    write_key(path)
+    signing_key = SigningKey(lambda: str(path), check_interval=0)
+    cache = VisaCache(signing_key)
+    old_visa = cache.get("user-1", "http://issuer")
+    old_kid = signing_key.kid
+
+    rotated = tmp_path / "rotated.pem"
+    write_key(rotated)
+    os.replace(rotated, path)
+    new_visa = cache.get("user-1", "http://issuer")
+
+    keys = signing_key.jwks()["keys"]
+    assert [key["kid"] for key in keys] == [signing_key.kid, old_kid]
+    assert jwt.get_unverified_header(new_visa)["kid"] == signing_key.kid
+    for visa in (old_visa, new_visa):
+        assert jwt.decode(visa, signing_key.jwks(), algorithms=["RS256"])["sub"] == "user-1"
+
+def test_userinfo_reports_the_reused_visas_own_lifetime(tmp_path, monkeypatch):
+    import main
+
+    write_key(tmp_path / "key.pem")
+    cache = VisaCache(SigningKey(lambda: str(tmp_path / "key.pem")), reuse_fraction=0.5)
+    monkeypatch.setattr(main, "visa_cache", cache)
+    issued = int(time.time()) - 100
+    monkeypatch.setattr(time, "time", lambda: issued)
+    cache.get("user-1", main.config("ISSUER"))
+    monkeypatch.undo()
+    monkeypatch.setattr(main, "visa_cache", cache)
+
+    body = main.userinfo(None, {"sub": "user-1", "name": "A", "email": "a@example.org"})
+    claims = jwt.get_unverified_claims(body["ga4gh_passport_v1"][0])
+    assert cache.stats()["hits"] == 1
+    assert (body["iat"], body["exp"]) == (claims["iat"], claims["exp"])
+    assert body["iat"] == issued
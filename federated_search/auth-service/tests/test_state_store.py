@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from db import Base
+from state_store import MemoryStateStore, SQLStateStore
+
+def sql_store(path):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    return SQLStateStore(sessionmaker(bind=engine)), engine
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateStore()
+    return sql_store(tmp_path / "state.db")[0]
+
+def test_state_is_single_use(store):
+    assert store.put_state("s1", "http://client/cb")
+    assert not store.put_state("s1", "http://other/cb")
+    assert store.pop_state("s1") == "http://client/cb"
+    assert store.pop_state("s1") is None
+
+def test_expired_entries_are_ignored_and_swept(store):
+    assert store.put_state("old", "http://client/cb", ttl=-1)
+    store.put_token("old", {"access_token": "t", "user_sub": "u", "user_email": "e"}, time.time() - 1)
+    store.put_token("new", {"access_token": "t2", "user_sub": "u", "user_email": "e"}, time.time() + 60)
+    assert store.get_token("old") is None
+    # An expired state can be taken again
+    assert store.put_state("old", "http://client/cb", ttl=-1)
+
+    assert store.sweep() == 2
+    assert store.stats()["tokens"] == 1
+    assert store.get_token("new")["access_token"] == "t2"
+
+def test_instances_sharing_a_sqlite_file_see_each_others_logins(tmp_path):
+    first, engine = sql_store(tmp_path / "shared.db")
+    second, _ = sql_store(tmp_path / "shared.db")
+    assert first.put_state("shared", "http://client/cb")
+    assert second.pop_state("shared") == "http://client/cb"
+    second.put_token("shared", {"access_token": "t", "user_sub": "u", "user_email": "e"}, time.time() + 60)
+    assert first.get_token("shared")["access_token"] == "t"
+    indexed = {tuple(index["column_names"]) for index in inspect(engine).get_indexes("issued_token")}
+    assert ("expires_at",) in indexed
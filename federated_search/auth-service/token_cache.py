@@ -0,0 +1,71 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+from jose import jwt
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+# Upper bound on how long claims are trusted without re-verifying, even for tokens without "exp"
+TOKEN_CACHE_MAX_TTL = float(os.getenv("TOKEN_CACHE_MAX_TTL", "3600"))
+
+class VerifiedTokenCache:
+    """Bounded cache of verified JWT claims, keyed by a digest of the token, that expires with the token."""
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES, max_ttl: float = TOKEN_CACHE_MAX_TTL):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def decode(self, token: str, key: str, algorithms: List[str]) -> dict:
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                claims, expires_at = entry
+                if now < expires_at:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return dict(claims)
+                del self._entries[digest]
+            self.misses += 1
+
+        try:
+            claims = jwt.decode(token, key, algorithms=algorithms)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+
+        expires_at = now + self.max_ttl
+        if isinstance(claims.get("exp"), (int, float)):
+            expires_at = min(expires_at, claims["exp"])
+        with self._lock:
+            self._entries[digest] = (claims, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return dict(claims)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            # Each hit is one signature verification skipped
+            "verifications_saved": self.hits,
+        }
+
+token_cache = VerifiedTokenCache()
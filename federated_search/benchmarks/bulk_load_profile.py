@@ -0,0 +1,74 @@
+"""Compare loading the person table with per-row session.merge against the bulk loader.
+
+Writes a synthetic CSV export of --rows persons, then loads it into two fresh SQLite files:
+once the way init_db.py used to (one session.merge per row, one commit), and once through
+app.bulk_load from the same export.
+
+    python benchmarks/bulk_load_profile.py --rows 200000
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "sysbio-service"))
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.bulk_load import bulk_load, file_pages  # noqa: E402
+from app.database import create_write_engine  # noqa: E402
+from app.models.person import Person  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="bulk-load-bench-")
+COLUMNS = [column.name for column in Person.__table__.columns]
+
+def write_export(path: str, rows: int):
+    rng = random.Random(7)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for person_id in range(1, rows + 1):
+            writer.writerow([
+                person_id, rng.choice(["MALE", "FEMALE"]), rng.randint(1930, 2005),
+                rng.choice(["White", "Asian", "Black or African American", ""]),
+                rng.choice(["Hispanic or Latino", "Not Hispanic or Latino"]),
+                rng.choice(["Parkinson's disease", "Alzheimer's disease", "Essential tremor"]),
+            ])
+
+def fresh_engine(name: str):
+    engine = create_write_engine(f"sqlite:///{os.path.join(WORKDIR, name)}")
+    Person.__table__.create(engine)
+    return engine
+
+def legacy_load(engine, export: str) -> float:
+    # The loader as it was: one ORM merge, and so one SELECT, per row
+    session = sessionmaker(bind=engine)()
+    start = time.perf_counter()
+    for page in file_pages(export, Person.__table__):
+        for row in page:
+            session.merge(Person(**dict(zip(COLUMNS, row))))
+    session.commit()
+    session.close()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+
+    export = os.path.join(WORKDIR, "persons.csv")
+    write_export(export, args.rows)
+
+    before = legacy_load(fresh_engine("legacy.db"), export)
+    report = bulk_load(fresh_engine("bulk.db"), Person.__table__, file_pages(export, Person.__table__))
+    print(f"before (session.merge per row): {args.rows / before:10,.0f} rows/s  ({before:.2f}s)")
+    print(f"after  (paged executemany):     {report.rows_per_second:10,.0f} rows/s  "
+          f"({report.seconds:.2f}s, {report.rows_per_second * before / args.rows:.1f}x)")
+    print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Compare /search throughput on the default SQLite engine and the read-serving profile.
+
+Builds a synthetic AMP PD database, then drives the amp-pd /search route from concurrent
+threads once per engine and prints requests per second for each.
+
+    python benchmarks/sqlite_profile.py --rows 200000 --threads 16 --requests 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "amp-pd-service"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine, insert  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.database import Base, create_read_engine, create_write_engine  # noqa: E402
+from app.dependencies import get_db  # noqa: E402
+from app.models.person import Person  # noqa: E402
+from main import app  # noqa: E402
+
+DIAGNOSES = ["Parkinson's disease", "Alzheimer's disease", "Healthy control", "Lewy body dementia"]
+QUERIES = [
+    ("SELECT * FROM person WHERE diagnosis_name = :d", lambda: {"d": random.choice(DIAGNOSES)}),
+    ("SELECT * FROM person WHERE person_id BETWEEN :lo AND :lo + 500", lambda: {"lo": random.randint(1, 100000)}),
+    ("SELECT diagnosis_name, COUNT(*) AS n FROM person GROUP BY diagnosis_name", lambda: {}),
+]
+
+def build_database(path: str, rows: int):
+    engine = create_write_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    batch = []
+    with engine.begin() as conn:
+        for person_id in range(1, rows + 1):
+            batch.append({
+                "person_id": person_id,
+                "gender": random.choice(["male", "female"]),
+                "year_of_birth": random.randint(1930, 2000),
+                "race": random.choice(["asian", "white", "black"]),
+                "ethnicity": random.choice(["hispanic", "non-hispanic"]),
+                "diagnosis_name": random.choice(DIAGNOSES),
+            })
+            if len(batch) == 10000:
+                conn.execute(insert(Person), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Person), batch)
+    engine.dispose()
+
+def run_load(engine, threads: int, requests: int, limit: int) -> float:
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    client = TestClient(app)
+
+    def one_request(_):
+        query, params = random.choice(QUERIES)
+        response = client.post("/search", json={
+            "query": query,
+            "parameters": {**params(), "access_tier": "public"},
+            "limit": limit,
+        })
+        response.raise_for_status()
+
+    # Warm the pool and page cache before timing
+    list(map(one_request, range(threads)))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - start
+    app.dependency_overrides.pop(get_db, None)
+    engine.dispose()
+    return requests / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "bench.db")
+        print(f"Building {args.rows} rows in {path}...")
+        build_database(path, args.rows)
+        url = f"sqlite:///{path}"
+
+        default = run_load(
+            create_engine(url, connect_args={"check_same_thread": False}), args.threads, args.requests, args.limit
+        )
+        tuned = run_load(create_read_engine(url), args.threads, args.requests, args.limit)
+
+    print(f"default engine: {default:8.1f} req/s")
+    print(f"read profile:   {tuned:8.1f} req/s ({tuned / default:.2f}x)")
+
+if __name__ == "__main__":
+    main()
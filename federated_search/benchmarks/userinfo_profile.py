@@ -0,0 +1,111 @@
+"""Compare auth-service /userinfo throughput before and after key and visa caching.
+
+Generates a throwaway RSA key, then drives /userinfo from concurrent threads twice: once through
+a copy of the previous handler, which re-read the PEM file and signed a new visa per request, and
+once through the current one. Requests cycle through --users subjects, so with --users smaller
+than --requests most visas come from the cache.
+
+    python benchmarks/userinfo_profile.py --threads 8 --requests 2000 --users 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "auth-service"))
+
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="userinfo-bench-")
+KEY_PATH = os.path.join(WORKDIR, "private_key.pem")
+os.environ.setdefault("JWT_SECRET", "bench-secret")
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ.setdefault("GOOGLE_CLIENT_ID", "bench")
+os.environ.setdefault("GOOGLE_CLIENT_SECRET", "bench")
+os.environ.setdefault("REDIRECT_URI", "http://localhost/callback")
+os.environ.setdefault("ISSUER", "http://localhost:8000")
+os.environ["PRIVATE_KEY_PATH"] = KEY_PATH
+os.environ["STATE_DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'state.db')}"
+
+from fastapi import Depends  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from jose import jwt  # noqa: E402
+
+import main  # noqa: E402
+
+def write_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(KEY_PATH, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        ))
+
+def legacy_userinfo(user=Depends(main.get_current_user)):
+    # The handler as it was: read and parse the PEM, then sign a fresh visa, on every request
+    now = int(time.time())
+    with open(main.config("PRIVATE_KEY_PATH"), "r") as f:
+        private_key = f.read()
+    visa_claim = {
+        "iss": main.config("ISSUER"),
+        "sub": user["sub"],
+        "iat": now,
+        "exp": now + 12 * 3600,
+        "jti": str(uuid.uuid4()),
+        "ga4gh_visa_v1": {
+            "type": "ControlledAccessGrants",
+            "asserted": now,
+            "value": "phs000123.v1.p1.c1",
+            "source": main.config("ISSUER"),
+            "by": "dac",
+        },
+    }
+    visa_jwt = jwt.encode(visa_claim, private_key, algorithm="RS256")
+    return {"sub": user["sub"], "ga4gh_passport_v1": [visa_jwt]}
+
+def user_tokens(count: int):
+    exp = int(time.time()) + 3600
+    return [
+        jwt.encode({"sub": f"user-{i}", "email": f"user-{i}@example.org", "name": f"User {i}", "exp": exp},
+                   os.environ["JWT_SECRET"], algorithm="HS256")
+        for i in range(count)
+    ]
+
+def run(path: str, tokens: list, threads: int, requests: int) -> float:
+    client = TestClient(main.app)
+
+    def call(i):
+        response = client.get(path, headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"})
+        response.raise_for_status()
+
+    for i in range(min(threads, requests)):
+        call(i)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(call, range(requests)))
+    return requests / (time.perf_counter() - start)
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+
+    write_key()
+    main.app.add_api_route("/userinfo-legacy", legacy_userinfo, methods=["GET"])
+    tokens = user_tokens(args.users)
+
+    before = run("/userinfo-legacy", tokens, args.threads, args.requests)
+    main.visa_cache.clear()
+    after = run("/userinfo", tokens, args.threads, args.requests)
+    print(f"before (read key + sign per request): {before:8.1f} req/s")
+    print(f"after  (cached key + reused visas):   {after:8.1f} req/s  ({after / before:.1f}x)")
+    print(f"visa cache: {main.visa_cache.stats()}")
+
+if __name__ == "__main__":
+    main_()
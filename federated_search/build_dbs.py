@@ -0,0 +1,253 @@
+"""Build the PD, AD and public sysbio SQLite databases from one extraction of the person cohort.
+
+The cohort query runs once against BigQuery (or --export names a local Parquet/CSV export),
+the rows are split by person_id into one shard per service, and each service's init_db.py
+loads its shard in its own process, all three at once. Wall-clock time is reported per stage.
+
+    python build_dbs.py                          # extract from BigQuery
+    python build_dbs.py --export persons.parquet  # build offline from an export
+    python build_dbs.py --only pd --only ad       # rebuild a subset
+    python build_dbs.py --incremental             # update the served files in place, see below
+
+With --incremental each init_db.py applies only new and changed rows to a copy of its database
+and renames the copy over the served file, so running services never see a missing or half-built
+database; they switch to the new file on their next connection checkout.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The same ranges init_db.py loads: PD gets ID <= 1500, AD 1500 < ID <= 3000, and sysbio the rest
+MAX_PD_ID = 1500
+MAX_AD_ID = 3000
+
+# service -> (directory, database file)
+SERVICES = {
+    "pd": ("amp-pd-service", "pd.db"),
+    "ad": ("amp-ad-service", "ad.db"),
+    "sysbio": ("sysbio-service", "sysbio.db"),
+}
+
+# The tables the cohort is read from, whose last-modified times are its watermarks
+COHORT_TABLES = (
+    "data-development-440922.sysbio_synth_omop.condition_occurrence",
+    "data-development-440922.sysbio_synth_omop.concept",
+    "data-development-440922.sysbio_synth_omop.person",
+)
+
+# The query each init_db.py runs, without its person_id filter
+COHORT_QUERY = """
+WITH ranked_conditions AS (
+  SELECT
+    co.person_id,
+    c.concept_name AS diagnosis_name,
+    ROW_NUMBER() OVER (PARTITION BY co.person_id ORDER BY co.condition_start_date DESC) AS rn
+  FROM `data-development-440922.sysbio_synth_omop.condition_occurrence` co
+  JOIN `data-development-440922.sysbio_synth_omop.concept` c
+    ON co.condition_concept_id = c.concept_id
+)
+SELECT
+  p.person_id,
+  gender.concept_name AS gender,
+  p.year_of_birth,
+  race.concept_name AS race,
+  ethnicity.concept_name AS ethnicity,
+  rc.diagnosis_name
+FROM ranked_conditions rc
+JOIN `data-development-440922.sysbio_synth_omop.person` p
+  ON rc.person_id = p.person_id
+LEFT JOIN `data-development-440922.sysbio_synth_omop.concept` gender
+  ON p.gender_concept_id = gender.concept_id
+LEFT JOIN `data-development-440922.sysbio_synth_omop.concept` race
+  ON p.race_concept_id = race.concept_id
+LEFT JOIN `data-development-440922.sysbio_synth_omop.concept` ethnicity
+  ON p.ethnicity_concept_id = ethnicity.concept_id
+WHERE rc.rn = 1
+"""
+
+class StageTimer:
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def report(self) -> str:
+        width = max(len(name) for name, _ in self.stages)
+        return "\n".join(f"  {name:<{width}}  {seconds:8.2f}s" for name, seconds in self.stages)
+
+def source_watermarks(export: str) -> dict:
+    """Watermarks of the cohort's source, in the form init_db.py stores them."""
+    if export:
+        stat = os.stat(export)
+        return {export: f"{stat.st_mtime_ns}-{stat.st_size}"}
+    from google.cloud import bigquery
+    client = bigquery.Client()
+    return {table_id: client.get_table(table_id).modified.isoformat() for table_id in COHORT_TABLES}
+
+def stored_watermarks(service: str) -> dict:
+    directory, filename = SERVICES[service]
+    try:
+        with open(os.path.join(HERE, directory, filename + ".watermarks.json"), encoding="utf-8") as f:
+            return json.load(f).get("person", {})
+    except FileNotFoundError:
+        return {}
+
+def extract(path: str) -> str:
+    """Run the cohort query once and stream the result into a Parquet file."""
+    from google.cloud import bigquery
+    import pyarrow.parquet as pq
+
+    writer = None
+    rows = 0
+    result = bigquery.Client().query(COHORT_QUERY).result()
+    try:
+        for batch in result.to_arrow_iterable():
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # No batches at all; an empty file with the result's schema still partitions into empty shards
+        pq.write_table(result.to_arrow(), path)
+    print(f"Extracted {rows:,} persons from BigQuery")
+    return path
+
+def open_batches(path: str):
+    """The schema and record batches of a Parquet or CSV export."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(path)
+        return parquet.schema_arrow, parquet.iter_batches()
+    import pyarrow.csv as pacsv
+    # Empty cells are NULL, as when init_db.py reads a CSV export itself
+    reader = pacsv.open_csv(path, convert_options=pacsv.ConvertOptions(strings_can_be_null=True))
+    return reader.schema, reader
+
+def shard_masks(person_id):
+    import pyarrow.compute as pc
+    return {
+        "pd": pc.less_equal(person_id, MAX_PD_ID),
+        "ad": pc.and_(pc.greater(person_id, MAX_PD_ID), pc.less_equal(person_id, MAX_AD_ID)),
+        "sysbio": pc.greater(person_id, MAX_AD_ID),
+    }
+
+def partition(export: str, workdir: str, services) -> dict:
+    """Split the export into one Parquet shard per service in a single pass."""
+    import pyarrow.parquet as pq
+
+    paths = {service: os.path.join(workdir, f"{service}.parquet") for service in services}
+    schema, batches = open_batches(export)
+    # Every shard is written, even one no row falls into, so each init_db.py has a file to load
+    writers = {service: pq.ParquetWriter(path, schema) for service, path in paths.items()}
+    counts = dict.fromkeys(services, 0)
+    try:
+        for batch in batches:
+            masks = shard_masks(batch.column("person_id"))
+            for service in services:
+                shard = batch.filter(masks[service])
+                writers[service].write_batch(shard)
+                counts[service] += shard.num_rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+    print("Partitioned persons: " + ", ".join(f"{service} {count:,}" for service, count in counts.items()))
+    return paths
+
+def build(service: str, shard: str, watermarks: dict, incremental: bool = False) -> tuple:
+    """Rebuild or, with incremental, update one service's database from its shard with its own init_db.py."""
+    directory, filename = SERVICES[service]
+    cwd = os.path.join(HERE, directory)
+    command = [sys.executable, "init_db.py"]
+    if incremental:
+        command.append("--incremental")
+    else:
+        for suffix in ("", "-wal", "-shm", ".watermarks.json"):
+            path = os.path.join(cwd, filename + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///./{filename}",
+        "PERSON_EXPORT": shard,
+        # The shard is a fresh file each run, so the watermarks describe the source it was cut from
+        "PERSON_WATERMARKS": json.dumps(watermarks),
+    }
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return result.returncode, result.stdout, time.perf_counter() - start
+
+def build_all(shards: dict, watermarks: dict, timer: StageTimer, incremental: bool = False) -> bool:
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        futures = {
+            service: pool.submit(build, service, shard, watermarks, incremental) for service, shard in shards.items()
+        }
+        ok = True
+        for service, future in futures.items():
+            returncode, output, seconds = future.result()
+            timer.stages.append((f"build {service}", seconds))
+            for line in output.splitlines():
+                print(f"[{service}] {line}")
+            if returncode != 0:
+                print(f"[{service}] init_db.py failed with exit code {returncode}")
+                ok = False
+    return ok
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--export", default=os.getenv("PERSON_EXPORT"),
+                        help="Local Parquet or CSV export of the cohort; BigQuery is queried when omitted")
+    parser.add_argument("--only", action="append", choices=sorted(SERVICES),
+                        help="Build only this service's database; repeat for several")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Apply changes to copies of the existing databases and swap them in")
+    parser.add_argument("--keep-shards", action="store_true", help="Keep the extracted and partitioned files")
+    args = parser.parse_args()
+    services = args.only or list(SERVICES)
+
+    timer = StageTimer()
+    workdir = tempfile.mkdtemp(prefix="build-dbs-")
+    start = time.perf_counter()
+    ok = True
+    try:
+        export = args.export and os.path.abspath(args.export)
+        watermarks = timer.run("watermarks", source_watermarks, export)
+        if args.incremental:
+            current = [service for service in services if stored_watermarks(service) == watermarks]
+            if current:
+                print("Sources unchanged since the last sync, skipped: " + ", ".join(current))
+            services = [service for service in services if service not in current]
+        if services:
+            if not export:
+                export = timer.run("extract", extract, os.path.join(workdir, "persons.parquet"))
+            shards = timer.run("partition", partition, export, workdir, services)
+            wall = time.perf_counter()
+            ok = build_all(shards, watermarks, timer, args.incremental)
+            timer.stages.append(("build (parallel)", time.perf_counter() - wall))
+    finally:
+        if args.keep_shards:
+            print(f"Shards kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    timer.stages.append(("total", time.perf_counter() - start))
+    print("Wall-clock time per stage:")
+    print(timer.report())
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
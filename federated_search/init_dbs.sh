@@ -3,20 +3,7 @@
 set -o errexit
 set -o nounset
 
-cd amp-pd-service
-echo "Wiping local db..."
-rm -rf *.db
-echo "Local db wiped."
-DATABASE_URL="sqlite:///./pd.db" python init_db.py
-
-cd ../amp-ad-service
-echo "Wiping local db..."
-rm -rf *.db
-echo "Local db wiped."
-DATABASE_URL="sqlite:///./ad.db" python init_db.py
-
-cd ../sysbio-service
-echo "Wiping local db..."
-rm -rf *.db
-echo "Local db wiped."
-DATABASE_URL="sqlite:///./sysbio.db" python init_db.py
+# Extracts the cohort once and builds pd.db, ad.db and sysbio.db in parallel.
+# Pass --export <file> to build from a local Parquet/CSV export instead of BigQuery.
+# Pass --incremental to update the running services' databases in place instead of rebuilding.
+python build_dbs.py "$@"
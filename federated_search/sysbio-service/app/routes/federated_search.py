@@ -1,31 +1,81 @@
-import re
+import asyncio
+import json
+import logging
+import threading
+import time
 from fastapi import APIRouter, Depends, HTTPException, Path, status, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from app.models.error import ErrorResponse
+from app.utils.arrow import (
+    ARROW_MEDIA_TYPE, arrow_available, concat_tables, dicts_to_table, first_values, ipc_to_table, result_to_table,
+    split_table_page, table_to_ipc, wants_arrow,
+)
+from app.utils.circuit_breaker import CircuitOpen, circuit_breakers, hedged
+from app.utils.data_model import fill_value_types, object_model, schema_cache
+from app.utils.db_executor import run_db
+from app.utils.entitlements import entitlements
 from app.utils.error_utils import error_response
+from app.utils.http_client import source_clients
+from app.utils.metrics import ROWS_RETURNED, SQL_SECONDS, registry
+from app.utils.ndjson import NDJSON_MEDIA_TYPE, encode_line, wants_ndjson
+from app.utils.pagination import decode_token, encode_token, fetch_page, is_paginatable, plan_page
+from app.utils.query_guard import QueryBudgetExceeded, QueryGuard, QueryRejected, check_plan
+from app.utils.query_log import query_log
+from app.utils.result_cache import cache_key, result_cache
+from app.utils.timing import Timings, TraceContext, current_timings, json_response, timings_block
+from app.utils.token_cache import token_cache
+from app.database import data_version
 from app.dependencies import get_db
 from app.schemas import SearchRequest
-from jose import jwt, JWTError
-from typing import Dict, Any, Optional
-import httpx
+from jose import JWTError
+from typing import Dict, Any, Iterable, Mapping, Optional
 import os
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 JWT_SECRET = os.getenv("JWT_SECRET", os.getenv("SECRET_KEY"))
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token", auto_error=False)
 
-AMP_PD_URL = os.getenv("AMP_PD_URL")
-AMP_AD_URL = os.getenv("AMP_AD_URL")
+AMP_PD_URL = os.getenv("AMP_PD_URL", "http://amp-pd:8080")
+AMP_AD_URL = os.getenv("AMP_AD_URL", "http://amp-ad:8080")
+
+# Per-source deadlines in seconds. The local query and the AMP calls run concurrently,
+# so a federated search takes roughly as long as its slowest source, capped by that
+# source's deadline. Sources that miss their deadline are reported in "errors".
+SOURCES = ("public", "pd", "ad")
+
+SOURCE_TIMEOUTS = {
+    "public": float(os.getenv("PUBLIC_QUERY_TIMEOUT", "10")),
+    "pd": float(os.getenv("AMP_PD_TIMEOUT", "10")),
+    "ad": float(os.getenv("AMP_AD_TIMEOUT", "10")),
+}
+
+# Upper bound on rows buffered between the AMP streams and a streaming client
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "1000"))
+STREAM_DONE = object()
+
+DOWNSTREAM_SECONDS = registry.histogram(
+    "downstream_request_duration_seconds", "Latency of calls to each AMP source, failed calls included.", ("source",),
+)
+DOWNSTREAM_ERRORS = registry.counter(
+    "downstream_errors_total", "Failed or skipped calls to each AMP source.", ("source", "reason"),
+)
+
+class SourceTimeout(Exception):
+    pass
+
+class InvalidQuery(Exception):
+    pass
 
 def get_current_user(token: str = Depends(oauth2_scheme)):
     assert JWT_SECRET is not None
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+        payload = token_cache.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
     return payload
@@ -35,137 +85,483 @@ def get_optional_current_user(token: Optional[str] = Depends(optional_oauth2_sch
         return None
     assert JWT_SECRET is not None
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+        return token_cache.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
     except JWTError:
         return None
 
-@router.post(
-    "/search",
-    response_model=dict,
-    responses={
-        400: {"model": ErrorResponse, "description": "Bad request due to invalid input"},
-        500: {"model": ErrorResponse, "description": "Internal server error"},
-    }
-)
-async def run_query(fastapi_request: Request, request: SearchRequest, db: Session = Depends(get_db), user: Optional[dict] = Depends(get_optional_current_user)):
-    # Prepare parameter dict
-    if isinstance(request.parameters, dict):
-        params: Dict[str, Any] = request.parameters.copy()
-    elif request.parameters is None:
-        params = {}
-    else:
-        raise HTTPException(
-            status_code=400,
-            detail="Only named parameters (dict[str, Any]) are supported for pagination"
-        )
+async def with_deadline(source: str, awaitable):
+    timeout = SOURCE_TIMEOUTS[source]
+    try:
+        return await asyncio.wait_for(awaitable, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise SourceTimeout(f"Source '{source}' did not respond within {timeout} seconds")
+
+async def run_public_source(fn, db: Session, *args):
+    """Run fn(db, *args) on a DB worker under the public deadline.
 
-    query_base = request.query.strip().rstrip(';')
-    pagination_supported = not re.search(r'\blimit\b', query_base, flags=re.IGNORECASE)
+    wait_for only stops waiting, so on timeout or cancellation the running statement is interrupted
+    and the worker is waited for; otherwise get_db would return the session's connection to the pool
+    while the worker is still executing on it.
+    """
+    lock = threading.Lock()
+    state = {"abandoned": False, "connection": None}
 
-    if pagination_supported:
-        query_base += " LIMIT :limit OFFSET :offset"
-        params["limit"] = request.limit or 10
-        params["offset"] = request.offset or 0
+    def work():
+        if state["abandoned"]:
+            raise SourceTimeout("Source 'public' was abandoned before its query started")
+        # Checked out outside the lock: a full pool can block here, and the event loop takes the lock
+        connection = db.connection().connection.dbapi_connection
+        with lock:
+            if state["abandoned"]:
+                raise SourceTimeout("Source 'public' was abandoned while waiting for a connection")
+            state["connection"] = connection
+        return fn(db, *args)
 
+    task = asyncio.ensure_future(run_db(work))
     try:
-        stmt = text(query_base)
-        result = db.execute(stmt, params)
-        rows = result.fetchall()
-        public_data = [
-            {**dict(row._mapping), "source": "public"}
-            for row in rows
-        ]
+        return await with_deadline("public", asyncio.shield(task))
+    except (SourceTimeout, asyncio.CancelledError):
+        with lock:
+            state["abandoned"] = True
+            if state["connection"] is not None:
+                state["connection"].interrupt()
+        await asyncio.gather(task, return_exceptions=True)
+        raise
+
+async def guarded_amp_call(source: str, call, hedge: bool = True):
+    """Run call() against an AMP service through its circuit breaker and deadline.
+
+    Calls are skipped with CircuitOpen while the source's breaker is open. When hedge is set and the breaker
+    has enough latency samples, a duplicate request is sent if the first is slower than the hedge percentile.
+    """
+    breaker = circuit_breakers[source]
+    if not breaker.allow():
+        DOWNSTREAM_ERRORS.inc(source, "circuit_open")
+        raise CircuitOpen(f"Source '{source}' is failing; calls are paused for up to {breaker.open_seconds} seconds")
+    start = time.monotonic()
+    try:
+        result = await with_deadline(source, hedged(breaker, call) if hedge else call())
+    except asyncio.CancelledError:
+        breaker.abandon()
+        raise
     except Exception as e:
-        return error_response(400, title="Invalid SQL", detail=f"Invalid SQL: {e}")
+        elapsed = time.monotonic() - start
+        breaker.record(elapsed, failed=True)
+        DOWNSTREAM_SECONDS.observe(elapsed, source)
+        record_timing(source, elapsed)
+        DOWNSTREAM_ERRORS.inc(source, "timeout" if isinstance(e, SourceTimeout) else "error")
+        raise
+    elapsed = time.monotonic() - start
+    breaker.record(elapsed, failed=False)
+    DOWNSTREAM_SECONDS.observe(elapsed, source)
+    record_timing(source, elapsed)
+    return result
 
-    pd_data, ad_data = [], []
-    pd_restricted, ad_restricted = {}, {}
+def record_timing(name: str, seconds: float):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
 
-    auth_header = fastapi_request.headers.get("Authorization")
-    headers = {}
-    if auth_header:
-        headers["Authorization"] = auth_header
+def record_downstream_timing(source: str, response):
+    # Fold the AMP service's own phases (plan, sql, serialize...) in under the source's name
+    timings = current_timings.get()
+    if timings is not None:
+        timings.merge(source, response.headers.get("Server-Timing"))
 
-    pdrd_access_tier = params.get("pdrd_access_tier", "public")
-    ad_access_tier = params.get("ad_access_tier", "public")
-
-    # WARNING: in this demo, the downstream AMP services still accept raw SQL queries on their /search endpoints.
-    # this puts them at risk of SQL injection attacks.
-    # This top-level "sysbio-service" implements a strategy for protecting against SQL injection,
-    # but all the AMP services would need to take that vulnerability into account.
-    # ~~~
-    # TODO: update the downstream AMP service /search endpoints to protect against SQL injection.
-    pd_request_payload = {
-        "query": request.query,
-        "parameters": {"access_tier": pdrd_access_tier}
-    }
-    ad_request_payload = {
-        "query": request.query,
-        "parameters": {"access_tier": ad_access_tier}
+async def timed(name: str, awaitable):
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        record_timing(name, time.perf_counter() - started)
+
+def breaker_states():
+    return {source: breaker.state for source, breaker in circuit_breakers.items()}
+
+def record_public_query(query: str, started: float, rows: int):
+    elapsed = time.perf_counter() - started
+    query_log.record(query, elapsed, rows)
+    SQL_SECONDS.observe(elapsed)
+    ROWS_RETURNED.observe(rows)
+
+def run_public_query(db: Session, query: str, params: Dict[str, Any], limit: Optional[int], offset: int, page_token: Optional[str]):
+    started = time.perf_counter()
+    with QueryGuard(db):
+        check_plan(db, query, params)
+        if limit is None:
+            rows = db.execute(text(query), params).fetchall()
+            next_token = None
+        else:
+            position = decode_token(page_token) if page_token else ({"o": offset} if offset else None)
+            rows, next_position = fetch_page(db, query, params, limit, position)
+            next_token = encode_token(next_position) if next_position else None
+    record_public_query(query, started, len(rows))
+    data = [
+        {**dict(row._mapping), "source": "public"}
+        for row in rows
+    ]
+    return data, {}, next_token
+
+async def query_amp_service(source: str, url: str, payload: dict, headers: dict):
+    client = source_clients.get(source)
+    response = await client.post(
+        f"{url}/search", json=payload, headers=headers, timeout=SOURCE_TIMEOUTS[source]
+    )
+    response.raise_for_status()
+    result_cache.observe_version(source, response.headers.get("X-Data-Version"))
+    record_downstream_timing(source, response)
+    body = response.json()
+    next_token = (body.get("pagination") or {}).get("next_page_token")
+    return body.get("data", []), body.get("restricted_fields", {}), next_token
+
+def run_public_arrow(db: Session, query: str, params: Dict[str, Any], limit: Optional[int], offset: int, page_token: Optional[str]):
+    started = time.perf_counter()
+    with QueryGuard(db):
+        check_plan(db, query, params)
+        if limit is None:
+            table = result_to_table(db.execute(text(query), params), source="public")
+            record_public_query(query, started, table.num_rows)
+            return table, {}, None
+        position = decode_token(page_token) if page_token else ({"o": offset} if offset else None)
+        plan = plan_page(db, query, params, limit, position)
+        table = result_to_table(db.execute(text(plan.sql), plan.params), source="public")
+    record_public_query(query, started, table.num_rows)
+    table, next_position = split_table_page(plan, table)
+    return table, {}, encode_token(next_position) if next_position else None
+
+async def query_amp_arrow(source: str, url: str, payload: dict, headers: dict):
+    client = source_clients.get(source)
+    response = await client.post(
+        f"{url}/search",
+        json=payload,
+        headers={**headers, "Accept": ARROW_MEDIA_TYPE},
+        timeout=SOURCE_TIMEOUTS[source],
+    )
+    response.raise_for_status()
+    result_cache.observe_version(source, response.headers.get("X-Data-Version"))
+    record_downstream_timing(source, response)
+    if response.headers.get("content-type", "").startswith(ARROW_MEDIA_TYPE):
+        table, metadata = ipc_to_table(response.content)
+    else:
+        # Service cannot produce Arrow; convert its JSON rows once here
+        metadata = response.json()
+        table = dicts_to_table(metadata.get("data", []))
+    next_token = (metadata.get("pagination") or {}).get("next_page_token")
+    return table, metadata.get("restricted_fields", {}), next_token
+
+async def arrow_search(db: Session, page: "FederatedPage", amp_requests: dict, headers: dict,
+                       timings: Timings, trace: TraceContext, include_timings: bool = False):
+    try:
+        tables, restricted_by_source, next_tokens, errors = await fetch_sources(
+            db, page, amp_requests, headers, run_public_arrow, query_amp_arrow
+        )
+    except InvalidQuery as e:
+        return error_response(400, title="Invalid SQL", detail=f"Invalid SQL: {e}")
+    except (QueryBudgetExceeded, QueryRejected) as e:
+        return query_guard_response(e)
+    timings.lap("fetch")
+
+    # Record batches from every source are concatenated as-is; rows are never rebuilt
+    present = [tables[source] for source in SOURCES if source in tables]
+    table = concat_tables(present) if present else dicts_to_table([])
+    restricted_fields = merge_restricted_fields(restricted_by_source)
+    data_model = build_data_model(db, page.query, table.column_names, restricted_fields, [first_values(table)])
+    table = table.select([key for key in data_model.get("required", []) if key in table.column_names])
+
+    metadata = {
+        "data_model": data_model,
+        "restricted_fields": restricted_fields,
+        "sources": {source: tables[source].num_rows if source in tables else 0 for source in SOURCES},
+        "pagination": page.pagination(next_tokens),
+        "circuit_breakers": breaker_states(),
     }
+    if errors:
+        metadata["errors"] = errors
+    timings.lap("merge")
+    if include_timings:
+        metadata["timings"] = timings_block(timings, trace)
+    started = time.perf_counter()
+    body = table_to_ipc(table, metadata)
+    timings.add("serialize", time.perf_counter() - started)
+    return Response(content=body, media_type=ARROW_MEDIA_TYPE, headers={"Server-Timing": timings.header()})
+
+def query_guard_response(exc: Exception):
+    title = "Query budget exceeded" if isinstance(exc, QueryBudgetExceeded) else "Query rejected"
+    return error_response(400, title=title, detail=str(exc), source="public")
+
+def source_error(source: str, exc: Exception):
+    if isinstance(exc, SourceTimeout):
+        return {"source": source, "title": "Timeout", "detail": str(exc)}
+    if isinstance(exc, CircuitOpen):
+        return {"source": source, "title": "Circuit open", "detail": str(exc)}
+    # Counted in DOWNSTREAM_ERRORS too; the log keeps the cause
+    logger.warning("%s service error: %s", source.upper(), exc)
+    return {"source": source, "title": "Source unavailable", "detail": str(exc)}
+
+async def fetch_sources(db: Session, page: "FederatedPage", amp_requests: dict, headers: dict, run_public, query_amp):
+    """Fetch one page from every source that still has rows, concurrently and each under its deadline.
+
+    run_public and query_amp produce (rows, restricted_fields, next_page_token) for the local database and for
+    an AMP service, in whichever row format the response is built from. Sources that fail or time out are left
+    out of the rows and reported in the returned errors.
+    """
+    def fetch_source(source: str):
+        if source == "public":
+            return timed("public", run_public_source(
+                run_public, db, page.query, page.params, page.limit, page.offset, page.page_tokens["public"]
+            ))
+        url, payload = amp_requests[source]
+        return guarded_amp_call(source, lambda: query_amp(source, url, payload, headers))
+
+    sources = [source for source in SOURCES if source in page.page_tokens]
+    results = await asyncio.gather(*(fetch_source(source) for source in sources), return_exceptions=True)
+
+    errors = []
+    data_by_source, restricted_by_source, next_tokens = {}, {}, {}
+    for source, result in zip(sources, results):
+        if isinstance(result, Exception):
+            if source == "public" and not isinstance(result, SourceTimeout):
+                if isinstance(result, (QueryBudgetExceeded, QueryRejected)):
+                    raise result
+                raise InvalidQuery(str(result))
+            errors.append(source_error(source, result))
+            # Retry the same page of a failed source when the client asks for the next page
+            next_tokens[source] = page.page_tokens.get(source)
+            continue
+        data_by_source[source], restricted_by_source[source], next_tokens[source] = result
+    return data_by_source, restricted_by_source, next_tokens, errors
 
-    async with httpx.AsyncClient() as client:
+class FederatedPage:
+    """What to fetch for one page of a federated query, decoded from a request or a page token."""
+
+    def __init__(self, query: str, params: Dict[str, Any], limit: Optional[int], offset: int, page_tokens: Dict[str, str]):
+        self.query = query
+        self.params = params
+        self.limit = limit
+        self.offset = offset
+        # Each source's own page token; "" is its first page and a missing source has no more rows
+        self.page_tokens = page_tokens
+
+    @classmethod
+    def from_token(cls, token: str):
+        cursor = decode_token(token)
         try:
-            pd_response = await client.post(f"{AMP_PD_URL}/search", json=pd_request_payload, headers=headers)
-            if pd_response.status_code == 200:
-                pd_json = pd_response.json()
-                pd_data = pd_json.get("data", [])
-                pd_restricted = pd_json.get("restricted_fields", {})
+            return cls(cursor["q"], cursor["p"], cursor["l"], cursor["o"], cursor["t"])
+        except KeyError:
+            raise ValueError("Malformed page token")
+
+    def amp_payload(self, access_tier: str, source: str):
+        # WARNING: in this demo, the downstream AMP services still accept raw SQL queries on their /search endpoints.
+        # this puts them at risk of SQL injection attacks.
+        # This top-level "sysbio-service" implements a strategy for protecting against SQL injection,
+        # but all the AMP services would need to take that vulnerability into account.
+        # ~~~
+        # TODO: update the downstream AMP service /search endpoints to protect against SQL injection.
+        payload = {
+            "query": self.query,
+            "parameters": {"access_tier": access_tier}
+        }
+        if self.limit is not None:
+            payload["limit"] = self.limit
+            payload["offset"] = self.offset
+            payload["page_token"] = self.page_tokens.get(source) or None
+        return payload
+
+    def pagination(self, next_tokens: Dict[str, Optional[str]]):
+        remaining = {source: token for source, token in next_tokens.items() if token is not None}
+        if self.limit is None or not remaining:
+            return {"next_page_url": None}
+        token = encode_token({
+            "q": self.query,
+            "p": self.params,
+            "l": self.limit,
+            "o": self.offset,
+            "t": remaining,
+        })
+        return {"next_page_url": f"/search?page_token={token}", "next_page_token": token}
+
+class StreamState:
+    def __init__(self, page: FederatedPage, bind, timings: Timings, trace: TraceContext, include_timings: bool = False):
+        self.errors = []
+        self.counts = {source: 0 for source in SOURCES}
+        self.restricted_by_source = {}
+        self.next_tokens = {}
+        self.page = page
+        self.bind = bind
+        self.timings = timings
+        self.trace = trace
+        self.include_timings = include_timings
+
+    def source_failed(self, source: str, exc: Exception):
+        self.errors.append(source_error(source, exc))
+        # Retry the same page of a failed source when the client asks for the next page
+        self.next_tokens[source] = self.page.page_tokens.get(source)
+
+async def stream_amp_rows(source: str, url: str, payload: dict, headers: dict, queue: asyncio.Queue, state: StreamState):
+    client = source_clients.get(source)
+    async with client.stream(
+        "POST",
+        f"{url}/search",
+        json=payload,
+        headers={**headers, "Accept": NDJSON_MEDIA_TYPE},
+        timeout=SOURCE_TIMEOUTS[source],
+    ) as response:
+        response.raise_for_status()
+        record_downstream_timing(source, response)
+        if not response.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+            # Service does not stream; forward its buffered rows instead
+            body = json.loads(await response.aread())
+            state.restricted_by_source[source] = body.get("restricted_fields", {})
+            state.next_tokens[source] = (body.get("pagination") or {}).get("next_page_token")
+            for row in body.get("data", []):
+                await queue.put((source, row))
+            return
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            message = json.loads(line)
+            if "errors" in message:
+                raise RuntimeError(message["errors"][0].get("detail"))
+            if "data" in message:
+                await queue.put((source, message["data"]))
+            elif "restricted_fields" in message:
+                state.restricted_by_source[source] = message["restricted_fields"]
+            if "pagination" in message:
+                state.next_tokens[source] = message["pagination"].get("next_page_token")
+
+async def run_stream_source(source: str, url: str, payload: dict, headers: dict, queue: asyncio.Queue, state: StreamState):
+    try:
+        # Streamed rows are forwarded as they arrive, so a duplicate request could repeat them
+        await guarded_amp_call(
+            source, lambda: stream_amp_rows(source, url, payload, headers, queue, state), hedge=False
+        )
+    except Exception as e:
+        state.source_failed(source, e)
+    await queue.put(STREAM_DONE)
+
+def stream_data_model(state: StreamState, fields: Iterable[str], restricted_fields: dict, rows: list):
+    # The request's session is closed by now; this one only connects if the schema cache misses
+    with Session(bind=state.bind) as session:
+        return build_data_model(session, state.page.query, fields, restricted_fields, rows)
+
+async def stream_rows(public_data: list, amp_tasks: list, queue: asyncio.Queue, state: StreamState):
+    try:
+        pending = len(amp_tasks)
+        buffered = []
+        # The header needs the shape of one row, so wait for the first row from any source
+        while not public_data and not buffered and pending:
+            item = await queue.get()
+            if item is STREAM_DONE:
+                pending -= 1
             else:
-                pd_response.raise_for_status()
-        except Exception as e:
-            print(f"PD service error: {e}")
+                buffered.append(item)
+        first_row = public_data[0] if public_data else (buffered[0][1] if buffered else {})
+        restricted_fields = merge_restricted_fields(state.restricted_by_source)
+        data_model = await run_db(
+            stream_data_model, state, first_row, restricted_fields, [*public_data, *(row for _, row in buffered)]
+        )
+        yield encode_line({"data_model": data_model})
+
+        for row in public_data:
+            state.counts["public"] += 1
+            yield encode_line({"data": row})
+        for source, row in buffered:
+            state.counts[source] += 1
+            yield encode_line({"data": row})
+        while pending:
+            item = await queue.get()
+            if item is STREAM_DONE:
+                pending -= 1
+                continue
+            source, row = item
+            state.counts[source] += 1
+            yield encode_line({"data": row})
+
+        trailer = {
+            "restricted_fields": merge_restricted_fields(state.restricted_by_source),
+            "sources": state.counts,
+            "pagination": state.page.pagination(state.next_tokens),
+            "circuit_breakers": breaker_states(),
+        }
+        if state.errors:
+            trailer["errors"] = state.errors
+        if state.include_timings:
+            # Headers went out before the first row, so the full breakdown is only in the trailer
+            state.timings.lap("stream")
+            trailer["timings"] = timings_block(state.timings, state.trace)
+        yield encode_line(trailer)
+    finally:
+        for task in amp_tasks:
+            task.cancel()
+
+async def stream_search(db: Session, page: FederatedPage, amp_requests: dict, headers: dict,
+                        timings: Timings, trace: TraceContext, include_timings: bool = False):
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    state = StreamState(page, db.get_bind(), timings, trace, include_timings)
+    amp_tasks = [
+        asyncio.create_task(run_stream_source(source, url, payload, headers, queue, state))
+        for source, (url, payload) in amp_requests.items()
+        if source in page.page_tokens
+    ]
 
+    public_data = []
+    if "public" in page.page_tokens:
         try:
-            ad_response = await client.post(f"{AMP_AD_URL}/search", json=ad_request_payload, headers=headers)
-            if ad_response.status_code == 200:
-                ad_json = ad_response.json()
-                ad_data = ad_json.get("data", [])
-                ad_restricted = ad_json.get("restricted_fields", {})
-            else:
-                ad_response.raise_for_status()
+            public_data, _, state.next_tokens["public"] = await timed("public", run_public_source(
+                run_public_query, db, page.query, page.params, page.limit, page.offset, page.page_tokens["public"]
+            ))
+        except SourceTimeout as e:
+            state.source_failed("public", e)
+        except (QueryBudgetExceeded, QueryRejected) as e:
+            for task in amp_tasks:
+                task.cancel()
+            return query_guard_response(e)
         except Exception as e:
-            print(f"AD service error: {e}")
+            for task in amp_tasks:
+                task.cancel()
+            return error_response(400, title="Invalid SQL", detail=f"Invalid SQL: {e}")
 
-    all_data = public_data + pd_data + ad_data
+    return StreamingResponse(
+        stream_rows(public_data, amp_tasks, queue, state),
+        media_type=NDJSON_MEDIA_TYPE,
+        headers={"Server-Timing": timings.header()},
+    )
 
+# Canonical order to ensure stable column sorting across all queries
+CANONICAL_FIELD_ORDER = [
+    # identifiers
+    "ID", "person_id", "drs_url",
+    # general
+    "source",
+    "description",
+    # synthetic_dataset
+    "dataset", "status", "sex", "age_at_sampling", "age_at_death",
+    "APOE4_compund_genotype", "time_from_baseline", "repository_link",
+    # person
+    "gender", "year_of_birth", "race", "ethnicity", "diagnosis_name",
+    # synthetic_files
+    "filename", "filesize_bytes",
+]
+
+# Labels used for each AMP source in the merged restricted_fields block
+RESTRICTED_SOURCE_LABELS = {"pd": "pdrd", "ad": "ad"}
+
+def merge_restricted_fields(restricted_by_source: Dict[str, dict]):
     restricted_fields = {}
-    if pd_restricted:
-        for field, reason in pd_restricted.items():
-            restricted_fields.setdefault(field.lower(), []).append({"source": "pdrd", "reason": reason})
-    if ad_restricted:
-        for field, reason in ad_restricted.items():
-            restricted_fields.setdefault(field.lower(), []).append({"source": "ad", "reason": reason})
-
-
-    def infer_type(value):
-        if isinstance(value, int):
-            return "integer"
-        elif isinstance(value, float):
-            return "number"
-        elif isinstance(value, bool):
-            return "boolean"
-        return "string"
-
-    # Canonical order to ensure stable column sorting across all queries
-    CANONICAL_FIELD_ORDER = [
-        # identifiers
-        "ID", "person_id", "drs_url",
-        # general
-        "source",
-        "description",
-        # synthetic_dataset
-        "dataset", "status", "sex", "age_at_sampling", "age_at_death",
-        "APOE4_compund_genotype", "time_from_baseline", "repository_link",
-        # person
-        "gender", "year_of_birth", "race", "ethnicity", "diagnosis_name",
-        # synthetic_files
-        "filename", "filesize_bytes",
-    ]
+    for source, restricted in restricted_by_source.items():
+        for field, reason in (restricted or {}).items():
+            restricted_fields.setdefault(field.lower(), []).append(
+                {"source": RESTRICTED_SOURCE_LABELS[source], "reason": reason}
+            )
+    return restricted_fields
+
+def build_data_model(db: Session, query: str, fields: Iterable[str], restricted_fields: dict, rows: Iterable[Mapping] = ()):
+    """Model of the merged rows, typed from the local schema and, for undeclared columns, from rows.
 
-    all_present_fields = set()
-    if all_data:
-        all_present_fields.update(all_data[0].keys())
+    AMP sources hold the same tables as the public database, so restricted fields that no row
+    carries are typed from the public schema too.
+    """
+    all_present_fields = set(fields)
     all_present_fields.update(restricted_fields.keys())
 
     # Filter and order the fields based on the canonical list
@@ -177,34 +573,150 @@ async def run_query(fastapi_request: Request, request: SearchRequest, db: Sessio
         if field not in ordered_keys:
             ordered_keys.append(field)
 
-    if ordered_keys:
-        first_row = all_data[0] if all_data else {}
-        data_model = {
-            "type": "object",
-            "properties": {
-                key: {"type": infer_type(first_row.get(key))} for key in ordered_keys
-            },
-            "required": ordered_keys
-        }
+    types = schema_cache.column_types(db, query, ordered_keys)
+    fill_value_types(types, rows)
+    return object_model(types)
+
+@router.post(
+    "/search",
+    response_model=dict,
+    responses={
+        400: {"model": ErrorResponse, "description": "Bad request due to invalid input"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    }
+)
+async def run_query(fastapi_request: Request, request: SearchRequest, db: Session = Depends(get_db), user: Optional[dict] = Depends(get_optional_current_user)):
+    timings = Timings()
+    current_timings.set(timings)
+    trace = TraceContext.from_header(fastapi_request.headers.get("traceparent"))
+    if request.page_token:
+        try:
+            page = FederatedPage.from_token(request.page_token)
+        except ValueError as e:
+            return error_response(400, title="Invalid page token", detail=str(e))
     else:
-        data_model = {"type": "object", "properties": {}}
+        # Prepare parameter dict
+        if isinstance(request.parameters, dict):
+            params: Dict[str, Any] = request.parameters.copy()
+            # Tier flags sent by older clients are ignored; tiers now come from the caller's visas
+            params.pop("pdrd_access_tier", None)
+            params.pop("ad_access_tier", None)
+        elif request.parameters is None:
+            params = {}
+        else:
+            raise HTTPException(
+                status_code=400,
+                detail="Only named parameters (dict[str, Any]) are supported for pagination"
+            )
+        query = request.query.strip().rstrip(';')
+        # Queries with their own LIMIT are returned whole, as a single page
+        limit = (request.limit or 10) if is_paginatable(query) else None
+        page = FederatedPage(query, params, limit, request.offset or 0, {source: "" for source in SOURCES})
+
+    auth_header = fastapi_request.headers.get("Authorization")
+    # Every AMP call is a child of this request's span
+    headers = {"traceparent": trace.header()}
+    if auth_header:
+        headers["Authorization"] = auth_header
+
+    # A dictionary lookup for returning users; see app.utils.entitlements
+    entitlement = await entitlements.resolve(user, auth_header)
+    if entitlement.visas:
+        # The AMP services verify the same visas before serving restricted tiers
+        headers["X-GA4GH-Passport"] = ",".join(entitlement.visas)
+    tiers = entitlement.tiers
+    amp_requests = {
+        "pd": (AMP_PD_URL, page.amp_payload(tiers["pd"], "pd")),
+        "ad": (AMP_AD_URL, page.amp_payload(tiers["ad"], "ad")),
+    }
+
+    timings.lap("parse")
+
+    accept = fastapi_request.headers.get("accept")
+    if wants_arrow(accept):
+        if not arrow_available():
+            return error_response(406, title="Not Acceptable", detail="Arrow responses are not available on this service.")
+        return await arrow_search(db, page, amp_requests, headers, timings, trace, request.timings)
+    if wants_ndjson(accept):
+        return await stream_search(db, page, amp_requests, headers, timings, trace, request.timings)
+
+    key = None
+    if result_cache.enabled:
+        result_cache.observe_version("public", data_version())
+        key = cache_key(
+            page.query, page.params, tiers, page.limit, page.offset, page.page_tokens,
+        )
+        cached = result_cache.get(key)
+        if cached is not None:
+            timings.lap("cache")
+            return json_response({**cached, "circuit_breakers": breaker_states()}, timings, trace, request.timings)
+
+    try:
+        data_by_source, restricted_by_source, next_tokens, errors = await fetch_sources(
+            db, page, amp_requests, headers, run_public_query, query_amp_service
+        )
+    except InvalidQuery as e:
+        return error_response(400, title="Invalid SQL", detail=f"Invalid SQL: {e}")
+    except (QueryBudgetExceeded, QueryRejected) as e:
+        return query_guard_response(e)
+    timings.lap("fetch")
 
-    # Build next_page_url only if pagination was applied
-    next_page_url = None
-    if pagination_supported and len(all_data) == (request.limit or 10):
-        offset = request.offset or 0
-        limit = request.limit or 10
-        next_offset = offset + limit
-        next_page_url = f"/search?offset={next_offset}&limit={limit}"
+    all_data = [row for source in SOURCES for row in data_by_source.get(source, [])]
+    restricted_fields = merge_restricted_fields(restricted_by_source)
+    # Sources can return different columns, so the model covers the first row of each
+    fields = [field for rows in data_by_source.values() for field in (rows[0] if rows else {})]
+    data_model = build_data_model(db, page.query, fields, restricted_fields, all_data)
 
-    return {
+    response = {
         "data_model": data_model,
         "data": all_data,
         "restricted_fields": restricted_fields,
-        "pagination": {
-            "next_page_url": next_page_url
-        }
+        "sources": {source: len(data_by_source.get(source, [])) for source in SOURCES},
+        "access_tiers": tiers,
+        "pagination": page.pagination(next_tokens),
     }
+    if errors:
+        response["errors"] = errors
+    elif key is not None:
+        # Partial results are never cached, so a recovered source is picked up on the next call
+        result_cache.put(key, response, page.page_tokens.keys())
+    timings.lap("merge")
+    # Breaker state is live, so it is added after caching rather than stored with the rows
+    return json_response({**response, "circuit_breakers": breaker_states()}, timings, trace, request.timings)
+
+@router.get(
+    "/search",
+    response_model=dict,
+    responses={
+        400: {"model": ErrorResponse, "description": "Bad request due to invalid input"},
+        500: {"model": ErrorResponse, "description": "Internal server error"},
+    }
+)
+async def next_page(fastapi_request: Request, page_token: str, timings: bool = False, db: Session = Depends(get_db), user: Optional[dict] = Depends(get_optional_current_user)):
+    return await run_query(fastapi_request, SearchRequest(query="", page_token=page_token, timings=timings), db, user)
+
+@router.get("/stats/http-pool", response_model=dict)
+async def http_pool_stats():
+    return source_clients.stats()
+
+@router.get("/stats/cache", response_model=dict)
+async def cache_stats():
+    return result_cache.stats()
+
+@router.get("/stats/token-cache", response_model=dict)
+async def token_cache_stats():
+    return token_cache.stats()
+
+@router.get("/stats/circuit-breakers", response_model=dict)
+async def circuit_breaker_stats():
+    return {source: breaker.snapshot() for source, breaker in circuit_breakers.items()}
+
+@router.post("/cache/invalidate", response_model=dict)
+async def invalidate_cache(source: Optional[str] = None):
+    # Call after reloading a service's SQLite database; omit source to drop everything
+    if source is not None and source not in SOURCES:
+        return error_response(400, title="Bad Request", detail=f"Unknown source '{source}'.")
+    return {"invalidated": result_cache.invalidate(source)}
 
 @router.get(
     "/ga4gh/drs/v1/objects/{object_id}",
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 from app.dependencies import get_db
+from app.utils.db_executor import run_db
 from app.models.table import Table, ListTablesResponse
 
 router = APIRouter()
@@ -9,9 +10,9 @@ router = APIRouter()
 @router.get("/tables", response_model=ListTablesResponse)
 async def list_tables(db: Session = Depends(get_db)):
     try:
-        tables = db.execute(
+        tables = await run_db(lambda: db.execute(
             text("SELECT name FROM sqlite_master WHERE type='table';")
-        ).fetchall()
+        ).fetchall())
 
         result = []
         for row in tables:
@@ -5,3 +5,7 @@ class SearchRequest(BaseModel):
     parameters: Optional[Union[List[Any], Dict[str, Any]]] = None
     limit: Optional[int] = 10
     offset: Optional[int] = 0
+    # Opaque cursor from a previous response's pagination block; replaces query, parameters and limit
+    page_token: Optional[str] = None
+    # Adds a "timings" block with the per-phase breakdown also sent in the Server-Timing header
+    timings: Optional[bool] = False
@@ -0,0 +1,84 @@
+import json
+from typing import Iterable, Optional
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow responses are optional; /search falls back to JSON without pyarrow
+    pa = None
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# Rows pulled from the cursor per record batch
+ARROW_BATCH_SIZE = 5000
+
+def wants_arrow(accept: Optional[str]) -> bool:
+    return ARROW_MEDIA_TYPE in (accept or "")
+
+def arrow_available() -> bool:
+    return pa is not None
+
+def rows_to_batch(names: list, rows: list, drop: Iterable[str] = (), source: Optional[str] = None):
+    # Columns are built straight from the row tuples; no per-row dicts are created
+    columns = list(zip(*rows)) if rows else [() for _ in names]
+    keep = [i for i, name in enumerate(names) if name not in drop]
+    arrays = [pa.array(columns[i]) for i in keep]
+    fields = [names[i] for i in keep]
+    if source is not None:
+        arrays.append(pa.array([source] * len(rows), pa.string()))
+        fields.append("source")
+    return pa.Table.from_arrays(arrays, names=fields)
+
+def result_to_table(result, drop: Iterable[str] = (), source: Optional[str] = None, batch_size: int = ARROW_BATCH_SIZE,
+                    max_rows: Optional[int] = None):
+    names = list(result.keys())
+    tables = []
+    read = 0
+    while max_rows is None or read < max_rows:
+        size = batch_size if max_rows is None else min(batch_size, max_rows - read)
+        rows = result.fetchmany(size)
+        if not rows:
+            break
+        read += len(rows)
+        tables.append(rows_to_batch(names, rows, drop, source))
+    if not tables:
+        return rows_to_batch(names, [], drop, source)
+    return concat_tables(tables)
+
+def dicts_to_table(rows: list):
+    return pa.Table.from_pylist(rows)
+
+def concat_tables(tables: list):
+    # Batches and sources can disagree on columns or have all-null columns; promote rather than fail
+    return pa.concat_tables(tables, promote_options="permissive")
+
+def split_table_page(plan, table):
+    """Arrow counterpart of pagination.split_page."""
+    has_more = table.num_rows > plan.limit
+    table = table.slice(0, plan.limit)
+    last_row = None
+    if plan.key and table.num_rows:
+        last_row = {plan.key: table.column(plan.key)[table.num_rows - 1].as_py()}
+    return table, plan.next_position(last_row, has_more)
+
+def first_values(table) -> dict:
+    """First non-null value of every column, for typing columns the schema does not declare."""
+    values = {}
+    for name in table.column_names:
+        column = table.column(name).drop_null()
+        values[name] = column[0].as_py() if len(column) else None
+    return values
+
+def table_to_ipc(table, metadata: dict) -> bytes:
+    table = table.replace_schema_metadata({key: json.dumps(value, default=str) for key, value in metadata.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def ipc_to_table(data: bytes):
+    table = pa.ipc.open_stream(data).read_all()
+    metadata = {
+        key.decode("utf-8"): json.loads(value)
+        for key, value in (table.schema.metadata or {}).items()
+    }
+    return table.replace_schema_metadata(None), metadata
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+# A source's circuit opens when, over the last CIRCUIT_WINDOW calls (and at least CIRCUIT_MIN_CALLS),
+# the share of failed calls or of calls slower than CIRCUIT_SLOW_CALL_SECONDS crosses its threshold.
+# After CIRCUIT_OPEN_SECONDS it lets CIRCUIT_HALF_OPEN_PROBES calls through; one good probe closes it again.
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "5"))
+CIRCUIT_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+# Send a duplicate request once a call has been outstanding longer than this percentile of recent
+# successful latencies. 0 disables hedging.
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one downstream source, tripped by failure or slow-call rate."""
+
+    def __init__(self, name: str, window: int = CIRCUIT_WINDOW, min_calls: int = CIRCUIT_MIN_CALLS,
+                 failure_rate: float = CIRCUIT_FAILURE_RATE, slow_call_seconds: float = CIRCUIT_SLOW_CALL_SECONDS,
+                 slow_call_rate: float = CIRCUIT_SLOW_CALL_RATE, open_seconds: float = CIRCUIT_OPEN_SECONDS,
+                 half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES, hedge_percentile: float = HEDGE_PERCENTILE):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.hedge_percentile = hedge_percentile
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._latencies = deque(maxlen=max(window, 100))
+        self._opened_at = 0.0
+        self._probes = 0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                self.rejected += 1
+                return False
+            self._probes += 1
+        self.calls += 1
+        return True
+
+    def record(self, latency: float, failed: bool):
+        slow = latency >= self.slow_call_seconds
+        if failed:
+            self.failures += 1
+        else:
+            self._latencies.append(latency)
+
+        if self.state == HALF_OPEN:
+            if failed or slow:
+                self._open()
+            else:
+                self.state = CLOSED
+                self._outcomes.clear()
+            return
+
+        self._outcomes.append((failed, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        calls = len(self._outcomes)
+        failure_rate = sum(1 for failed, _ in self._outcomes if failed) / calls
+        slow_rate = sum(1 for _, slow in self._outcomes if slow) / calls
+        if failure_rate >= self.failure_rate or slow_rate >= self.slow_call_rate:
+            self._open()
+
+    def abandon(self):
+        # A call that was cancelled says nothing about the source; just give its probe slot back
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.opened += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge_percentile or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))
+        return latencies[index]
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "opened": self.opened,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "hedge_delay_seconds": self.hedge_delay(),
+        }
+
+async def hedged(breaker: CircuitBreaker, call: Callable[[], Awaitable]):
+    """Await call(), firing one duplicate if it is still outstanding after the breaker's hedge delay."""
+    delay = breaker.hedge_delay()
+    if delay is None:
+        return await call()
+
+    primary = asyncio.ensure_future(call())
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            breaker.hedges += 1
+            pending.add(asyncio.ensure_future(call()))
+        error = None
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        breaker.hedges_won += 1
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+
+circuit_breakers = {
+    "pd": CircuitBreaker("pd"),
+    "ad": CircuitBreaker("ad"),
+}
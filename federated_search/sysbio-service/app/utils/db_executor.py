@@ -0,0 +1,15 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# SQLAlchemy sessions are synchronous, so async routes hand their queries to this pool instead of
+# blocking the event loop. Its size is the cap on concurrent queries per worker process, separate
+# from the threadpool FastAPI uses for sync dependencies and routes.
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
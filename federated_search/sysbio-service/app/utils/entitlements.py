@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from jose import jwt
+from jose.exceptions import JOSEError
+from app.utils.http_client import source_clients
+
+# auth-service, which hands out passports at /userinfo and publishes the keys that sign their visas
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth:8080")
+AUTH_JWKS_URL = os.getenv("AUTH_JWKS_URL", f"{AUTH_SERVICE_URL}/.well-known/jwks.json")
+# Expected "iss" of visas; any issuer whose key is in the JWKS is accepted when unset
+AUTH_ISSUER = os.getenv("AUTH_ISSUER")
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", "5"))
+JWKS_TTL = float(os.getenv("JWKS_TTL", "3600"))
+# A visa signed with an unknown key triggers a JWKS refresh at most this often
+JWKS_MIN_REFRESH = float(os.getenv("JWKS_MIN_REFRESH", "30"))
+ENTITLEMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENTITLEMENT_CACHE_MAX_ENTRIES", "10000"))
+# Entitlements are derived again at least this often, so new grants show up before old visas expire
+ENTITLEMENT_MAX_TTL = float(os.getenv("ENTITLEMENT_MAX_TTL", "900"))
+
+TIER_ORDER = ("public", "registered", "controlled")
+REGISTERED_VISA_TYPES = ("AcceptedTermsAndPolicies", "ResearcherStatus", "AffiliationAndRole")
+
+def _datasets(name: str) -> List[str]:
+    return [value.strip() for value in os.getenv(name, "").split(",") if value.strip()]
+
+# Datasets (visa "value"s) whose ControlledAccessGrants unlock each AMP source's controlled tier.
+# An empty list accepts any ControlledAccessGrants visa, e.g. AMP_PD_DATASETS=phs000123.v1.p1.c1
+SOURCE_DATASETS = {
+    "pd": _datasets("AMP_PD_DATASETS"),
+    "ad": _datasets("AMP_AD_DATASETS"),
+}
+
+class Entitlement:
+    __slots__ = ("tiers", "visas", "expires_at")
+
+    def __init__(self, tiers: Dict[str, str], visas: List[str], expires_at: float):
+        self.tiers = tiers
+        # Verified visa JWTs, forwarded so the AMP services can check them too
+        self.visas = visas
+        self.expires_at = expires_at
+
+PUBLIC = Entitlement({source: "public" for source in SOURCE_DATASETS}, [], float("inf"))
+
+def source_tiers(visas: List[dict]) -> Dict[str, str]:
+    """Highest tier each source grants for a set of verified ga4gh_visa_v1 claims."""
+    tiers = dict(PUBLIC.tiers)
+    for visa in visas:
+        visa_type, value = visa.get("type"), visa.get("value")
+        for source, datasets in SOURCE_DATASETS.items():
+            if visa_type == "ControlledAccessGrants" and (not datasets or value in datasets):
+                tier = "controlled"
+            elif visa_type in REGISTERED_VISA_TYPES or visa_type == "ControlledAccessGrants":
+                tier = "registered"
+            else:
+                continue
+            if TIER_ORDER.index(tier) > TIER_ORDER.index(tiers[source]):
+                tiers[source] = tier
+    return tiers
+
+class EntitlementCache:
+    """Per-source access tiers derived from each user's GA4GH passport, kept per subject until a visa expires.
+
+    A cached user's tiers cost one dictionary lookup. On a miss the passport is fetched from auth-service
+    and its visas are verified locally against the cached JWKS; concurrent misses for the same subject
+    share one fetch. If auth-service cannot be reached the caller is treated as public, without caching.
+    """
+
+    def __init__(self, max_entries: int = ENTITLEMENT_CACHE_MAX_ENTRIES, max_ttl: float = ENTITLEMENT_MAX_TTL):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self._entries: "OrderedDict[str, Entitlement]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._jwks: Optional[dict] = None
+        self._jwks_fetched_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.rejected_visas = 0
+        self.jwks_fetches = 0
+
+    def lookup(self, sub: str) -> Optional[Entitlement]:
+        with self._lock:
+            entry = self._entries.get(sub)
+            if entry is None:
+                return None
+            if time.time() >= entry.expires_at:
+                del self._entries[sub]
+                return None
+            self._entries.move_to_end(sub)
+            return entry
+
+    async def resolve(self, user: Optional[dict], authorization: Optional[str]) -> Entitlement:
+        if not user or not authorization or not user.get("sub"):
+            return PUBLIC
+        sub = user["sub"]
+        entry = self.lookup(sub)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+
+        inflight = self._inflight.get(sub)
+        if inflight is None:
+            # A task of its own, so a cancelled request does not cancel the others waiting on it
+            inflight = asyncio.ensure_future(self._derive_shared(sub, authorization))
+            self._inflight[sub] = inflight
+        return await asyncio.shield(inflight)
+
+    async def _derive_shared(self, sub: str, authorization: str) -> Entitlement:
+        try:
+            return await self._derive(sub, authorization)
+        except Exception:
+            self.failures += 1
+            return PUBLIC
+        finally:
+            self._inflight.pop(sub, None)
+
+    async def _derive(self, sub: str, authorization: str) -> Entitlement:
+        response = await source_clients.get("auth").get(
+            f"{AUTH_SERVICE_URL}/userinfo", headers={"Authorization": authorization}, timeout=AUTH_TIMEOUT,
+        )
+        response.raise_for_status()
+        passport = response.json()
+
+        now = time.time()
+        expires_at = now + self.max_ttl
+        visas, claims = [], []
+        for visa in passport.get("ga4gh_passport_v1") or []:
+            try:
+                kid = jwt.get_unverified_header(visa).get("kid")
+                decoded = jwt.decode(
+                    visa, await self.jwks(kid), algorithms=["RS256"], issuer=AUTH_ISSUER, options={"verify_aud": False},
+                )
+            except JOSEError:
+                self.rejected_visas += 1
+                continue
+            if decoded.get("sub") != sub:
+                self.rejected_visas += 1
+                continue
+            visas.append(visa)
+            claims.append(decoded.get("ga4gh_visa_v1") or {})
+            if isinstance(decoded.get("exp"), (int, float)):
+                expires_at = min(expires_at, decoded["exp"])
+
+        entry = Entitlement(source_tiers(claims), visas, expires_at)
+        with self._lock:
+            self._entries[sub] = entry
+            self._entries.move_to_end(sub)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    async def jwks(self, kid: Optional[str] = None) -> dict:
+        """auth-service's signing keys, refreshed early when a visa names a key we do not have yet."""
+        age = time.monotonic() - self._jwks_fetched_at
+        if self._jwks is not None and age < JWKS_TTL:
+            if kid is None or any(key.get("kid") == kid for key in self._jwks.get("keys", [])) or age < JWKS_MIN_REFRESH:
+                return self._jwks
+        try:
+            response = await source_clients.get("auth").get(AUTH_JWKS_URL, timeout=AUTH_TIMEOUT)
+            response.raise_for_status()
+            self._jwks = response.json()
+            self.jwks_fetches += 1
+        except Exception:
+            # Keep verifying with the keys we have until auth-service is reachable again
+            if self._jwks is None:
+                raise
+        self._jwks_fetched_at = time.monotonic()
+        return self._jwks
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "rejected_visas": self.rejected_visas,
+            "jwks_fetches": self.jwks_fetches,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._jwks = None
+        self._jwks_fetched_at = 0.0
+
+entitlements = EntitlementCache()
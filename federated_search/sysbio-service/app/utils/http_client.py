@@ -0,0 +1,101 @@
+import os
+import httpx
+from typing import Dict
+
+# One pooled client per downstream source, shared by every request in the process.
+# Pool limits can be tuned per source, e.g. AMP_PD_MAX_CONNECTIONS or AMP_AD_MAX_KEEPALIVE.
+POOL_DEFAULTS = {
+    "MAX_CONNECTIONS": "100",
+    "MAX_KEEPALIVE": "20",
+    "KEEPALIVE_EXPIRY": "30",
+}
+HTTP2_ENABLED = os.getenv("AMP_HTTP2", "false").lower() in ("1", "true", "yes")
+
+def _pool_setting(source: str, name: str) -> str:
+    return os.getenv(f"AMP_{source.upper()}_{name}", os.getenv(f"AMP_{name}", POOL_DEFAULTS[name]))
+
+def pool_limits(source: str) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(_pool_setting(source, "MAX_CONNECTIONS")),
+        max_keepalive_connections=int(_pool_setting(source, "MAX_KEEPALIVE")),
+        keepalive_expiry=float(_pool_setting(source, "KEEPALIVE_EXPIRY")),
+    )
+
+def http2_available() -> bool:
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("AMP_HTTP2 is enabled but the 'h2' package is not installed; falling back to HTTP/1.1")
+        return False
+    return True
+
+class PoolStats:
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        self.http2 = False
+
+    def as_dict(self) -> dict:
+        reused = self.requests - self.connections_opened
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "tls_handshakes": self.tls_handshakes,
+            "connections_reused": max(reused, 0),
+            "http2": self.http2,
+        }
+
+class SourceClients:
+    """Lazily created, process-wide httpx clients keyed by source name."""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, PoolStats] = {}
+
+    def get(self, source: str) -> httpx.AsyncClient:
+        client = self._clients.get(source)
+        if client is None or client.is_closed:
+            client = self._build(source)
+            self._clients[source] = client
+        return client
+
+    def _build(self, source: str) -> httpx.AsyncClient:
+        stats = self._stats.setdefault(source, PoolStats())
+        stats.http2 = http2_available()
+
+        async def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                stats.connections_opened += 1
+            elif event_name == "connection.start_tls.complete":
+                stats.tls_handshakes += 1
+
+        async def on_request(request: httpx.Request):
+            stats.requests += 1
+            request.extensions["trace"] = trace
+
+        return httpx.AsyncClient(
+            limits=pool_limits(source),
+            http2=stats.http2,
+            event_hooks={"request": [on_request]},
+        )
+
+    def stats(self) -> dict:
+        result = {}
+        for source, stats in self._stats.items():
+            limits = pool_limits(source)
+            result[source] = {
+                **stats.as_dict(),
+                "max_connections": limits.max_connections,
+                "max_keepalive_connections": limits.max_keepalive_connections,
+            }
+        return result
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+source_clients = SourceClients()
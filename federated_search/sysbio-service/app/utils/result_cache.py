@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Seconds a cached federated response stays valid; 0 disables the cache
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "300"))
+
+_STRING_LITERAL = re.compile(r"('(?:[^']|'')*')")
+
+def normalize_sql(query: str) -> str:
+    # Collapse whitespace and case outside string literals so trivially different spellings share an entry
+    parts = _STRING_LITERAL.split(query.strip().rstrip(';'))
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part).lower()
+        for i, part in enumerate(parts)
+    ).strip()
+
+def cache_key(query: str, params: dict, tiers: Dict[str, str], limit: Optional[int], offset: int,
+              page_tokens: dict) -> str:
+    raw = json.dumps([
+        normalize_sql(query),
+        params,
+        tiers,
+        limit,
+        offset,
+        page_tokens,
+    ], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class _Entry:
+    __slots__ = ("value", "size", "expires_at", "sources")
+
+    def __init__(self, value: Any, size: int, expires_at: float, sources: frozenset):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.sources = sources
+
+class ResultCache:
+    """LRU + TTL cache of federated /search responses with a memory budget."""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES, max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 ttl: float = RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key: str, value: Any, sources: Iterable[str]):
+        if not self.enabled:
+            return
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, time.monotonic() + self.ttl, frozenset(sources))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, source: Optional[str] = None) -> int:
+        with self._lock:
+            keys = [
+                key for key, entry in self._entries.items()
+                if source is None or source in entry.sources
+            ]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def observe_version(self, source: str, version: Optional[str]):
+        # A source reports a new data version after its SQLite database is reloaded
+        if version is None:
+            return
+        previous = self._versions.get(source)
+        self._versions[source] = version
+        if previous is not None and previous != version:
+            self.invalidate(source)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+result_cache = ResultCache()
@@ -0,0 +1,92 @@
+import json
+import re
+import secrets
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+from fastapi.responses import Response
+
+# W3C trace context: version-trace id-parent span id-flags
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_SERVER_TIMING_ENTRY = re.compile(r"^\s*([!#$%&'*+\-.^_`|~\w]+)(?:.*?;\s*dur=([0-9.]+))?")
+
+class TraceContext:
+    """The caller's trace, or a new one, plus a span id for the work done in this service."""
+
+    def __init__(self, trace_id: str, parent_id: Optional[str] = None, flags: str = "01"):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.flags = flags
+        self.span_id = secrets.token_hex(8)
+
+    @classmethod
+    def from_header(cls, traceparent: Optional[str]) -> "TraceContext":
+        match = _TRACEPARENT.match((traceparent or "").strip().lower())
+        if match and match.group(1) != "0" * 32 and match.group(2) != "0" * 16:
+            return cls(match.group(1), match.group(2), match.group(3))
+        return cls(secrets.token_hex(16))
+
+    def header(self) -> str:
+        """traceparent for calls made from this span."""
+        return f"00-{self.trace_id}-{self.span_id}-{self.flags}"
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    phases = {}
+    for entry in (header or "").split(","):
+        match = _SERVER_TIMING_ENTRY.match(entry)
+        if match and match.group(2):
+            phases[match.group(1)] = float(match.group(2))
+    return phases
+
+class Timings:
+    """Milliseconds spent per phase of one request, reported as Server-Timing and in the optional timings block.
+
+    lap() closes a sequential phase at the current time; add() records work that overlapped other
+    phases, such as one source of a concurrent fan-out.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds * 1000
+
+    def lap(self, name: str):
+        now = time.perf_counter()
+        self.add(name, now - self._last)
+        self._last = now
+
+    def merge(self, prefix: str, server_timing: Optional[str]):
+        # Phases reported by a downstream service in its Server-Timing header
+        for name, ms in parse_server_timing(server_timing).items():
+            self.phases[f"{prefix}.{name}"] = ms
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={ms:.2f}" for name, ms in self.phases.items())
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: round(ms, 3) for name, ms in self.phases.items()}
+
+current_timings: ContextVar[Optional[Timings]] = ContextVar("current_timings", default=None)
+
+def timings_block(timings: Timings, trace: TraceContext) -> dict:
+    return {"trace_id": trace.trace_id, "span_id": trace.span_id, "phases_ms": timings.as_dict()}
+
+def json_response(content: dict, timings: Timings, trace: TraceContext, include_timings: bool = False,
+                  headers: Optional[dict] = None) -> Response:
+    """Serialize content here, rather than in FastAPI, so the serialization phase can be timed too.
+
+    The timings block is written before serialization, so it holds every phase but that one;
+    the Server-Timing header includes it.
+    """
+    if include_timings:
+        content = {**content, "timings": timings_block(timings, trace)}
+    started = time.perf_counter()
+    body = json.dumps(content, default=str, separators=(",", ":")).encode("utf-8")
+    timings.add("serialize", time.perf_counter() - started)
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={**(headers or {}), "Server-Timing": timings.header()},
+    )
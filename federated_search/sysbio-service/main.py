@@ -1,11 +1,28 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from app.database import engine, snapshot_stats
 from app.routes import federated_search, tables
+from app.utils.circuit_breaker import OPEN, HALF_OPEN, circuit_breakers
+from app.utils.data_model import schema_cache
+from app.utils.entitlements import entitlements
+from app.utils.http_client import source_clients
+from app.utils.metrics import CONTENT_TYPE, MetricsMiddleware, pool_stats, registry
+from app.utils.result_cache import result_cache
+from app.utils.token_cache import token_cache
 from pathlib import Path
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the pooled AMP clients up front and drain their connections on shutdown
+    source_clients.get("pd")
+    source_clients.get("ad")
+    yield
+    await source_clients.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,6 +34,30 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+def circuit_breaker_stats():
+    return {
+        source: {
+            **breaker.snapshot(),
+            "open": int(breaker.state == OPEN),
+            "half_open": int(breaker.state == HALF_OPEN),
+        }
+        for source, breaker in circuit_breakers.items()
+    }
+
+registry.collect("http_pool", source_clients.stats, label="source")
+registry.collect("circuit_breaker", circuit_breaker_stats, label="source")
+registry.collect("result_cache", result_cache.stats)
+registry.collect("schema_cache", schema_cache.stats)
+registry.collect("token_cache", token_cache.stats)
+registry.collect("entitlement_cache", entitlements.stats)
+registry.collect("db_pool", lambda: pool_stats(engine))
+registry.collect("snapshot", lambda: snapshot_stats)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
 
 static_dir = Path(__file__).resolve().parent / "static"
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
@@ -4,6 +4,10 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 from app.dependencies import get_db
 from app.database import Base
+from app.utils.circuit_breaker import CircuitBreaker, circuit_breakers
+from app.utils.data_model import schema_cache
+from app.utils.entitlements import entitlements
+from app.utils.result_cache import result_cache
 from main import app
 
 DATABASE_URL = "sqlite:///:memory:"
@@ -36,3 +40,25 @@ def override_dependency():
         finally:
             db.close()
     app.dependency_overrides[get_db] = _get_db
+
+@pytest.fixture(autouse=True)
+def clear_result_cache():
+    result_cache.invalidate()
+    yield
+
+@pytest.fixture(autouse=True)
+def clear_schema_cache():
+    # Test databases are in memory, so data_version() cannot tell them apart
+    schema_cache.clear()
+    yield
+
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers():
+    for source in circuit_breakers:
+        circuit_breakers[source] = CircuitBreaker(source)
+    yield
+
+@pytest.fixture(autouse=True)
+def clear_entitlements():
+    entitlements.clear()
+    yield
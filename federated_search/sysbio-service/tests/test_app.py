@@ -1,11 +1,20 @@
+import asyncio
+import json
+import time
 import pytest
 import httpx
 import respx
 from httpx import AsyncClient, ASGITransport
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
 
 from main import app
 from app.database import Base
 from app.dependencies import get_db
+from app.routes import federated_search
+from app.utils import query_guard
+from app.utils.circuit_breaker import CircuitBreaker
+from app.utils.pagination import decode_token
 
 DATABASE_URL = "sqlite:///:memory:"
 
@@ -41,3 +50,292 @@ async def test_invalid_sql():
         res = await ac.post("/search", json={"query": "SELEC WRONG SYNTAX", "parameters": {}})
     assert res.status_code == 400
     assert "Invalid SQL" in res.json()["errors"][0]["detail"]
+
+@pytest.mark.asyncio
+async def test_timed_out_public_query_is_interrupted_before_returning(monkeypatch, tmp_path):
+    monkeypatch.setitem(federated_search.SOURCE_TIMEOUTS, "public", 0.05)
+    file_engine = create_engine(f"sqlite:///{tmp_path / 'slow.db'}")
+    db = sessionmaker(bind=file_engine)()
+    finished = []
+
+    def slow_query(session):
+        try:
+            return session.execute(text(
+                "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT COUNT(*) FROM n"
+            )).scalar()
+        finally:
+            finished.append(True)
+
+    with pytest.raises(federated_search.SourceTimeout):
+        await federated_search.run_public_source(slow_query, db)
+    # The worker is done with the connection before the caller gets it back
+    assert finished == [True]
+    db.close()
+    assert file_engine.pool.checkedout() == 0
+
+@pytest.mark.asyncio
+async def test_public_deadline_does_not_stall_the_loop_behind_a_blocked_checkout(monkeypatch):
+    monkeypatch.setitem(federated_search.SOURCE_TIMEOUTS, "public", 0.05)
+    called = []
+
+    class ExhaustedPool:
+        def connection(self):
+            # Stands in for a checkout waiting on a pool with every connection in use
+            time.sleep(0.3)
+            raise TimeoutError("QueuePool limit reached")
+
+    gaps, last = [], time.monotonic()
+
+    async def ticker():
+        nonlocal last
+        while True:
+            await asyncio.sleep(0.01)
+            gaps.append(time.monotonic() - last)
+            last = time.monotonic()
+
+    ticks = asyncio.create_task(ticker())
+    with pytest.raises(federated_search.SourceTimeout):
+        await federated_search.run_public_source(lambda db: called.append(db), ExhaustedPool())
+    ticks.cancel()
+    assert max(gaps) < 0.15
+    assert called == []
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_slow_source_is_reported_as_timed_out(monkeypatch):
+    monkeypatch.setitem(federated_search.SOURCE_TIMEOUTS, "ad", 0.05)
+
+    async def slow_ad(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={"data": [{"person_id": 2001}]})
+
+    respx.post("http://amp-pd:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 101}]})
+    )
+    respx.post("http://amp-ad:8080/search").mock(side_effect=slow_ad)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        response = await ac.post("/search", json={"query": "SELECT * FROM person", "parameters": {}})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["sources"]["pd"] == 1
+    assert body["sources"]["ad"] == 0
+    assert body["errors"] == [{
+        "source": "ad",
+        "title": "Timeout",
+        "detail": "Source 'ad' did not respond within 0.05 seconds",
+    }]
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_ndjson_streams_rows_from_every_source():
+    pd_lines = "\n".join([
+        '{"data_model": {}, "restricted_fields": {"gender": "registered access only"}}',
+        '{"data": {"person_id": 101, "source": "AMP PDRD"}}',
+        '{"data": {"person_id": 102, "source": "AMP PDRD"}}',
+        '{"pagination": {"next_page_url": null}}',
+    ]) + "\n"
+    respx.post("http://amp-pd:8080/search").mock(
+        return_value=httpx.Response(200, text=pd_lines, headers={"content-type": "application/x-ndjson"})
+    )
+    respx.post("http://amp-ad:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 2001}]})
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        response = await ac.post(
+            "/search",
+            json={"query": "SELECT * FROM person", "parameters": {}},
+            headers={"Accept": "application/x-ndjson"},
+        )
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert "data_model" in lines[0]
+    rows = [line["data"] for line in lines[1:-1]]
+    assert [row["source"] for row in rows[:2]] == ["public", "public"]
+    assert sorted(row["person_id"] for row in rows[2:]) == [101, 102, 2001]
+    trailer = lines[-1]
+    assert trailer["sources"] == {"public": 2, "pd": 2, "ad": 1}
+    assert trailer["restricted_fields"]["gender"] == [{"source": "pdrd", "reason": "registered access only"}]
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_federated_cursor_tracks_each_source():
+    pd_route = respx.post("http://amp-pd:8080/search").mock(side_effect=[
+        httpx.Response(200, json={"data": [{"person_id": 101}], "pagination": {"next_page_token": "pd-page-2"}}),
+        httpx.Response(200, json={"data": [{"person_id": 102}], "pagination": {"next_page_token": None}}),
+    ])
+    ad_route = respx.post("http://amp-ad:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 2001}], "pagination": {"next_page_token": None}})
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        first = await ac.post("/search", json={"query": "SELECT * FROM person", "parameters": {}, "limit": 1})
+        first_body = first.json()
+        assert first_body["sources"] == {"public": 1, "pd": 1, "ad": 1}
+        assert json.loads(pd_route.calls[0].request.content)["limit"] == 1
+        # The public database pages by key from the first page on
+        public_token = decode_token(first_body["pagination"]["next_page_token"])["t"]["public"]
+        assert decode_token(public_token) == {"k": "person_id", "a": 1}
+
+        second = await ac.get(first_body["pagination"]["next_page_url"])
+        second_body = second.json()
+
+    assert second_body["sources"] == {"public": 1, "pd": 1, "ad": 0}
+    assert json.loads(pd_route.calls[1].request.content)["page_token"] == "pd-page-2"
+    # AMP AD was exhausted on the first page, so it is not asked again
+    assert ad_route.call_count == 1
+    assert second_body["pagination"]["next_page_url"] is None
+
+@pytest.mark.asyncio
+async def test_malformed_page_token_is_rejected():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        res = await ac.get("/search", params={"page_token": "garbage!"})
+    assert res.status_code == 400
+    assert res.json()["errors"][0]["title"] == "Invalid page token"
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_repeated_query_is_served_from_cache():
+    pd_route = respx.post("http://amp-pd:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 101}]})
+    )
+    respx.post("http://amp-ad:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 2001}]})
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        first = await ac.post("/search", json={"query": "SELECT * FROM person LIMIT 10"})
+        second = await ac.post("/search", json={"query": "select *  from person limit 10;"})
+        stats = (await ac.get("/stats/cache")).json()
+
+    assert first.json() == second.json()
+    assert pd_route.call_count == 1
+    assert stats["hits"] == 1
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_arrow_response_concatenates_sources():
+    pa = pytest.importorskip("pyarrow")
+    pd_table = pa.table({"person_id": [101, 102], "source": ["AMP PDRD", "AMP PDRD"]}).replace_schema_metadata({
+        "restricted_fields": json.dumps({"gender": "registered access only"}),
+        "pagination": json.dumps({"next_page_token": None}),
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, pd_table.schema) as writer:
+        writer.write_table(pd_table)
+    respx.post("http://amp-pd:8080/search").mock(return_value=httpx.Response(
+        200, content=sink.getvalue().to_pybytes(), headers={"content-type": "application/vnd.apache.arrow.stream"}
+    ))
+    respx.post("http://amp-ad:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 2001, "source": "AMP AD"}]})
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        response = await ac.post(
+            "/search",
+            json={"query": "SELECT * FROM person", "parameters": {}},
+            headers={"Accept": "application/vnd.apache.arrow.stream"},
+        )
+
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.column_names == ["person_id", "source", "gender"]
+    assert table.column("person_id").to_pylist() == [1, 2, 101, 102, 2001]
+    assert table.column("source").to_pylist()[:3] == ["public", "public", "AMP PDRD"]
+    metadata = {key.decode(): json.loads(value) for key, value in table.schema.metadata.items()}
+    assert metadata["sources"] == {"public": 2, "pd": 2, "ad": 1}
+    assert metadata["restricted_fields"]["gender"] == [{"source": "pdrd", "reason": "registered access only"}]
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_open_circuit_skips_failing_source(caplog):
+    caplog.set_level("WARNING", logger=federated_search.__name__)
+    federated_search.circuit_breakers["ad"] = CircuitBreaker("ad", min_calls=2, failure_rate=0.5)
+    respx.post("http://amp-pd:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 101}]})
+    )
+    ad_route = respx.post("http://amp-ad:8080/search").mock(return_value=httpx.Response(503))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        for _ in range(3):
+            response = await ac.post("/search", json={"query": "SELECT * FROM person", "parameters": {}})
+
+    body = response.json()
+    assert ad_route.call_count == 2
+    assert body["sources"]["pd"] == 1
+    assert body["errors"][0]["source"] == "ad"
+    assert body["errors"][0]["title"] == "Circuit open"
+    assert body["circuit_breakers"] == {"pd": "closed", "ad": "open"}
+    # Failures that reached the service are logged, not printed
+    assert "AD service error" in caplog.text
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_expensive_cross_join_is_rejected(monkeypatch):
+    monkeypatch.setattr(query_guard, "QUERY_MAX_PLAN_COST", 1)
+    respx.post("http://amp-pd:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+    respx.post("http://amp-ad:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        response = await ac.post("/search", json={"query": "SELECT * FROM person a, person b", "parameters": {}})
+
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["title"] == "Query rejected"
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_trace_context_and_timings_are_propagated():
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    pd_route = respx.post("http://amp-pd:8080/search").mock(return_value=httpx.Response(
+        200, json={"data": [{"person_id": 101}]}, headers={"Server-Timing": "plan;dur=1.5, sql;dur=4.25"},
+    ))
+    ad_route = respx.post("http://amp-ad:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 2001}]})
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        response = await ac.post(
+            "/search",
+            json={"query": "SELECT * FROM person", "parameters": {}, "timings": True},
+            headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+        )
+
+    assert response.status_code == 200
+    for route in (pd_route, ad_route):
+        forwarded = route.calls.last.request.headers["traceparent"]
+        assert forwarded.startswith(f"00-{trace_id}-")
+        assert "00f067aa0ba902b7" not in forwarded
+    timings = response.json()["timings"]
+    assert timings["trace_id"] == trace_id
+    phases = timings["phases_ms"]
+    for phase in ("parse", "public", "pd", "ad", "fetch", "merge"):
+        assert phase in phases
+    assert phases["pd.sql"] == 4.25
+    server_timing = response.headers["Server-Timing"]
+    assert "pd.plan;dur=1.50" in server_timing
+    assert "serialize;dur=" in server_timing
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_timings_block_is_opt_in():
+    respx.post("http://amp-pd:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+    respx.post("http://amp-ad:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        response = await ac.post("/search", json={"query": "SELECT * FROM person", "parameters": {}})
+
+    assert "timings" not in response.json()
+    assert "parse;dur=" in response.headers["Server-Timing"]
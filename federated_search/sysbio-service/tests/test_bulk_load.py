@@ -0,0 +1,77 @@
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, text
+
+from app.bulk_load import bigquery_pages, bulk_load, file_pages
+
+COLUMNS = "person_id,gender,year_of_birth,race,ethnicity,diagnosis_name"
+# Same shape as app.models.person, on its own metadata so the shared test database is untouched
+PERSON = Table(
+    "person", MetaData(),
+    Column("person_id", Integer, primary_key=True), Column("gender", String), Column("year_of_birth", Integer),
+    Column("race", String), Column("ethnicity", String), Column("diagnosis_name", String),
+)
+
+def make_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'load.db'}")
+    PERSON.create(engine)
+    return engine
+
+def rows(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT * FROM person ORDER BY person_id")).fetchall()
+
+def test_csv_export_is_typed_filtered_and_replaces_existing_rows(tmp_path):
+    export = tmp_path / "persons.csv"
+    export.write_text(f"{COLUMNS}\n1,MALE,1950,,Hispanic,PD\n2,FEMALE,,Asian,,AD\n3000,MALE,1960,White,,PD\n")
+    engine = make_engine(tmp_path)
+
+    report = bulk_load(engine, PERSON, file_pages(str(export), PERSON, page_size=1,
+                                                             keep=lambda row: row[0] <= 1500))
+    assert (report.rows, report.pages) == (2, 2)
+    assert rows(engine) == [(1, "MALE", 1950, None, "Hispanic", "PD"), (2, "FEMALE", None, "Asian", None, "AD")]
+    assert "rows/s" in str(report)
+
+    export.write_text(f"{COLUMNS}\n1,FEMALE,1951,White,,PD\n")
+    bulk_load(engine, PERSON, file_pages(str(export), PERSON))
+    assert rows(engine)[0] == (1, "FEMALE", 1951, "White", None, "PD")
+    assert len(rows(engine)) == 2
+
+def test_parquet_export_loads_missing_columns_as_null(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    export = tmp_path / "persons.parquet"
+    pq.write_table(pa.table({"person_id": [5, 6], "gender": ["MALE", None]}), export)
+    engine = make_engine(tmp_path)
+
+    bulk_load(engine, PERSON, file_pages(str(export), PERSON))
+    assert rows(engine) == [(5, "MALE", None, None, None, None), (6, None, None, None, None, None)]
+
+def test_bigquery_result_is_read_page_by_page(tmp_path):
+    class Result:
+        def __init__(self, page_size):
+            records = [dict(zip(COLUMNS.split(","), (i, "MALE", 1950, "White", None, "PD"))) for i in range(5)]
+            self.pages = (records[i:i + page_size] for i in range(0, len(records), page_size))
+
+    class Client:
+        def query(self, query):
+            return self
+
+        def result(self, page_size):
+            return Result(page_size)
+
+    engine = make_engine(tmp_path)
+    report = bulk_load(engine, PERSON, bigquery_pages(Client(), "SELECT 1", PERSON, page_size=2))
+    assert (report.rows, report.pages) == (5, 3)
+
+def test_failed_load_rolls_back_and_restores_pragmas(tmp_path):
+    engine = make_engine(tmp_path)
+
+    def pages():
+        yield [(1, "MALE", 1950, None, None, None)]
+        raise RuntimeError("export truncated")
+
+    with pytest.raises(RuntimeError):
+        bulk_load(engine, PERSON, pages(), commit_rows=10)
+    assert rows(engine) == []
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 2
@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+
+from app.utils import circuit_breaker
+from app.utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, hedged
+
+def test_breaker_opens_on_failure_rate():
+    breaker = CircuitBreaker("pd", window=10, min_calls=4, failure_rate=0.5)
+    for failed in (False, True, False, True):
+        assert breaker.allow()
+        breaker.record(0.01, failed=failed)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.snapshot()["rejected"] == 1
+
+def test_breaker_opens_on_slow_calls():
+    breaker = CircuitBreaker("pd", window=10, min_calls=3, slow_call_seconds=1, slow_call_rate=0.6)
+    for _ in range(3):
+        breaker.allow()
+        breaker.record(2.0, failed=False)
+    assert breaker.state == OPEN
+
+def test_half_open_probe_closes_breaker(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("pd", window=10, min_calls=1, open_seconds=30, half_open_probes=1)
+    breaker.allow()
+    breaker.record(0.01, failed=True)
+    assert breaker.state == OPEN
+
+    now[0] += 31
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Only one probe at a time while half-open
+    assert not breaker.allow()
+    breaker.record(0.01, failed=False)
+    assert breaker.state == CLOSED
+
+def test_failed_probe_reopens_breaker(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("pd", window=10, min_calls=1, open_seconds=30)
+    breaker.allow()
+    breaker.record(0.01, failed=True)
+    now[0] += 31
+    assert breaker.allow()
+    breaker.record(0.01, failed=True)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+@pytest.mark.asyncio
+async def test_hedged_call_returns_faster_duplicate(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "HEDGE_MIN_SAMPLES", 2)
+    breaker = CircuitBreaker("pd", hedge_percentile=50)
+    breaker.record(0.01, failed=False)
+    breaker.record(0.01, failed=False)
+    delays = [1.0, 0.0]
+
+    async def call():
+        delay = delays.pop(0)
+        await asyncio.sleep(delay)
+        return delay
+
+    assert await asyncio.wait_for(hedged(breaker, call), timeout=0.5) == 0.0
+    assert breaker.hedges == 1
+    assert breaker.hedges_won == 1
+
+@pytest.mark.asyncio
+async def test_no_hedge_without_latency_samples():
+    breaker = CircuitBreaker("pd", hedge_percentile=50)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return "ok"
+
+    assert await hedged(breaker, call) == "ok"
+    assert len(calls) == 1
+    assert breaker.hedges == 0
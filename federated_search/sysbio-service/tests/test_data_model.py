@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from app.utils import data_model
+from app.utils.data_model import SchemaCache, fill_value_types, object_model, value_type
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE sample (id INTEGER PRIMARY KEY, flag BOOLEAN, score REAL, label TEXT, extra)"
+        ))
+        conn.execute(text("INSERT INTO sample VALUES (1, NULL, NULL, NULL, NULL), (2, 1, 2.5, 'b', 7)"))
+    with Session(bind=engine) as session:
+        yield session
+
+def test_bool_is_not_reported_as_integer():
+    assert value_type(True) == "boolean"
+    assert value_type(3) == "integer"
+    assert value_type(None) is None
+
+def test_types_come_from_schema_not_first_row(session):
+    cache = SchemaCache()
+    query = "SELECT * FROM sample"
+    rows = [dict(row._mapping) for row in session.execute(text(query))]
+    types = cache.column_types(session, query, rows[0].keys())
+    assert types == {"id": "integer", "flag": "boolean", "score": "number", "label": "string", "extra": None}
+    fill_value_types(types, rows)
+    assert types["extra"] == "integer"
+    assert object_model(types)["required"] == ["id", "flag", "score", "label", "extra"]
+
+def test_query_shape_is_cached_until_schema_changes(session, monkeypatch):
+    cache = SchemaCache()
+    query = "SELECT s.label, s.n FROM sample s"
+    monkeypatch.setattr(data_model, "data_version", lambda: "v1")
+    assert cache.column_types(session, query, ["label", "n"]) == {"label": "string", "n": None}
+    cache.column_types(session, query, ["label", "n"])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    session.execute(text("ALTER TABLE sample ADD COLUMN n INTEGER"))
+    monkeypatch.setattr(data_model, "data_version", lambda: "v2")
+    assert cache.column_types(session, query, ["label", "n"]) == {"label": "string", "n": "integer"}
+    assert cache.invalidations == 1
+
+def test_only_plain_column_references_take_the_schema_type(session):
+    cache = SchemaCache()
+    # An expression aliased to a column's name is not that column
+    query = "SELECT COUNT(*) AS label, s.id, label AS name FROM sample s"
+    assert cache.column_types(session, query, ["label", "id", "name"]) == {
+        "label": None, "id": "integer", "name": "string",
+    }
+    rows = [dict(row._mapping) for row in session.execute(text(query))]
+    types = cache.column_types(session, query, ["label", "id", "name"])
+    fill_value_types(types, rows)
+    assert types["label"] == "integer"
@@ -0,0 +1,45 @@
+import threading
+import time
+import asyncio
+import pytest
+
+from app.utils import db_executor
+from app.utils.db_executor import run_db
+
+@pytest.mark.asyncio
+async def test_run_db_uses_dedicated_threads():
+    name = await run_db(lambda: threading.current_thread().name)
+    assert name.startswith("db")
+
+@pytest.mark.asyncio
+async def test_event_loop_keeps_running_during_slow_query():
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    task = asyncio.create_task(ticker())
+    await run_db(time.sleep, 0.1)
+    task.cancel()
+    assert ticks >= 5
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded_by_pool_size():
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def query():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.02)
+        with lock:
+            active -= 1
+
+    await asyncio.gather(*(run_db(query) for _ in range(db_executor.DB_MAX_WORKERS * 2)))
+    assert peak <= db_executor.DB_MAX_WORKERS
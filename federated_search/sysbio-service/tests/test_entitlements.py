@@ -0,0 +1,120 @@
+import asyncio
+import time
+import httpx
+import pytest
+import respx
+from cryptography.hazmat.primitives.asymmetric import rsa
+from httpx import AsyncClient, ASGITransport
+from jose import jwk, jwt
+
+from main import app
+from app.routes import federated_search
+from app.utils import entitlements as entitlements_module
+from app.utils.entitlements import EntitlementCache
+
+SECRET = "test-secret"
+KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+JWKS = {"keys": [{**jwk.construct(KEY, algorithm="RS256").public_key().to_dict(), "kid": "k1"}]}
+
+def visa(sub="user-1", visa_type="ControlledAccessGrants", value="phs000123.v1.p1.c1", lifetime=3600, key=KEY):
+    now = int(time.time())
+    return jwt.encode({
+        "iss": "http://auth.test", "sub": sub, "iat": now, "exp": now + lifetime,
+        "ga4gh_visa_v1": {"type": visa_type, "asserted": now, "value": value, "by": "dac"},
+    }, key, algorithm="RS256", headers={"kid": "k1"})
+
+def mock_auth(visas):
+    respx.get("http://auth:8080/.well-known/jwks.json").mock(return_value=httpx.Response(200, json=JWKS))
+    return respx.get("http://auth:8080/userinfo").mock(
+        return_value=httpx.Response(200, json={"sub": "user-1", "ga4gh_passport_v1": visas})
+    )
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_tiers_come_from_verified_visas_and_are_cached_per_subject():
+    cache = EntitlementCache()
+    userinfo = mock_auth([visa(), visa(sub="someone-else"), visa(key=rsa.generate_private_key(65537, 2048))])
+    user = {"sub": "user-1"}
+
+    first = await cache.resolve(user, "Bearer t")
+    second = await cache.resolve(user, "Bearer t")
+    assert first.tiers == {"pd": "controlled", "ad": "controlled"}
+    assert second is first
+    assert len(first.visas) == 1
+    assert userinfo.call_count == 1
+    assert cache.stats() == {
+        "entries": 1, "hits": 1, "misses": 1, "failures": 0, "rejected_visas": 2, "jwks_fetches": 1,
+    }
+    assert (await cache.resolve(None, None)).tiers == {"pd": "public", "ad": "public"}
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_controlled_access_is_scoped_to_each_sources_datasets(monkeypatch):
+    monkeypatch.setitem(entitlements_module.SOURCE_DATASETS, "ad", ["phs999999"])
+    mock_auth([visa(), visa(visa_type="AcceptedTermsAndPolicies")])
+    entry = await EntitlementCache().resolve({"sub": "user-1"}, "Bearer t")
+    assert entry.tiers == {"pd": "controlled", "ad": "registered"}
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_entry_expires_with_the_earliest_visa_and_failures_are_not_cached():
+    cache = EntitlementCache()
+    userinfo = mock_auth([visa(lifetime=1)])
+    entry = await cache.resolve({"sub": "user-1"}, "Bearer t")
+    assert entry.expires_at <= time.time() + 1
+    entry.expires_at = time.time() - 1
+    assert cache.lookup("user-1") is None
+
+    async def unavailable(request):
+        await asyncio.sleep(0.01)
+        return httpx.Response(503)
+
+    userinfo.mock(side_effect=unavailable)
+    results = await asyncio.gather(*(cache.resolve({"sub": "user-1"}, "Bearer t") for _ in range(5)))
+    assert all(result.tiers == {"pd": "public", "ad": "public"} for result in results)
+    # Concurrent misses for one subject share a single passport fetch
+    assert userinfo.call_count == 2
+    assert cache.stats()["failures"] == 1
+    assert cache.lookup("user-1") is None
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_cancelled_request_does_not_cancel_others_waiting_on_its_fetch():
+    cache = EntitlementCache()
+    userinfo = mock_auth([visa()])
+
+    async def slow_passport(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"sub": "user-1", "ga4gh_passport_v1": [visa()]})
+
+    userinfo.mock(side_effect=slow_passport)
+    owner = asyncio.create_task(cache.resolve({"sub": "user-1"}, "Bearer t"))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(cache.resolve({"sub": "user-1"}, "Bearer t"))
+    await asyncio.sleep(0.01)
+    owner.cancel()
+
+    assert (await waiter).tiers == {"pd": "controlled", "ad": "controlled"}
+    assert owner.cancelled()
+    assert userinfo.call_count == 1
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_search_sends_entitled_tiers_and_visas_downstream(monkeypatch):
+    monkeypatch.setattr(federated_search, "JWT_SECRET", SECRET)
+    passport = [visa(visa_type="ResearcherStatus")]
+    mock_auth(passport)
+    pd_route = respx.post("http://amp-pd:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+    respx.post("http://amp-ad:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+    token = jwt.encode({"sub": "user-1", "exp": int(time.time()) + 60}, SECRET, algorithm="HS256")
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/search", headers={"Authorization": f"Bearer {token}"}, json={
+            "query": "SELECT * FROM person", "parameters": {"pdrd_access_tier": "controlled"},
+        })
+
+    assert response.status_code == 200
+    assert response.json()["access_tiers"] == {"pd": "registered", "ad": "registered"}
+    sent = pd_route.calls.last.request
+    assert b'"access_tier": "registered"' in sent.content or b'"access_tier":"registered"' in sent.content
+    assert sent.headers["X-GA4GH-Passport"] == passport[0]
@@ -0,0 +1,31 @@
+import pytest
+import httpx
+import respx
+
+from app.utils.http_client import SourceClients, pool_limits
+
+def test_pool_limits_are_configurable_per_source(monkeypatch):
+    monkeypatch.setenv("AMP_PD_MAX_CONNECTIONS", "7")
+    monkeypatch.setenv("AMP_MAX_KEEPALIVE", "3")
+    pd_limits = pool_limits("pd")
+    ad_limits = pool_limits("ad")
+    assert pd_limits.max_connections == 7
+    assert pd_limits.max_keepalive_connections == 3
+    assert ad_limits.max_connections == 100
+    assert ad_limits.max_keepalive_connections == 3
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_client_is_shared_across_requests():
+    respx.post("http://amp-pd:8080/search").mock(return_value=httpx.Response(200, json={"data": []}))
+    clients = SourceClients()
+    client = clients.get("pd")
+    await client.post("http://amp-pd:8080/search", json={})
+    await clients.get("pd").post("http://amp-pd:8080/search", json={})
+
+    assert clients.get("pd") is client
+    assert clients.stats()["pd"]["requests"] == 2
+
+    await clients.aclose()
+    assert client.is_closed
+    assert clients.get("pd") is not client
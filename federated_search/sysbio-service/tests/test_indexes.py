@@ -0,0 +1,41 @@
+from sqlalchemy import create_engine, inspect, text
+
+from app.indexes import build_indexes, filtered_columns, recommend_indexes
+from app.utils.query_log import QueryLog, read_log
+
+def make_engine():
+    engine = create_engine("sqlite:///:memory:")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE person (person_id INTEGER PRIMARY KEY, gender TEXT, year_of_birth INTEGER, "
+            "race TEXT, ethnicity TEXT, diagnosis_name TEXT)"
+        ))
+    return engine
+
+def test_build_indexes_skips_missing_tables():
+    engine = make_engine()
+    created = build_indexes(engine)
+    assert "ix_person_race" in created
+    assert not any(name.startswith("ix_synthetic") for name in created)
+    names = {index["name"] for index in inspect(engine).get_indexes("person")}
+    assert "ix_person_diagnosis_name_gender" in names
+
+def test_equality_filters_lead_composite_candidates():
+    columns = ["person_id", "gender", "year_of_birth", "race"]
+    query = "SELECT * FROM person WHERE year_of_birth > :y AND race = :r ORDER BY person_id"
+    assert filtered_columns(query, columns) == ["race", "year_of_birth"]
+
+def test_advisor_recommends_hot_unindexed_scans(tmp_path):
+    log = QueryLog(str(tmp_path / "queries.log"))
+    for _ in range(3):
+        log.record("SELECT * FROM person WHERE ethnicity = :e", 0.02, 10)
+    log.record("SELECT * FROM person WHERE person_id = :id", 0.001, 1)
+
+    engine = make_engine()
+    with engine.connect() as conn:
+        recommendations = recommend_indexes(conn, read_log(log.path))
+    assert [(r["table"], r["columns"], r["scans"]) for r in recommendations] == [("person", ["ethnicity"], 3)]
+
+    build_indexes(engine, {"ix_person_ethnicity": ("person", ("ethnicity",))})
+    with engine.connect() as conn:
+        assert recommend_indexes(conn, read_log(log.path)) == []
@@ -0,0 +1,51 @@
+import httpx
+import pytest
+import respx
+from httpx import AsyncClient, ASGITransport
+
+from app.utils.metrics import Histogram, Registry
+from main import app
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+    text = registry.render()
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{route="/a"} 3' in text
+
+def test_stats_collector_skips_non_numeric_values():
+    registry = Registry()
+    registry.collect("cache", lambda: {"hits": 3, "enabled": True, "state": "closed"})
+    text = registry.render()
+    assert "cache_hits 3" in text
+    assert "cache_enabled 1" in text
+    assert "cache_state" not in text
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_metrics_cover_search_and_sources():
+    respx.post("http://amp-pd:8080/search").mock(
+        return_value=httpx.Response(200, json={"data": [{"person_id": 101}]})
+    )
+    respx.post("http://amp-ad:8080/search").mock(return_value=httpx.Response(503))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        await ac.post("/search", json={"query": "SELECT * FROM person", "parameters": {}})
+        response = await ac.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'http_request_duration_seconds_count{method="POST",route="/search",status="200"}' in text
+    assert 'http_response_size_bytes_count{method="POST",route="/search"}' in text
+    assert "search_sql_duration_seconds_count" in text
+    assert 'downstream_request_duration_seconds_count{source="pd"}' in text
+    assert 'downstream_errors_total{source="ad",reason="error"}' in text
+    assert 'circuit_breaker_open{source="ad"} 0' in text
+    assert "result_cache_hits" in text
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import text
+
+from app.utils.pagination import decode_token, encode_token, fetch_page, supports_keyset
+from tests.conftest import TestingSessionLocal
+
+def test_token_round_trip():
+    position = {"k": "person_id", "a": 42}
+    assert decode_token(encode_token(position)) == position
+
+def test_malformed_token_is_rejected():
+    with pytest.raises(ValueError):
+        decode_token("not a token!")
+
+@pytest.mark.parametrize("query,expected", [
+    ("SELECT * FROM person WHERE gender = :g", True),
+    ("SELECT * FROM person ORDER BY year_of_birth", False),
+    ("SELECT * FROM person p JOIN synthetic_files f ON 1 = 1", False),
+    ("SELECT * FROM person, synthetic_files", False),
+    ("SELECT gender, COUNT(*) FROM person GROUP BY gender", False),
+])
+def test_supports_keyset(query, expected):
+    assert supports_keyset(query) is expected
+
+def test_fetch_page_uses_keyset_positions():
+    db = TestingSessionLocal()
+    try:
+        rows, position = fetch_page(db, "SELECT * FROM person", {}, 1)
+        assert [row.person_id for row in rows] == [1]
+        assert position == {"k": "person_id", "a": 1}
+
+        rows, position = fetch_page(db, "SELECT * FROM person", {}, 1, position)
+        assert [row.person_id for row in rows] == [2]
+        assert position is None
+    finally:
+        db.close()
+
+def test_fetch_page_falls_back_to_offsets():
+    db = TestingSessionLocal()
+    try:
+        rows, position = fetch_page(db, "SELECT gender FROM person ORDER BY gender", {}, 1)
+        assert [row.gender for row in rows] == ["female"]
+        assert position == {"o": 1}
+    finally:
+        db.close()
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from app.utils.query_guard import (
+    QueryBudgetExceeded, QueryGuard, QueryRejected, check_plan, clear_row_counts, table_aliases,
+)
+
+engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False})
+Session = sessionmaker(bind=engine)
+
+@pytest.fixture
+def db():
+    clear_row_counts()
+    session = Session()
+    session.execute(text("CREATE TABLE IF NOT EXISTS person (person_id INTEGER PRIMARY KEY, gender TEXT)"))
+    session.execute(text("DELETE FROM person"))
+    session.execute(text(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000) "
+        "INSERT INTO person SELECT i, 'x' FROM n"
+    ))
+    try:
+        yield session
+    finally:
+        session.close()
+
+def test_runaway_query_is_interrupted(db):
+    runaway = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT COUNT(*) FROM n"
+    with pytest.raises(QueryBudgetExceeded):
+        with QueryGuard(db, budget=0.05):
+            db.execute(text(runaway)).scalar()
+    # The handler is removed again, so the connection stays usable
+    assert db.execute(text("SELECT COUNT(*) FROM person")).scalar() == 1000
+
+def test_cross_join_above_cost_is_rejected(db):
+    with pytest.raises(QueryRejected):
+        check_plan(db, "SELECT * FROM person a, person AS b", {}, max_cost=10 ** 5)
+    check_plan(db, "SELECT * FROM person a, person AS b", {}, max_cost=10 ** 7)
+
+def test_indexed_join_is_allowed(db):
+    check_plan(db, "SELECT * FROM person a JOIN person b ON b.person_id = a.person_id", {}, max_cost=10)
+
+def test_aliases_map_to_tables():
+    assert table_aliases("SELECT * FROM person p JOIN files AS f ON 1, dataset d") == {
+        "person": "person", "p": "person", "files": "files", "f": "files", "dataset": "dataset", "d": "dataset",
+    }
@@ -0,0 +1,55 @@
+import time
+
+from app.utils.result_cache import ResultCache, cache_key, normalize_sql
+
+def key_for(query, **overrides):
+    args = dict(params={}, tiers={"pd": "public", "ad": "public"}, limit=10, offset=0, page_tokens={"public": "", "pd": "", "ad": ""})
+    args.update(overrides)
+    return cache_key(query, **args)
+
+def test_normalize_sql_keeps_string_literals():
+    assert normalize_sql("SELECT *\n  FROM person WHERE gender = 'Male';") == "select * from person where gender = 'Male'"
+
+def test_cache_key_depends_on_tiers_and_page():
+    base = key_for("SELECT * FROM person")
+    assert key_for("select *   from person") == base
+    assert key_for("SELECT * FROM person", tiers={"pd": "controlled", "ad": "public"}) != base
+    assert key_for("SELECT * FROM person", tiers={"ad": "public", "pd": "public"}) == base
+    assert key_for("SELECT * FROM person", page_tokens={"pd": "abc"}) != base
+
+def test_lru_eviction_and_counters():
+    cache = ResultCache(max_entries=2, max_bytes=10_000, ttl=60)
+    cache.put("a", {"n": 1}, ["public"])
+    cache.put("b", {"n": 2}, ["public"])
+    assert cache.get("a") == {"n": 1}
+    cache.put("c", {"n": 3}, ["public"])
+    assert cache.get("b") is None
+    assert cache.get("a") == {"n": 1}
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+
+def test_memory_budget_evicts_oldest():
+    cache = ResultCache(max_entries=100, max_bytes=40, ttl=60)
+    cache.put("a", {"data": "x" * 10}, ["public"])
+    cache.put("b", {"data": "y" * 10}, ["public"])
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] <= 40
+
+def test_ttl_expiry():
+    cache = ResultCache(max_entries=10, max_bytes=10_000, ttl=0.01)
+    cache.put("a", {"n": 1}, ["public"])
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+def test_new_data_version_invalidates_source():
+    cache = ResultCache(max_entries=10, max_bytes=10_000, ttl=60)
+    cache.observe_version("pd", "v1")
+    cache.put("with-pd", {"n": 1}, ["public", "pd"])
+    cache.put("public-only", {"n": 2}, ["public"])
+    cache.observe_version("pd", "v1")
+    assert cache.get("with-pd") == {"n": 1}
+    cache.observe_version("pd", "v2")
+    assert cache.get("with-pd") is None
+    assert cache.get("public-only") == {"n": 2}
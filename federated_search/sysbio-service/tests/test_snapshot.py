@@ -0,0 +1,87 @@
+import os
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, text
+
+from app.bulk_load import bulk_load
+from app.database import create_read_engine, create_write_engine, snapshot_stats
+from app.snapshot import Snapshot, read_watermarks, record_watermarks
+
+# Same shape as app.models.person, on its own metadata so the shared test database is untouched
+PERSON = Table(
+    "person", MetaData(),
+    Column("person_id", Integer, primary_key=True), Column("gender", String), Column("year_of_birth", Integer),
+)
+
+@pytest.fixture
+def served(tmp_path):
+    path = str(tmp_path / "served.db")
+    engine = create_write_engine(f"sqlite:///{path}")
+    PERSON.create(engine)
+    bulk_load(engine, PERSON, [[(1, "MALE", 1950), (2, "FEMALE", 1960)]])
+    engine.dispose()
+    record_watermarks(path, {"person": {"persons.csv": "v1"}})
+    return path
+
+def rows(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT * FROM person ORDER BY person_id")).fetchall()
+
+def test_only_new_and_changed_rows_are_applied(served):
+    with Snapshot(served) as snapshot:
+        report = snapshot.sync(PERSON, {"persons.csv": "v2"},
+                               lambda: [[(1, "MALE", 1950), (2, "FEMALE", 1961), (3, "MALE", 1970)]])
+    assert report.changed == 2
+    assert report.load.rows == 3
+    assert rows(create_read_engine(f"sqlite:///{served}")) == [
+        (1, "MALE", 1950), (2, "FEMALE", 1961), (3, "MALE", 1970),
+    ]
+    assert read_watermarks(served)["person"] == {"persons.csv": "v2"}
+    assert not os.path.exists(served + ".staging")
+
+def test_leftovers_of_an_interrupted_sync_are_discarded(served):
+    # A stale log next to the staging file would be replayed into the fresh copy
+    for suffix in ("", "-wal", "-shm"):
+        with open(served + ".staging" + suffix, "wb") as f:
+            f.write(b"stale")
+
+    with Snapshot(served) as snapshot:
+        snapshot.sync(PERSON, {"persons.csv": "v2"}, lambda: [[(3, "MALE", 1970)]])
+    assert len(rows(create_read_engine(f"sqlite:///{served}"))) == 3
+
+def test_unchanged_sources_are_not_read(served):
+    def pages():
+        raise AssertionError("source read although its watermark did not move")
+
+    with Snapshot(served) as snapshot:
+        report = snapshot.sync(PERSON, {"persons.csv": "v1"}, pages)
+    assert report.skipped
+
+def test_failed_sync_leaves_the_served_file_alone(served):
+    before = os.stat(served).st_ino
+
+    def pages():
+        yield [(4, "MALE", 1980)]
+        raise RuntimeError("export truncated")
+
+    with pytest.raises(RuntimeError):
+        with Snapshot(served) as snapshot:
+            snapshot.sync(PERSON, {"persons.csv": "v2"}, pages)
+    assert os.stat(served).st_ino == before
+    assert not any(os.path.exists(served + ".staging" + suffix) for suffix in ("", "-wal", "-shm"))
+    assert read_watermarks(served)["person"] == {"persons.csv": "v1"}
+
+def test_pooled_connections_reopen_after_a_swap(served):
+    engine = create_read_engine(f"sqlite:///{served}")
+    held = engine.connect()
+    assert len(rows(engine)) == 2
+    reopened = snapshot_stats["reopened"]
+
+    with Snapshot(served) as snapshot:
+        snapshot.sync(PERSON, {"persons.csv": "v2"}, lambda: [[(3, "MALE", 1970)]])
+
+    # A connection checked out before the swap finishes on the file it opened
+    assert held.execute(text("SELECT COUNT(*) FROM person")).scalar() == 2
+    held.close()
+    assert len(rows(engine)) == 3
+    assert snapshot_stats["reopened"] > reopened
@@ -0,0 +1,53 @@
+import time
+import pytest
+from jose import jwt, JWTError
+
+from app.utils.token_cache import VerifiedTokenCache
+
+SECRET = "test-secret"
+
+def make_token(**claims):
+    return jwt.encode({"sub": "user-1", **claims}, SECRET, algorithm="HS256")
+
+def test_second_decode_skips_verification():
+    cache = VerifiedTokenCache()
+    token = make_token(exp=int(time.time()) + 60)
+    assert cache.decode(token, SECRET, ["HS256"])["sub"] == "user-1"
+    assert cache.decode(token, SECRET, ["HS256"])["sub"] == "user-1"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_invalid_token_is_not_cached():
+    cache = VerifiedTokenCache()
+    token = make_token()
+    with pytest.raises(JWTError):
+        cache.decode(token, "wrong-secret", ["HS256"])
+    with pytest.raises(JWTError):
+        cache.decode(token, "wrong-secret", ["HS256"])
+    assert cache.stats()["failures"] == 2
+    assert cache.stats()["entries"] == 0
+
+def test_entry_expires_with_token(monkeypatch):
+    cache = VerifiedTokenCache()
+    exp = int(time.time()) + 60
+    token = make_token(exp=exp)
+    cache.decode(token, SECRET, ["HS256"])
+
+    # Once the token's exp has passed the cached claims are no longer served
+    real_time = time.time
+    monkeypatch.setattr(time, "time", lambda: real_time() + 120)
+    cache.decode(token, SECRET, ["HS256"])
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["misses"] == 2
+
+def test_cache_is_bounded():
+    cache = VerifiedTokenCache(max_entries=2)
+    for i in range(3):
+        cache.decode(make_token(n=i), SECRET, ["HS256"])
+    assert cache.stats()["entries"] == 2
+
+def test_callers_cannot_mutate_cached_claims():
+    cache = VerifiedTokenCache()
+    token = make_token()
+    cache.decode(token, SECRET, ["HS256"])["sub"] = "someone-else"
+    assert cache.decode(token, SECRET, ["HS256"])["sub"] == "user-1"